@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Benchmark CodeHelp's query prompts (codehelp.helper.run_query_prompts()) with
+and without SPECULATIVE_CLEANUP, replaying recorded responses with simulated
+API timing (time to first token + a fixed token rate) in place of real API
+calls.
+
+Responses are read from one of:
+  --jsonl FILE  one JSON object per line: {"main": "...", "cleanup": "..."}
+                ("cleanup" is the cleaned-up text, used for responses w/ code)
+  --db FILE     a CodeHelp database: main and cleanup responses are taken
+                from non-streamed queries' response_json / response_text
+otherwise, a set of synthetic responses is generated.
+
+Reports latency (in simulated seconds) for queries with and without code,
+and the completion tokens generated.
+
+Usage: python dev/cleanup_bench.py [--jsonl FILE | --db FILE] [--ttft SECONDS] [--tps TOKENS_PER_SEC] [--speedup FACTOR]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections.abc import AsyncIterator
+from pathlib import Path
+from typing import Any
+
+import openai
+from codehelp import create_app
+from codehelp.helper import has_code_indication, run_query_prompts
+from codehelp.prompts import make_sufficient_prompt
+from gened.db import init_db
+from gened.openai import run_async
+
+CHUNK_CHARS = 16  # characters per streamed chunk (~4 tokens)
+
+QUERY = ("Python", "code", "error", "issue")
+SUFFICIENT_PROMPT = make_sufficient_prompt(*QUERY)
+
+generated_chars = 0
+
+
+def load_jsonl(path: str) -> list[dict[str, str]]:
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def load_db(path: str) -> list[dict[str, str]]:
+    db = sqlite3.connect(path)
+    records = []
+    for response_json, response_text in db.execute("SELECT response_json, response_text FROM queries WHERE response_json IS NOT NULL"):
+        try:
+            responses = json.loads(response_json)
+            texts = json.loads(response_text)
+            main = responses[0]['choices'][0]['message']['content']
+        except (json.JSONDecodeError, TypeError, KeyError, IndexError):
+            continue  # streamed, cached, or errored
+        record = {'main': main}
+        if has_code_indication(main):
+            record['cleanup'] = texts['main']
+        records.append(record)
+    return records
+
+
+def make_synthetic(n: int, code_rate: float) -> list[dict[str, str]]:
+    rng = random.Random(0)
+    words = "the your function variable loop value should check return error list index call because".split()
+
+    def text(num_words: int) -> str:
+        return " ".join(rng.choice(words) for _ in range(num_words)) + ".\n\n"
+
+    records = []
+    for _ in range(n):
+        if rng.random() < code_rate:
+            main = text(rng.randint(10, 80)) + "```\nfor x in items:\n    total += x\n```\n\n" + text(rng.randint(50, 200))
+            records.append({'main': main, 'cleanup': text(rng.randint(60, 200))})
+        else:
+            records.append({'main': text(rng.randint(60, 250))})
+    return records
+
+
+def make_mock_acreate(record: dict[str, str], ttft: float, tps: float):  # type: ignore[no-untyped-def]
+    def text_for(prompt: str) -> str:
+        if prompt.startswith("The following was written to help"):
+            return record.get('cleanup', record['main'])
+        if prompt == SUFFICIENT_PROMPT:
+            return "OK."
+        return record['main']
+
+    async def mock_acreate(*args: Any, **kwargs: Any) -> Any:
+        global generated_chars  # noqa: PLW0603 (global statement)
+        text = text_for(kwargs['messages'][-1]['content'])
+        await asyncio.sleep(ttft)
+        if not kwargs.get('stream'):
+            await asyncio.sleep(len(text) / 4 / tps)
+            generated_chars += len(text)
+            return openai.openai_object.OpenAIObject.construct_from({
+                'choices': [{'message': {'content': text}, 'finish_reason': "stop"}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': len(text) // 4, 'total_tokens': len(text) // 4},
+            })
+
+        async def chunks() -> AsyncIterator[Any]:
+            global generated_chars  # noqa: PLW0603 (global statement)
+            for i in range(0, len(text), CHUNK_CHARS):
+                await asyncio.sleep(CHUNK_CHARS / 4 / tps)
+                generated_chars += len(text[i:i+CHUNK_CHARS])
+                yield openai.openai_object.OpenAIObject.construct_from({'choices': [{'delta': {'content': text[i:i+CHUNK_CHARS]}, 'finish_reason': None}]})
+            yield openai.openai_object.OpenAIObject.construct_from({'choices': [{'delta': {}, 'finish_reason': "stop"}]})
+        return chunks()
+
+    return mock_acreate
+
+
+def run(app: Any, records: list[dict[str, str]], speculative: bool, ttft: float, tps: float, speedup: float) -> None:
+    global generated_chars  # noqa: PLW0603 (global statement)
+    generated_chars = 0
+    app.config['SPECULATIVE_CLEANUP'] = speculative
+    llm_dict = {'key': "bench", 'model': "bench"}
+    latencies: dict[bool, list[float]] = {True: [], False: []}
+
+    for record in records:
+        openai.ChatCompletion.acreate = make_mock_acreate(record, ttft / speedup, tps * speedup)
+        with app.app_context():
+            start = time.perf_counter()
+            run_async(run_query_prompts(llm_dict, *QUERY, set()))
+            latencies[has_code_indication(record['main'])].append((time.perf_counter() - start) * speedup)
+
+    name = "speculative" if speculative else "serial"
+    for has_code, values in latencies.items():
+        if values:
+            values.sort()
+            print(f"{name:>11}  {'with code' if has_code else 'no code':>9} ({len(values):4d}):  "
+                  f"mean {statistics.mean(values):6.2f} s   p50 {statistics.median(values):6.2f} s   p95 {values[int(len(values) * 0.95)]:6.2f} s")
+    print(f"{name:>11}  completion tokens generated: {generated_chars // 4}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--jsonl', help="recorded responses (JSON lines)")
+    source.add_argument('--db', help="CodeHelp database to take recorded responses from")
+    parser.add_argument('--synthetic', type=int, default=50, help="number of synthetic responses, if no recorded responses are given (default: 50)")
+    parser.add_argument('--code-rate', type=float, default=0.25, help="fraction of synthetic responses with code (default: 0.25)")
+    parser.add_argument('--ttft', type=float, default=0.5, help="simulated time to first token, in seconds (default: 0.5)")
+    parser.add_argument('--tps', type=float, default=50, help="simulated tokens per second (default: 50)")
+    parser.add_argument('--speedup', type=float, default=10, help="run this many times faster than simulated time (default: 10)")
+    args = parser.parse_args()
+
+    if args.jsonl:
+        records = load_jsonl(args.jsonl)
+    elif args.db:
+        records = load_db(args.db)
+    else:
+        records = make_synthetic(args.synthetic, args.code_rate)
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(test_config={'TESTING': True, 'DATABASE': str(Path(tmpdir) / "bench.db")}, instance_path=Path(tmpdir))
+        with app.app_context():
+            init_db()
+
+        print(f"{len(records)} responses, {args.ttft:.2f} s to first token, {args.tps:.0f} tokens/s")
+        for speculative in [False, True]:
+            run(app, records, speculative, args.ttft, args.tps, args.speedup)
+
+
+if __name__ == '__main__':
+    main()
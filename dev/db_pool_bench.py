@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Measure the per-request database overhead of gened.db.get_db() with and
+without connection pooling (DB_POOL), against a temporary database.
+
+Each simulated request pushes an app context, runs a small query (as most
+views do), and tears the context down, from several concurrent threads.
+
+Usage: python dev/db_pool_bench.py [-t THREADS] [-n REQUESTS_PER_THREAD]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from codehelp import create_app
+from flask import Flask
+from gened.db import get_db, get_db_pool_stats, init_db
+
+
+def run(app: Flask, pool: bool, threads: int, requests: int) -> None:
+    app.config['DB_POOL'] = pool
+    latencies: list[float] = []
+    barrier = threading.Barrier(threads)
+
+    def worker() -> None:
+        barrier.wait()
+        for _ in range(requests):
+            start = time.perf_counter()
+            with app.app_context():
+                get_db().execute("SELECT * FROM users WHERE id=?", [1]).fetchone()
+            latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    us = [x * 1e6 for x in latencies]
+    print(f"{'pooled' if pool else 'unpooled':>9}:  p50 {statistics.median(us):7.1f} us   p99 {us[int(len(us) * 0.99)]:7.1f} us   "
+          f"throughput {len(us) / elapsed:8.0f} req/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-t', type=int, default=8, help="number of threads (default: 8)")
+    parser.add_argument('-n', type=int, default=2000, help="requests per thread (default: 2000)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(test_config={'DATABASE': str(Path(tmpdir) / "bench.db")}, instance_path=Path(tmpdir))
+        with app.app_context():
+            init_db()
+
+        for pool in [False, True]:
+            run(app, pool, args.t, args.n)
+        print(f"pool stats: {get_db_pool_stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Measure write throughput and read latency under a concurrent mix of writes
+(like record_query(): an INSERT into queries) and reads (like the history
+query), with writes committed inline by each request thread or made by the
+single writer thread (DB_WRITER), against a temporary database.
+
+Writes that fail with "database is locked" (after SQLite's busy_timeout)
+are counted.  With --rate, each writing thread paces its writes (as in a
+classroom, where writes arrive at some rate rather than back-to-back), so the
+two modes are compared at the same write load.  Reading threads are paced
+at --read-rate.
+
+Usage: python dev/db_writer_bench.py [-w WRITER_THREADS] [-r READER_THREADS] [-n WRITES_PER_THREAD]
+                                     [--rate WRITES_PER_SEC] [--read-rate READS_PER_SEC] [--synchronous MODE]
+"""
+
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from codehelp import create_app
+from flask import Flask
+from gened.db import get_db, get_db_ro, get_db_writer_stats, init_db, run_write
+
+
+def write_query(db: sqlite3.Connection) -> None:
+    db.execute("INSERT INTO queries (language, code, error, issue, user_id) VALUES ('Python', 'x = 1', '', 'issue', 1)")
+
+
+def run(app: Flask, writer: bool, writers: int, readers: int, writes: int, rate: float, read_rate: float) -> None:
+    app.config['DB_WRITER'] = writer
+    write_latencies: list[float] = []
+    read_latencies: list[float] = []
+    locked = 0
+    done = threading.Event()
+    barrier = threading.Barrier(writers + readers)
+
+    def write_worker() -> None:
+        nonlocal locked
+        barrier.wait()
+        next_write = time.perf_counter()
+        for _ in range(writes):
+            if rate:
+                next_write += 1 / rate
+                time.sleep(max(0, next_write - time.perf_counter()))
+            start = time.perf_counter()
+            with app.app_context():
+                try:
+                    run_write(write_query)
+                except sqlite3.OperationalError:
+                    locked += 1
+            write_latencies.append(time.perf_counter() - start)
+
+    def read_worker() -> None:
+        barrier.wait()
+        next_read = time.perf_counter()
+        while not done.is_set():
+            next_read += 1 / read_rate
+            time.sleep(max(0, next_read - time.perf_counter()))
+            start = time.perf_counter()
+            with app.app_context():
+                get_db_ro().execute("SELECT * FROM queries WHERE user_id=? ORDER BY query_time DESC LIMIT 10", [1]).fetchall()
+            read_latencies.append(time.perf_counter() - start)
+
+    write_threads = [threading.Thread(target=write_worker) for _ in range(writers)]
+    read_threads = [threading.Thread(target=read_worker) for _ in range(readers)]
+    stats = get_db_writer_stats()
+    start = time.perf_counter()
+    for t in write_threads + read_threads:
+        t.start()
+    for t in write_threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    for t in read_threads:
+        t.join()
+
+    writes_us = sorted(x * 1e6 for x in write_latencies)
+    reads_us = sorted(x * 1e6 for x in read_latencies)
+    name = "writer" if writer else "inline"
+    print(f"{name:>6}:  writes {len(writes_us) / elapsed:7.0f}/s  p50 {statistics.median(writes_us):8.1f} us  p99 {writes_us[int(len(writes_us) * 0.99)]:9.1f} us  locked {locked}")
+    if reads_us:
+        print(f"{'':>6}   reads  {len(reads_us) / elapsed:7.0f}/s  p50 {statistics.median(reads_us):8.1f} us  p99 {reads_us[int(len(reads_us) * 0.99)]:9.1f} us")
+    if writer:
+        new_stats = get_db_writer_stats()
+        commits = new_stats['commits'] - stats['commits']
+        print(f"{'':>6}   {commits} commits, {(new_stats['writes'] - stats['writes']) / commits:.1f} writes per commit")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-w', type=int, default=16, help="number of writing threads (default: 16)")
+    parser.add_argument('-r', type=int, default=4, help="number of reading threads (default: 4)")
+    parser.add_argument('-n', type=int, default=500, help="writes per thread (default: 500)")
+    parser.add_argument('--rate', type=float, default=0, help="writes per second per writing thread (default: 0, as fast as possible)")
+    parser.add_argument('--read-rate', type=float, default=200, help="reads per second per reading thread (default: 200)")
+    parser.add_argument('--synchronous', default='NORMAL', help="PRAGMA synchronous (default: NORMAL; FULL fsyncs every commit)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(test_config={'DATABASE': str(Path(tmpdir) / "bench.db")}, instance_path=Path(tmpdir))
+        app.config['SQLITE_PRAGMAS'] = app.config['SQLITE_PRAGMAS'] | {'synchronous': args.synchronous}
+        with app.app_context():
+            init_db()
+            get_db().execute("INSERT INTO users (id, auth_provider, auth_name) VALUES (1, 1, 'bench')")
+            get_db().commit()
+
+        for writer in [False, True]:
+            run(app, writer, args.w, args.r, args.n, args.rate, args.read_rate)
+
+
+if __name__ == '__main__':
+    main()
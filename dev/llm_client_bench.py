@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Benchmark get_completion() latency against a local stub of the OpenAI chat
+completions API, comparing:
+  - asyncio.run() per request (new event loop + new HTTP connection each time)
+  - gened.openai.run_async() (persistent loop + pooled keep-alive sessions)
+
+Usage: python dev/llm_client_bench.py [-n REQUESTS] [-c CONCURRENCY] [--delay SECONDS]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import openai
+from codehelp import create_app
+from flask import Flask
+from gened.db import init_db
+from gened.openai import get_completion, run_async
+
+
+def make_stub_handler(delay: float) -> type[BaseHTTPRequestHandler]:
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"   # allow keep-alive connections
+        disable_nagle_algorithm = True  # avoid delayed-ACK stalls on reused connections
+
+        def do_POST(self) -> None:
+            length = int(self.headers.get('Content-Length', 0))
+            self.rfile.read(length)
+            time.sleep(delay)
+            body = json.dumps({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "stub",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "stub response"}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 1, "completion_tokens": 2, "total_tokens": 3},
+            }).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args: object) -> None:
+            pass
+
+    return StubHandler
+
+
+def one_request_asyncio_run(app: Flask) -> float:
+    with app.app_context():  # get_completion() reads the app config and records each call
+        start = time.perf_counter()
+        asyncio.run(get_completion("stub-key", prompt="hello", model="stub"))
+        return time.perf_counter() - start
+
+
+def one_request_run_async(app: Flask) -> float:
+    with app.app_context():
+        start = time.perf_counter()
+        run_async(get_completion("stub-key", prompt="hello", model="stub"))
+        return time.perf_counter() - start
+
+
+def percentile(data: list[float], pct: float) -> float:
+    ordered = sorted(data)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def bench(name: str, func, app: Flask, n: int, concurrency: int) -> None:  # type: ignore[no-untyped-def]
+    func(app)  # warm up
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        start = time.perf_counter()
+        latencies = list(pool.map(lambda _: func(app), range(n)))
+        total = time.perf_counter() - start
+    ms = [x * 1000 for x in latencies]
+    print(f"{name:>14}:  p50 {statistics.median(ms):7.2f} ms   p99 {percentile(ms, 99):7.2f} ms   throughput {n/total:8.1f} req/s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=500, help="number of requests per mode (default: 500)")
+    parser.add_argument('-c', type=int, default=8, help="number of concurrent request threads (default: 8)")
+    parser.add_argument('--delay', type=float, default=0.0, help="simulated server processing time in seconds (default: 0)")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_stub_handler(args.delay))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    openai.api_base = f"http://127.0.0.1:{server.server_port}/v1"
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(test_config={'TESTING': True, 'DATABASE': str(Path(tmpdir) / "bench.db")}, instance_path=Path(tmpdir))
+        with app.app_context():
+            init_db()
+
+        print(f"{args.n} requests, {args.c} concurrent threads, {args.delay*1000:.0f} ms server delay")
+        bench("asyncio.run()", one_request_asyncio_run, app, args.n, args.c)
+        bench("run_async()", one_request_run_async, app, args.n, args.c)
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Time the usage-count queries of the admin, instructor, and profile pages,
+reading the user_query_counts / role_query_counts rollups, against the same
+counts computed over the queries table (as those pages used to), on a
+temporary database with a synthetic history of queries.
+
+Usage: python dev/rollup_bench.py [-n NUM_QUERIES] [-u NUM_USERS] [-c NUM_CLASSES] [-d DAYS]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+from codehelp import create_app
+from gened.admin import ADMIN_CLASSES_SQL, ADMIN_CONSUMERS_SQL, ADMIN_ROLES_SQL, ADMIN_USERS_SQL
+from gened.db import get_db, init_db
+from gened.instructor import USERS_SQL
+from gened.profile import USER_SQL
+
+# The same counts, over the queries table
+OLD_ADMIN_CLASSES_SQL = """
+    SELECT
+        classes.id,
+        COUNT(DISTINCT roles.id) AS num_users,
+        COUNT(queries.id) AS num_queries,
+        SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries
+    FROM classes
+    LEFT JOIN roles ON roles.class_id=classes.id
+    LEFT JOIN queries ON queries.role_id=roles.id
+    GROUP BY classes.id
+    ORDER BY num_recent_queries DESC, classes.id DESC
+"""
+OLD_ADMIN_USERS_SQL = """
+    SELECT
+        users.id,
+        COUNT(queries.id) AS num_queries,
+        SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries
+    FROM users
+    LEFT JOIN queries ON queries.user_id=users.id
+    GROUP BY users.id
+    ORDER BY num_recent_queries DESC, users.id DESC
+"""
+OLD_INSTRUCTOR_USERS_SQL = """
+    SELECT
+        users.id,
+        COUNT(queries.id) AS num_queries,
+        SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries
+    FROM users
+    JOIN roles ON roles.user_id=users.id
+    LEFT JOIN queries ON queries.role_id=roles.id
+    WHERE roles.class_id=?
+    GROUP BY users.id
+"""
+
+
+def populate(db: sqlite3.Connection, num_queries: int, num_users: int, num_classes: int, days: int) -> None:
+    rng = random.Random(0)
+    db.executemany("INSERT INTO users (id, auth_provider, auth_name) VALUES (?, 1, ?)", [(i, f"user{i}") for i in range(1, num_users + 1)])
+    db.executemany("INSERT INTO classes (id, name) VALUES (?, ?)", [(i, f"class{i}") for i in range(1, num_classes + 1)])
+    db.executemany("INSERT INTO roles (id, user_id, class_id, role) VALUES (?, ?, ?, 'student')", [(i, i, i % num_classes + 1) for i in range(1, num_users + 1)])
+    batch = 10_000
+    for start in range(0, num_queries, batch):
+        rows = []
+        for _ in range(min(batch, num_queries - start)):
+            user = rng.randint(1, num_users)
+            rows.append((user, user, f"-{rng.uniform(0, days):.4f} days"))
+        db.executemany("INSERT INTO queries (language, code, issue, user_id, role_id, query_time) VALUES ('Python', 'x', 'y', ?, ?, datetime('now', ?))", rows)
+    db.commit()
+    db.execute("ANALYZE")
+
+
+def timeit(func: Callable[[], object], repeat: int = 5) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=300_000, help="number of queries (default: 300,000)")
+    parser.add_argument('-u', type=int, default=5000, help="number of users (default: 5000)")
+    parser.add_argument('-c', type=int, default=100, help="number of classes (default: 100)")
+    parser.add_argument('-d', type=int, default=365, help="days of history (default: 365)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(test_config={'DATABASE': str(Path(tmpdir) / "bench.db")}, instance_path=Path(tmpdir))
+        with app.app_context():
+            init_db()
+            db = get_db()
+            start = time.perf_counter()
+            populate(db, args.n, args.u, args.c, args.d)
+            print(f"{args.n} queries inserted (with rollups maintained by triggers) in {time.perf_counter() - start:.1f} s")
+
+            cases = [
+                ("admin classes", lambda: db.execute(OLD_ADMIN_CLASSES_SQL).fetchall(), lambda: db.execute(ADMIN_CLASSES_SQL.format(where_clause="")).fetchall()),
+                ("admin users", lambda: db.execute(OLD_ADMIN_USERS_SQL).fetchall(), lambda: db.execute(ADMIN_USERS_SQL.format(where_clause="")).fetchall()),
+                ("instructor users", lambda: db.execute(OLD_INSTRUCTOR_USERS_SQL, [1]).fetchall(), lambda: db.execute(USERS_SQL.format(role_id_column=""), [1]).fetchall()),
+                ("profile", None, lambda: db.execute(USER_SQL, [1]).fetchone()),
+                ("admin consumers", None, lambda: db.execute(ADMIN_CONSUMERS_SQL.format(where_clause="")).fetchall()),
+                ("admin roles", None, lambda: db.execute(ADMIN_ROLES_SQL.format(where_clause="")).fetchall()),
+            ]
+            for name, old, new in cases:
+                old_time = f"{timeit(old) * 1000:9.1f} ms" if old else f"{'':>12}"
+                print(f"{name:>17}:  over queries {old_time}   rollups {timeit(new) * 1000:9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
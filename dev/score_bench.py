@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Benchmark scoring a streamed response (codehelp.helper.score_response()) for
+avoid sets of several sizes, comparing:
+
+  rescore:      the previous approach -- score the whole text so far, with a
+                str.count() per keyword, each time a piece arrives
+  incremental:  codehelp.helper.response_scorer(), which searches each piece once
+  regex:        a single compiled alternation of all keywords, rescoring the
+                whole text so far each time a piece arrives
+
+plus the cost of scoring one complete response each way.
+
+Usage: python dev/score_bench.py [-l RESPONSE_LENGTH] [-p PIECE_LENGTH] [-r REPEATS]
+"""
+
+import argparse
+import random
+import re
+import statistics
+import string
+import time
+from collections.abc import Callable
+
+from codehelp.helper import CODE_INDICATIONS, response_scorer, score_response
+from codehelp.keywords import KeywordMatcher
+
+
+def score_response_rescore(response_txt: str, avoid_set: set[str]) -> int:
+    ''' score_response() as it was: one str.count() per keyword and code indication. '''
+    score = 0
+    for bad_kw in avoid_set:
+        score -= response_txt.count(bad_kw)
+    for code_indication in CODE_INDICATIONS:
+        score -= 100 * response_txt.count(code_indication)
+    return score
+
+
+def make_regex_scorer(avoid_set: set[str]) -> Callable[[str], int]:
+    avoid_re = re.compile('|'.join(re.escape(kw) for kw in sorted(avoid_set, key=len, reverse=True)))
+    code_re = re.compile('|'.join(re.escape(kw) for kw in CODE_INDICATIONS))
+    return lambda text: -len(avoid_re.findall(text)) - 100 * len(code_re.findall(text))
+
+
+def make_text(rng: random.Random, length: int, keywords: list[str]) -> str:
+    words = []
+    while sum(len(w) + 1 for w in words) < length:
+        words.append(rng.choice(keywords) if rng.random() < 0.01 else ''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 9))))
+    return ' '.join(words)[:length]
+
+
+def time_median(func: Callable[[], object], repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-l', type=int, default=4000, help="response length in characters (default: 4000)")
+    parser.add_argument('-p', type=int, default=4, help="streamed piece length in characters (default: 4)")
+    parser.add_argument('-r', type=int, default=20, help="number of repetitions to time (default: 20)")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{args.l}-character response in {args.p}-character pieces; median ms per response")
+    print(f"{'keywords':>8}  {'rescore':>9}  {'incremental':>11}  {'regex':>9}    {'one text: count':>15}  {'matcher':>7}  {'regex':>7}")
+    for num_keywords in (0, 10, 50, 100):
+        keywords = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 8))) + '()' for _ in range(num_keywords)]
+        avoid_set = set(keywords)
+        avoid = KeywordMatcher(avoid_set)
+        regex_score = make_regex_scorer(avoid_set) if avoid_set else (lambda text: 0)
+        text = make_text(rng, args.l, keywords or ['x'])
+        pieces = [text[i:i+args.p] for i in range(0, len(text), args.p)]
+
+        def rescore() -> int:
+            so_far = ""
+            for piece in pieces:
+                so_far += piece
+                score = score_response_rescore(so_far, avoid_set)  # noqa: B023 (loop variable)
+            return score
+
+        def incremental() -> int:
+            feed = response_scorer(avoid)  # noqa: B023 (loop variable)
+            for piece in pieces:  # noqa: B023 (loop variable)
+                score = feed(piece)
+            return score
+
+        def regex() -> int:
+            so_far = ""
+            for piece in pieces:  # noqa: B023 (loop variable)
+                so_far += piece
+                score = regex_score(so_far)  # noqa: B023 (loop variable)
+            return score
+
+        assert rescore() == incremental() == score_response(text, avoid)
+
+        print(f"{num_keywords:8}  {time_median(rescore, args.r):9.2f}  {time_median(incremental, args.r):11.2f}  {time_median(regex, args.r):9.2f}    "
+              f"{time_median(lambda: score_response_rescore(text, avoid_set), args.r * 10):15.3f}  "  # noqa: B023 (loop variable)
+              f"{time_median(lambda: score_response(text, avoid), args.r * 10):7.3f}  "  # noqa: B023 (loop variable)
+              f"{time_median(lambda: regex_score(text), args.r * 10):7.3f}")  # noqa: B023 (loop variable)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Benchmark codehelp.similar.find_similar() lookups against a temporary database
+populated with N synthetic indexed queries (random signatures; 30% marked
+helpful and so in the LSH buckets), plus one real near-duplicate to be found.
+
+Of the N queries, D are near-duplicates of the looked-up query (signatures
+differing in a few positions, so they share most of its buckets), as when many
+students in a class submit the same starter code.  Each lookup reads those
+dense buckets; the lookup is compared with an uncapped query that reads every
+entry in them.
+
+Usage: python dev/similar_bench.py [-n NUM_QUERIES] [-d NUM_DUPLICATES] [-r REPEATS]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+from codehelp import create_app
+from codehelp.similar import MAX_CANDIDATES, find_similar, index_query, query_signature, set_query_helpful
+from gened import minhash
+from gened.db import get_db, init_db
+
+CODE = "def total(values):\n    result = 0\n    for v in values:\n        result += v\n    return result\n"
+CODE_RENAMED = "def total(nums):\n    s = 0\n    for n in nums:\n        s += n\n    return s\n"
+ISSUE = "My function returns the wrong total."
+
+
+def near_duplicate(rng: random.Random, sig: tuple[int, ...]) -> tuple[int, ...]:
+    changed = set(rng.sample(range(minhash.NUM_PERM), 3))
+    return tuple(rng.getrandbits(61) if i in changed else x for i, x in enumerate(sig))
+
+
+def populate(num_queries: int, num_duplicates: int, class_id: int) -> None:
+    db = get_db()
+    db.execute("INSERT INTO users (id, auth_provider, auth_name) VALUES (1, 1, 'bench')")
+    db.execute("INSERT INTO classes (id, name) VALUES (?, 'bench')", [class_id])
+    rng = random.Random(0)
+    target_sig = query_signature(CODE, "", ISSUE)
+    assert target_sig is not None
+    dup_fraction = num_duplicates / num_queries if num_queries else 0
+    batch = 10000
+    for start in range(1, num_queries + 1, batch):
+        ids = range(start, min(start + batch, num_queries + 1))
+        helpful = {i: rng.random() < 0.3 for i in ids}
+        db.executemany(
+            "INSERT INTO queries (id, language, code, issue, response_text, helpful, user_id) VALUES (?, 'Python', '', '', '{\"main\": \"x\"}', ?, 1)",
+            helpful.items()
+        )
+        sigs: dict[int, tuple[int, ...]] = {
+            i: near_duplicate(rng, target_sig) if rng.random() < dup_fraction else tuple(rng.getrandbits(61) for _ in range(minhash.NUM_PERM))
+            for i in ids
+        }
+        db.executemany("INSERT INTO query_minhash (query_id, signature) VALUES (?, ?)", [(i, minhash.pack_signature(sig)) for i, sig in sigs.items()])
+        db.executemany(
+            "INSERT INTO query_lsh (class_id, bucket, query_id) VALUES (?, ?, ?)",
+            [(class_id, bucket, i) for i, sig in sigs.items() if helpful[i] for bucket in minhash.band_buckets(sig)]
+        )
+    # one real near-duplicate
+    db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (1, 1, ?, 'student')", [class_id])
+    cur = db.execute("INSERT INTO queries (language, code, issue, response_text, helpful, user_id, role_id) VALUES ('Python', ?, ?, '{\"main\": \"found\"}', 1, 1, 1)", [CODE, ISSUE])
+    assert cur.lastrowid is not None
+    index_query(db, cur.lastrowid, class_id, CODE, "", ISSUE)
+    set_query_helpful(db, cur.lastrowid, True)
+    db.commit()
+    db.execute("ANALYZE")
+
+
+def find_similar_uncapped(class_id: int, code: str, error: str, issue: str) -> int:
+    ''' The candidate query without a per-bucket cap, which reads and sorts
+    every entry in the matching buckets.  Returns the number of candidates. '''
+    sig = query_signature(code, error, issue)
+    assert sig is not None
+    buckets = minhash.band_buckets(sig)
+    return len(get_db().execute(f"""
+        SELECT DISTINCT queries.id, queries.response_text, query_minhash.signature
+        FROM query_lsh
+        JOIN queries ON queries.id=query_lsh.query_id
+        JOIN query_minhash ON query_minhash.query_id=query_lsh.query_id
+        WHERE query_lsh.class_id=?
+          AND query_lsh.bucket IN ({','.join('?' * len(buckets))})
+          AND queries.helpful=1
+        ORDER BY queries.id DESC
+        LIMIT ?
+    """, [class_id, *buckets, MAX_CANDIDATES]).fetchall())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', type=int, default=1_000_000, help="number of synthetic queries (default: 1,000,000)")
+    parser.add_argument('-d', type=int, default=10_000, help="number of near-duplicates among them (default: 10,000)")
+    parser.add_argument('-r', type=int, default=1000, help="number of lookups to time (default: 1000)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(test_config={'TESTING': True, 'DATABASE': str(Path(tmpdir) / "bench.db")}, instance_path=Path(tmpdir))
+        with app.app_context():
+            init_db()
+            start = time.perf_counter()
+            populate(args.n, args.d, class_id=1)
+            print(f"Populated {args.n} queries ({args.d} near-duplicates) in {time.perf_counter() - start:.1f} s")
+
+            sig_time = []
+            lookup_time = []
+            uncapped_time = []
+            for _ in range(args.r):
+                start = time.perf_counter()
+                query_signature(CODE_RENAMED, "", ISSUE)
+                sig_time.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                result = find_similar(1, CODE_RENAMED, "", ISSUE)
+                lookup_time.append(time.perf_counter() - start)
+                assert result == "found"
+                start = time.perf_counter()
+                find_similar_uncapped(1, CODE_RENAMED, "", ISSUE)
+                uncapped_time.append(time.perf_counter() - start)
+
+            sig_ms = statistics.median(sig_time) * 1000
+            total_ms = statistics.median(lookup_time) * 1000
+            print(f"signature: median {sig_ms:.3f} ms")
+            print(f"find_similar() incl. signature: median {total_ms:.3f} ms  (index lookup ~{total_ms - sig_ms:.3f} ms)")
+            print(f"uncapped candidates incl. signature: median {statistics.median(uncapped_time) * 1000:.3f} ms")
+
+
+if __name__ == '__main__':
+    main()
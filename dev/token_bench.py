@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Stress-test free-token spending from many concurrent threads against a
+temporary database, comparing:
+  - legacy: SELECT the balance, then UPDATE and commit (the old _get_llm() code)
+  - ledger: gened.tokens.spend_token() (a single conditional UPDATE)
+  - batched: gened.tokens.spend_token() with TOKEN_BATCH_INTERVAL set
+
+Reports tokens spent vs. available (any excess is over-spending), the final
+balance, spend latency, and the total time threads spent in database writes
+(holding or waiting for the write lock).
+
+Usage: python dev/token_bench.py [-t THREADS] [-n SPENDS_PER_THREAD] [--tokens TOKENS]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from codehelp import create_app
+from flask import Flask
+from gened.db import get_db, init_db
+from gened.tokens import _batcher, flush_token_batches, spend_token
+
+USER_ID = 1000
+
+write_time = 0.0
+write_time_mutex = threading.Lock()
+
+
+def add_write_time(start: float) -> None:
+    global write_time  # noqa: PLW0603 (global statement)
+    with write_time_mutex:
+        write_time += time.perf_counter() - start
+
+
+def legacy_spend(user_id: int) -> bool:
+    db = get_db()
+    tokens = db.execute("SELECT query_tokens FROM users WHERE id=?", [user_id]).fetchone()['query_tokens']
+    if tokens == 0:
+        return False
+    start = time.perf_counter()
+    db.execute("UPDATE users SET query_tokens=query_tokens-1 WHERE id=?", [user_id])
+    db.commit()
+    add_write_time(start)
+    return True
+
+
+def ledger_spend(user_id: int) -> bool:
+    start = time.perf_counter()
+    spent = spend_token(user_id)
+    add_write_time(start)
+    return spent
+
+
+def run(app: Flask, mode: str, threads: int, spends: int, tokens: int) -> None:
+    global write_time  # noqa: PLW0603 (global statement)
+    write_time = 0.0
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET query_tokens=? WHERE id=?", [tokens, USER_ID])
+        db.commit()
+    app.config['TOKEN_BATCH_INTERVAL'] = 0.1 if mode == "batched" else None
+    spend = legacy_spend if mode == "legacy" else spend_token if mode == "batched" else ledger_spend
+
+    results: list[bool] = []
+    latencies: list[float] = []
+    barrier = threading.Barrier(threads)
+
+    def worker() -> None:
+        barrier.wait()
+        for _ in range(spends):
+            with app.app_context():
+                start = time.perf_counter()
+                results.append(spend(USER_ID))
+                latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.perf_counter()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if mode == "batched":
+        # writes only happen when flushing; time a final flush
+        flush_start = time.perf_counter()
+        flush_token_batches()
+        add_write_time(flush_start)
+
+    with app.app_context():
+        final = get_db().execute("SELECT query_tokens FROM users WHERE id=?", [USER_ID]).fetchone()['query_tokens']
+
+    latencies.sort()
+    print(f"{mode:8s} spent {results.count(True):5d} of {tokens} available  (final balance {final:4d})  "
+          f"p50 {statistics.median(latencies)*1000:6.3f} ms  p99 {latencies[int(len(latencies)*0.99)]*1000:7.3f} ms  "
+          f"in writes {write_time*1000:8.1f} ms total, incl. lock waits  ({elapsed:.2f} s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-t', type=int, default=16, help="number of threads (default: 16)")
+    parser.add_argument('-n', type=int, default=100, help="spends per thread (default: 100)")
+    parser.add_argument('--tokens', type=int, default=1000, help="tokens available (default: 1000)")
+    args = parser.parse_args()
+
+    os.environ.setdefault("SECRET_KEY", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        app = create_app(test_config={'TESTING': True, 'DATABASE': str(Path(tmpdir) / "bench.db")}, instance_path=Path(tmpdir))
+        with app.app_context():
+            init_db()
+            db = get_db()
+            db.execute("INSERT INTO users (id, auth_provider, auth_name) VALUES (?, 2, 'bench')", [USER_ID])
+            db.commit()
+
+        for mode in ["legacy", "ledger", "batched"]:
+            run(app, mode, args.t, args.n, args.tokens)
+
+        assert not _batcher._pending
+
+
+if __name__ == '__main__':
+    main()
@@ -10,7 +10,7 @@ from flask.app import Flask
 from flask.wrappers import Response
 from gened import base
 
-from . import class_config, helper, tutor
+from . import class_config, helper, similar, tutor
 
 
 def create_app(test_config: dict[str, Any] | None = None, instance_path: Path | None = None) -> Flask:
@@ -25,7 +25,11 @@ def create_app(test_config: dict[str, Any] | None = None, instance_path: Path |
         SUPPORT_EMAIL='support@codehelp.app',
         HELP_LINK_TEXT='Get Help',
         DATABASE_NAME='codehelp.db',  # will be combined with app.instance_path in gened.create_app_base()
+        STREAM_RESPONSES=True,  # stream responses to the help form as they are generated
+        RESPONSE_CANDIDATES=1,  # generate this many main responses at once (non-streamed queries only), using the first w/o code (see helper.run_query_prompts())
+        SPECULATIVE_CLEANUP=False,  # cut off a main response at its first sign of code and clean up the text so far (see helper.run_query_prompts_stream())
         DOCS_DIR=module_dir / 'docs',
+        QUERY_SEARCH_COLUMNS=['code', 'error', 'issue', 'response_text'],
         DEFAULT_LANGUAGES=[
             "C",
             "C++",
@@ -48,6 +52,9 @@ def create_app(test_config: dict[str, Any] | None = None, instance_path: Path |
     app.register_blueprint(helper.bp)
     app.register_blueprint(tutor.bp)
 
+    # register app-specific CLI commands
+    app.cli.add_command(similar.index_queries_command)
+
     # register our custom class configuration with Gen-Ed
     class_config.register_with_gened()
 
@@ -3,6 +3,7 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 from dataclasses import dataclass, field
+from functools import cached_property
 
 from flask import current_app
 from gened.class_config import get_class_config as gened_get_config
@@ -10,6 +11,8 @@ from gened.class_config import register_class_config, register_extra_handler
 from typing_extensions import Self
 from werkzeug.datastructures import ImmutableMultiDict
 
+from .keywords import KeywordMatcher
+
 
 def _default_langs() -> list[str]:
     return current_app.config['DEFAULT_LANGUAGES']
@@ -20,6 +23,7 @@ class ClassConfig:
     languages: list[str] = field(default_factory=_default_langs)
     default_lang: str | None = None
     avoid: str = ''
+    use_cache: bool = True  # reuse cached responses for identical queries
 
     @classmethod
     def from_request_form(cls, form: ImmutableMultiDict[str, str]) -> Self:
@@ -27,8 +31,21 @@ class ClassConfig:
             languages=form.getlist('languages[]'),
             default_lang=form.get('default_lang', None),
             avoid=form['avoid'],
+            use_cache='use_cache' in form,
         )
 
+    # Derived from the configuration once per parsed object, which
+    # gened.class_config shares across requests.
+
+    @cached_property
+    def avoid_set(self) -> frozenset[str]:
+        ''' The "avoid set" of keywords: the non-blank lines of avoid. '''
+        return frozenset(x.strip() for x in self.avoid.split('\n') if x.strip() != '')
+
+    @cached_property
+    def avoid_matcher(self) -> KeywordMatcher:
+        return KeywordMatcher(self.avoid_set)
+
 
 def get_class_config() -> ClassConfig:
     return gened_get_config(ClassConfig)
@@ -4,20 +4,49 @@
 
 import asyncio
 import json
-from collections.abc import Iterable
-
-from flask import Blueprint, abort, redirect, render_template, request, url_for
+import sqlite3
+import time
+from collections.abc import AsyncIterator, Callable, Coroutine, Iterator
+from contextlib import aclosing
+from typing import Any
+
+from flask import (
+    Blueprint,
+    abort,
+    current_app,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from gened.auth import class_enabled_required, get_auth, login_required, tester_required
-from gened.db import get_db
-from gened.openai import TEST_API_KEY, LLMDict, get_completion, with_llm
+from gened.completion_cache import cache_get, cache_put, make_cache_key, normalize_text
+from gened.db import get_db, register_sql, run_write
+from gened.jobs import enqueue_job, get_job_progress, is_job_pending, jobs_enabled, set_job_progress
+from gened.openai import (
+    TEST_API_KEY,
+    LLMDict,
+    get_completion,
+    get_completion_candidates,
+    get_completion_stream,
+    iter_async,
+    run_async,
+    with_llm,
+)
 from gened.queries import get_history, get_query
+from gened.tokens import refund_spent_token
 from werkzeug.wrappers.response import Response
 
 from . import prompts
 from .class_config import get_class_config
+from .keywords import KeywordMatcher
+from .similar import find_similar, index_query, set_query_helpful
 
 bp = Blueprint('helper', __name__, url_prefix="/help", template_folder='templates')
 
+LAST_LANGUAGE_SQL = register_sql('last_language', "SELECT language FROM queries WHERE queries.user_id=? ORDER BY query_time DESC LIMIT 1")
+
 
 @bp.route("/")
 @bp.route("/<int:query_id>")
@@ -32,7 +61,7 @@ def help_form(query_id: int | None = None) -> str:
     selected_lang = class_config.default_lang
 
     # Select most recently submitted language, if available
-    lang_row = db.execute("SELECT language FROM queries WHERE queries.user_id=? ORDER BY query_time DESC LIMIT 1", [auth['user_id']]).fetchone()
+    lang_row = db.execute(LAST_LANGUAGE_SQL, [auth['user_id']]).fetchone()
     if lang_row and lang_row['language'] in languages:
         selected_lang = lang_row['language']
 
@@ -45,7 +74,10 @@ def help_form(query_id: int | None = None) -> str:
 
     history = get_history()
 
-    return render_template("help_form.html", query=query_row, history=history, languages=languages, selected_lang=selected_lang)
+    # with background jobs, the response page shows the response as it is generated instead
+    stream = current_app.config['STREAM_RESPONSES'] and not jobs_enabled()
+
+    return render_template("help_form.html", query=query_row, history=history, languages=languages, selected_lang=selected_lang, stream=stream)
 
 
 @bp.route("/view/<int:query_id>")
@@ -58,54 +90,122 @@ def help_view(query_id: int) -> str:
     else:
         topics = []
 
-    return render_template("help_view.html", query=query_row, responses=responses, history=history, topics=topics)
+    pending = is_job_pending(query_job_name(query_id))
+
+    return render_template("help_view.html", query=query_row, responses=responses, history=history, topics=topics, pending=pending)
+
+
+@bp.route("/status/<int:query_id>")
+@login_required
+def help_status(query_id: int) -> dict[str, Any]:
+    ''' Report whether a query's response is still being generated, and the response text so far. '''
+    query_row, _ = get_query(query_id)
+    if not query_row:
+        return abort(404)
+
+    partial = get_job_progress(query_job_name(query_id))
+    return {'pending': partial is not None, 'partial': partial or ""}
+
 
+# Text that indicates a response likely contains too much code
+CODE_INDICATIONS = ['```', 'should look like', 'should look something like']
 
-def score_response(response_txt: str, avoid_set: Iterable[str]) -> int:
+
+def has_code_indication(response_txt: str) -> bool:
+    return any(code_indication in response_txt for code_indication in CODE_INDICATIONS)
+
+
+CODE_INDICATIONS_MATCHER = KeywordMatcher(CODE_INDICATIONS)
+
+
+def score_response(response_txt: str, avoid: KeywordMatcher) -> int:
     ''' Return an integer score for a given response text.
     Returns:
         0 = best.
         Negative values for responses including indications of code blocks or keywords in the avoid set.
         Indications of code blocks are weighted most heavily.
     '''
-    score = 0
-    for bad_kw in avoid_set:
-        score -= response_txt.count(bad_kw)
-    for code_indication in ['```', 'should look like', 'should look something like']:
-        score -= 100 * response_txt.count(code_indication)
+    return -avoid.count(response_txt) - 100 * CODE_INDICATIONS_MATCHER.count(response_txt)
+
+
+def response_scorer(avoid: KeywordMatcher) -> Callable[[str], int]:
+    ''' An incremental score_response(): returns a function to call with each
+    new piece of a streamed response, which returns the score of the response so far.
+    Each piece is searched once, rather than rescoring the whole response as it grows.
+    '''
+    avoid_counter = avoid.counter()
+    code_counter = CODE_INDICATIONS_MATCHER.counter()
+
+    def feed(piece: str) -> int:
+        return -avoid_counter.feed(piece) - 100 * code_counter.feed(piece)
+
+    return feed
 
-    return score
 
+def get_avoid() -> KeywordMatcher:
+    ''' Get the matcher for the "avoid set" of keywords in the current class configuration. '''
+    return get_class_config().avoid_matcher
 
-async def run_query_prompts(llm_dict: LLMDict, language: str, code: str, error: str, issue: str) -> tuple[list[dict[str, str]], dict[str, str]]:
+
+async def run_query_prompts(llm_dict: LLMDict, language: str, code: str, error: str, issue: str, avoid: KeywordMatcher, query_id: int | None = None) -> tuple[list[dict[str, str]], dict[str, str]]:
     ''' Run the given query against the coding help system of prompts.
 
     Returns a tuple containing:
       1) A list of response objects from the OpenAI completion (to be stored in the database)
       2) A dictionary of response text, potentially including keys 'insufficient' and 'main'.
+
+    With RESPONSE_CANDIDATES > 1, that many candidate main responses are
+    generated at once, and the first to finish without code (or avoid-set
+    keywords) is used, so a cleanup is only needed if every candidate has code.
+
+    Otherwise, with SPECULATIVE_CLEANUP, the main response is streamed (via
+    run_query_prompts_stream()) so that a cleanup can start as soon as it
+    shows signs of containing code.
     '''
+    num_candidates = current_app.config['RESPONSE_CANDIDATES']
+    if num_candidates == 1 and current_app.config['SPECULATIVE_CLEANUP']:
+        result: tuple[list[dict[str, str]], dict[str, str]] = ([], {})
+        async for event, value in run_query_prompts_stream(llm_dict, language, code, error, issue, avoid, query_id):
+            if event == 'result':
+                result = value
+        return result
+
     api_key = llm_dict['key']
     model = llm_dict['model']
 
-    # create "avoid set" from class configuration
-    class_config = get_class_config()
-    avoid_set = {x.strip() for x in class_config.avoid.split('\n') if x.strip() != ''}
-
-    # Launch the "sufficient detail" check concurrently with the main prompt to save time
-    task_main = asyncio.create_task(
-        get_completion(
+    main_prompt = prompts.make_main_prompt(language, code, error, issue, avoid.keywords)
+    main_completion: Coroutine[Any, Any, tuple[Any, str]]
+    if num_candidates > 1:
+        main_completion = get_completion_candidates(
             api_key,
-            prompt=prompts.make_main_prompt(language, code, error, issue, avoid_set),
+            prompt=main_prompt,
+            model=model,
+            n=num_candidates,
+            new_scorer=lambda: response_scorer(avoid),
+            abandon_at=-100,  # every candidate has code (see score_response()): clean up the best of them
+            kind='main',
+            query_id=query_id,
+        )
+    else:
+        main_completion = get_completion(
+            api_key,
+            prompt=main_prompt,
             model=model,
             n=1,
-            score_func=lambda x: score_response(x, avoid_set)
+            score_func=lambda x: score_response(x, avoid),
+            kind='main',
+            query_id=query_id,
         )
-    )
+
+    # Launch the "sufficient detail" check concurrently with the main prompt to save time
+    task_main = asyncio.create_task(main_completion)
     task_sufficient = asyncio.create_task(
         get_completion(
             api_key,
             prompt=prompts.make_sufficient_prompt(language, code, error, issue),
-            model=model
+            model=model,
+            kind='sufficient',
+            query_id=query_id,
         )
     )
 
@@ -116,10 +216,10 @@ async def run_query_prompts(llm_dict: LLMDict, language: str, code: str, error:
     response, response_txt = await task_main
     responses.append(response)
 
-    if "```" in response_txt or "should look like" in response_txt or "should look something like" in response_txt:
+    if has_code_indication(response_txt):
         # That's probably too much code.  Let's clean it up...
         cleanup_prompt = prompts.make_cleanup_prompt(response_text=response_txt)
-        cleanup_response, cleanup_response_txt = await get_completion(api_key, prompt=cleanup_prompt, model=model)
+        cleanup_response, cleanup_response_txt = await get_completion(api_key, prompt=cleanup_prompt, model=model, kind='cleanup', query_id=query_id)
         responses.append(cleanup_response)
         response_txt = cleanup_response_txt
 
@@ -128,49 +228,268 @@ async def run_query_prompts(llm_dict: LLMDict, language: str, code: str, error:
     response_sufficient, response_sufficient_txt = await task_sufficient
     responses.append(response_sufficient)
 
-    if response_sufficient_txt.endswith("OK") or "OK." in response_sufficient_txt or "```" in response_sufficient_txt or "is sufficient for me" in response_sufficient_txt or response_sufficient_txt.startswith("Error ("):
+    return responses, make_response_texts(response_txt, response_sufficient_txt)
+
+
+def make_response_texts(main_txt: str, sufficient_txt: str) -> dict[str, str]:
+    ''' Combine the main and "sufficient detail" responses into a dictionary of response texts. '''
+    if sufficient_txt.endswith("OK") or "OK." in sufficient_txt or "```" in sufficient_txt or "is sufficient for me" in sufficient_txt or sufficient_txt.startswith("Error ("):
         # We're using just the main response.
-        return responses, {'main': response_txt}
+        return {'main': main_txt}
     else:
         # Give them the request for more information plus the main response, in case it's helpful.
-        return responses, {'insufficient': response_sufficient_txt, 'main': response_txt}
+        return {'insufficient': sufficient_txt, 'main': main_txt}
 
 
-def run_query(llm_dict: LLMDict, language: str, code: str, error: str, issue: str) -> int:
+async def run_query_prompts_stream(llm_dict: LLMDict, language: str, code: str, error: str, issue: str, avoid: KeywordMatcher, query_id: int | None = None) -> AsyncIterator[tuple[str, Any]]:
+    ''' Streaming version of run_query_prompts().
+
+    Yields (event, value) tuples:
+      ('delta', str) - a new piece of the main response text.
+      ('reset', '') - the text so far should be discarded (the main response is
+                      being replaced by a cleaned-up version, streamed next).
+      ('result', (responses, texts)) - final; same values returned by run_query_prompts().
+
+    The main response is not sent on once it shows signs of containing code,
+    so that text is never shown to the user before it has been cleaned up.
+    With SPECULATIVE_CLEANUP, the main response is cancelled at that point,
+    and the text so far is cleaned up right away rather than waiting for
+    the rest of a response that will be rewritten anyway.
+    '''
+    api_key = llm_dict['key']
+    model = llm_dict['model']
+
+    task_sufficient = asyncio.create_task(
+        get_completion(
+            api_key,
+            prompt=prompts.make_sufficient_prompt(language, code, error, issue),
+            model=model,
+            kind='sufficient',
+            query_id=query_id,
+        )
+    )
+
+    responses: list[dict[str, str]] = [{'model': model, 'stream': 'main'}]
+
+    speculative = current_app.config['SPECULATIVE_CLEANUP']
+    response_txt = ""
+    forwarding = True
+    code_counter = CODE_INDICATIONS_MATCHER.counter()
+    main_stream = get_completion_stream(api_key, prompt=prompts.make_main_prompt(language, code, error, issue, avoid.keywords), model=model, kind='main', query_id=query_id)
+    async with aclosing(main_stream):
+        async for delta in main_stream:
+            response_txt += delta
+            if code_counter.feed(delta) and forwarding:
+                # Stop showing this response; it will be cleaned up once complete (or right away, if speculative).
+                forwarding = False
+                if speculative:
+                    break
+            if forwarding:
+                yield 'delta', delta
+    response_txt = response_txt.strip()
+
+    if has_code_indication(response_txt):
+        yield 'reset', ''
+        cleanup_prompt = prompts.make_cleanup_prompt(response_text=response_txt)
+        response_txt = ""
+        async for delta in get_completion_stream(api_key, prompt=cleanup_prompt, model=model, kind='cleanup', query_id=query_id):
+            response_txt += delta
+            yield 'delta', delta
+        response_txt = response_txt.strip()
+        responses.append({'model': model, 'stream': 'cleanup'})
+
+    response_sufficient, response_sufficient_txt = await task_sufficient
+    responses.append(response_sufficient)
+
+    yield 'result', (responses, make_response_texts(response_txt, response_sufficient_txt))
+
+
+def get_cache_key(llm_dict: LLMDict, language: str, code: str, error: str, issue: str, avoid: KeywordMatcher) -> str | None:
+    ''' Get the completion cache key for a query, or None if responses should not be cached. '''
+    if llm_dict['key'] == TEST_API_KEY or not get_class_config().use_cache:
+        return None
+
+    # Key on the main prompt w/ normalized inputs, a fixed nonce, and a consistently-ordered avoid set.
+    code, error, issue = (normalize_text(x) for x in (code, error, issue))
+    prompt = prompts.make_main_prompt(language, code, error, issue, sorted(avoid.keywords), nonce=0)
+    return make_cache_key(llm_dict['model'], prompt)
+
+
+def is_cacheable(responses: list[dict[str, str]], texts: dict[str, str]) -> bool:
+    ''' Only cache complete responses, not errors (returned as strings by
+    get_completion() and as "Error (...)" text by either completion function). '''
+    return all(isinstance(response, dict) for response in responses) \
+        and not any("Error (" in text or "[error: " in text for text in texts.values())
+
+
+def get_similar_response(query_id: int, code: str, error: str, issue: str) -> str | None:
+    ''' Find a response marked helpful for a near-duplicate of this query in the current class, if enabled. '''
+    if not get_class_config().use_cache:
+        return None
+    auth = get_auth()
+    return find_similar(auth['class_id'], code, error, issue, exclude_id=query_id)
+
+
+def prepare_query(llm_dict: LLMDict, language: str, code: str, error: str, issue: str, with_similar: bool = True) -> tuple[int, KeywordMatcher, str | None, dict[str, str] | None, str | None]:
+    ''' Record a new query and look up any existing responses for it.
+
+    Returns (query_id, avoid, cache_key, cached_texts, similar_txt), where
+    cached_texts are the responses to an identical query from the completion
+    cache (already recorded as this query's responses), if any, and
+    similar_txt is a helpful response to a near-duplicate query, if any, if
+    with_similar, and if there was no cached response.
+    '''
     query_id = record_query(language, code, error, issue)
 
-    responses, texts = asyncio.run(run_query_prompts(llm_dict, language, code, error, issue))
+    # read class config here, as run_query_prompts() cannot access the database
+    avoid = get_avoid()
 
-    record_response(query_id, responses, texts)
+    cache_key = get_cache_key(llm_dict, language, code, error, issue, avoid)
+    cached = cache_get(cache_key) if cache_key else None
+    if cached:
+        _, cached_texts = cached
+        record_response(query_id, [{'cached': cache_key}], cached_texts)
+        return query_id, avoid, cache_key, cached_texts, None
+
+    similar_txt = get_similar_response(query_id, code, error, issue) if with_similar else None
+    return query_id, avoid, cache_key, None, similar_txt
+
+
+def run_query(llm_dict: LLMDict, language: str, code: str, error: str, issue: str) -> int:
+    # No similar response: it could only be shown once the new response is
+    # complete.  (The streaming and background job paths show one right away.)
+    query_id, avoid, cache_key, cached_texts, _ = prepare_query(llm_dict, language, code, error, issue, with_similar=False)
+
+    if not cached_texts:
+        responses, texts = run_async(run_query_prompts(llm_dict, language, code, error, issue, avoid, query_id))
+        save_query_result(query_id, llm_dict, cache_key, None, responses, texts)
+
+    return query_id
+
+
+def query_job_name(query_id: int) -> str:
+    return f"query:{query_id}"
+
+
+def start_query_job(llm_dict: LLMDict, language: str, code: str, error: str, issue: str) -> int:
+    ''' Record a query and start a background job to run it, returning
+    immediately.  The job's progress (the main response text so far) is
+    available via get_job_progress(query_job_name(query_id)).
+    '''
+    query_id, avoid, cache_key, cached_texts, similar_txt = prepare_query(llm_dict, language, code, error, issue)
+    if cached_texts:
+        return query_id
+
+    if similar_txt:
+        # shown on the response page while the new response is generated
+        record_response(query_id, [], {'similar': similar_txt})
+
+    job_name = query_job_name(query_id)
+
+    async def run() -> tuple[list[dict[str, str]], dict[str, str]]:
+        partial_txt = ""
+        result: tuple[list[dict[str, str]], dict[str, str]] = ([], {})
+        async for event, value in run_query_prompts_stream(llm_dict, language, code, error, issue, avoid, query_id):
+            if event == 'delta':
+                partial_txt += value
+                set_job_progress(job_name, partial_txt)
+            elif event == 'reset':
+                partial_txt = ""
+                set_job_progress(job_name, partial_txt)
+            elif event == 'result':
+                result = value
+        return result
+
+    def finish(result: tuple[list[dict[str, str]], dict[str, str]]) -> None:
+        responses, texts = result
+        save_query_result(query_id, llm_dict, cache_key, similar_txt, responses, texts)
+
+    enqueue_job(job_name, llm_dict['key'], run(), finish)
 
     return query_id
 
 
+def save_query_result(query_id: int, llm_dict: LLMDict, cache_key: str | None, similar_txt: str | None, responses: list[dict[str, str]], texts: dict[str, str]) -> None:
+    ''' Cache (if possible) and record the responses to a query. '''
+    if cache_key and is_cacheable(responses, texts):
+        cache_put(cache_key, llm_dict['model'], responses, texts)
+    if similar_txt:
+        texts = texts | {'similar': similar_txt}
+    record_response(query_id, responses, texts)
+
+
+# How often to save a partial response to the database while streaming (seconds)
+STREAM_SAVE_INTERVAL = 1.0
+
+
+def _sse(event: str, data: Any) -> str:
+    ''' Format a server-sent event (w/ JSON-encoded data, so it is always a single line). '''
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def run_query_stream(llm_dict: LLMDict, language: str, code: str, error: str, issue: str) -> Iterator[str]:
+    ''' Record and run a query, generating server-sent events as the response arrives.
+
+    The query's row is updated with the partial main response as it arrives
+    (at most every STREAM_SAVE_INTERVAL seconds) and with the complete responses at the end.
+    '''
+    query_id, avoid, cache_key, cached_texts, similar_txt = prepare_query(llm_dict, language, code, error, issue)
+
+    yield _sse('query', query_id)
+
+    if cached_texts:
+        yield _sse('delta', cached_texts['main'])
+        yield _sse('done', url_for(".help_view", query_id=query_id))
+        return
+
+    # Offer a helpful response to a near-duplicate query right away, while the new one is generated.
+    if similar_txt:
+        yield _sse('similar', similar_txt)
+
+    partial_txt = ""
+    last_save = time.monotonic()
+    responses: list[dict[str, str]] = []
+    texts: dict[str, str] = {}
+    for event, value in iter_async(run_query_prompts_stream(llm_dict, language, code, error, issue, avoid, query_id)):
+        if event == 'delta':
+            partial_txt += value
+            yield _sse('delta', value)
+            if time.monotonic() - last_save > STREAM_SAVE_INTERVAL:
+                record_response(query_id, responses, {'main': partial_txt})
+                last_save = time.monotonic()
+        elif event == 'reset':
+            partial_txt = ""
+            yield _sse('reset', '')
+        elif event == 'result':
+            responses, texts = value
+
+    save_query_result(query_id, llm_dict, cache_key, similar_txt, responses, texts)
+
+    yield _sse('done', url_for(".help_view", query_id=query_id))
+
+
 def record_query(language: str, code: str, error: str, issue: str) -> int:
-    db = get_db()
     auth = get_auth()
     role_id = auth['role_id']
 
-    cur = db.execute(
-        "INSERT INTO queries (language, code, error, issue, user_id, role_id) VALUES (?, ?, ?, ?, ?, ?)",
-        [language, code, error, issue, auth['user_id'], role_id]
-    )
-    new_row_id = cur.lastrowid
-    db.commit()
-
-    assert new_row_id is not None
+    def write(db: sqlite3.Connection) -> int:
+        cur = db.execute(
+            "INSERT INTO queries (language, code, error, issue, user_id, role_id) VALUES (?, ?, ?, ?, ?, ?)",
+            [language, code, error, issue, auth['user_id'], role_id]
+        )
+        new_row_id = cur.lastrowid
+        assert new_row_id is not None
+        index_query(db, new_row_id, auth['class_id'], code, error, issue)
+        return new_row_id
 
-    return new_row_id
+    return run_write(write)
 
 
 def record_response(query_id: int, responses: list[dict[str, str]], texts: dict[str, str]) -> None:
-    db = get_db()
-
-    db.execute(
+    run_write(lambda db: db.execute(
         "UPDATE queries SET response_json=?, response_text=? WHERE id=?",
         [json.dumps(responses), json.dumps(texts), query_id]
-    )
-    db.commit()
+    ))
 
 
 @bp.route("/request", methods=["POST"])
@@ -178,6 +497,36 @@ def record_response(query_id: int, responses: list[dict[str, str]], texts: dict[
 @class_enabled_required
 @with_llm()
 def help_request(llm_dict: LLMDict) -> Response:
+    language, code, error, issue = get_request_inputs()
+
+    if jobs_enabled():
+        query_id = start_query_job(llm_dict, language, code, error, issue)
+    else:
+        query_id = run_query(llm_dict, language, code, error, issue)
+
+    return redirect(url_for(".help_view", query_id=query_id))
+
+
+@bp.route("/request/stream", methods=["POST"])
+@login_required
+@class_enabled_required
+@with_llm()
+def help_request_stream(llm_dict: LLMDict) -> Response:
+    ''' Run a request, streaming the response to the client as server-sent events.
+
+    Events: 'query' (the new query's id), 'delta' (a new piece of the main
+    response), 'reset' (discard the text so far), and 'done' (the URL of the
+    completed query's page).
+    '''
+    language, code, error, issue = get_request_inputs()
+
+    events = stream_with_context(run_query_stream(llm_dict, language, code, error, issue))
+
+    return Response(events, mimetype="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def get_request_inputs() -> tuple[str, str, str, str]:
+    ''' Get the language, code, error, and issue for a new request from the submitted form. '''
     class_config = get_class_config()
     if class_config.languages:
         lang_id = int(request.form["lang_id"])
@@ -190,9 +539,7 @@ def help_request(llm_dict: LLMDict) -> Response:
 
     # TODO: limit length of code/error/issue
 
-    query_id = run_query(llm_dict, language, code, error, issue)
-
-    return redirect(url_for(".help_view", query_id=query_id))
+    return language, code, error, issue
 
 
 @bp.route("/load_test", methods=["POST"])
@@ -219,13 +566,17 @@ def load_test(llm_dict: LLMDict) -> Response:
 @bp.route("/post_helpful", methods=["POST"])
 @login_required
 def post_helpful() -> str:
-    db = get_db()
     auth = get_auth()
 
     query_id = int(request.form['id'])
     value = int(request.form['value'])
-    db.execute("UPDATE queries SET helpful=? WHERE id=? AND user_id=?", [value, query_id, auth['user_id']])
-    db.commit()
+
+    def write(db: sqlite3.Connection) -> None:
+        updated = db.execute("UPDATE queries SET helpful=? WHERE id=? AND user_id=? RETURNING id", [value, query_id, auth['user_id']]).fetchone()
+        if updated:
+            set_query_helpful(db, query_id, value == 1)
+
+    run_write(write)
     return ""
 
 
@@ -233,8 +584,35 @@ def post_helpful() -> str:
 @login_required
 @tester_required
 @with_llm()
-def get_topics_html(llm_dict: LLMDict, query_id: int) -> str:
-    topics = get_topics(llm_dict, query_id)
+def get_topics_html(llm_dict: LLMDict, query_id: int) -> str | tuple[str, int]:
+    if jobs_enabled():
+        # Returns 202 (Accepted) with no content until the topics are ready.
+        # Callers poll with ?poll=1, so a job that finished w/o topics is not rerun.
+        topics = get_saved_topics(query_id)
+        job_name = f"topics:{query_id}"
+        # Only a new job makes an LLM call, so a token spent by @with_llm()
+        # is refunded on every other path.
+        if not topics and is_job_pending(job_name):
+            refund_spent_token()
+            return "", 202
+        if not topics and not request.args.get('poll'):
+            messages = get_topics_messages(query_id)
+            if messages:
+                def finish(result: tuple[dict[str, str], str]) -> None:
+                    save_topics(query_id, result[1])
+
+                enqueue_job(job_name, llm_dict['key'], get_completion(
+                    api_key=llm_dict['key'],
+                    messages=messages,
+                    model=llm_dict['model'],
+                    kind='topics',
+                    query_id=query_id,
+                ), finish)
+                return "", 202
+        refund_spent_token()
+    else:
+        topics = get_topics(llm_dict, query_id)
+
     if not topics:
         return render_template("topics_fragment.html", error=True)
     else:
@@ -250,13 +628,13 @@ def get_topics_raw(llm_dict: LLMDict, query_id: int) -> list[str]:
     return topics
 
 
-def get_topics(llm_dict: LLMDict, query_id: int) -> list[str]:
+def get_topics_messages(query_id: int) -> list[dict[str, str]] | None:
     query_row, responses = get_query(query_id)
 
     if not query_row or not responses:
-        return []
+        return None
 
-    messages = prompts.make_topics_prompt(
+    return prompts.make_topics_prompt(
         query_row['language'],
         query_row['code'],
         query_row['error'],
@@ -264,12 +642,18 @@ def get_topics(llm_dict: LLMDict, query_id: int) -> list[str]:
         responses['main']
     )
 
-    response, response_txt = asyncio.run(get_completion(
-        api_key=llm_dict['key'],
-        messages=messages,
-        model=llm_dict['model'],
-    ))
 
+def get_saved_topics(query_id: int) -> list[str]:
+    query_row, _ = get_query(query_id)
+    if not query_row or not query_row['topics_json']:
+        return []
+    topics: list[str] = json.loads(query_row['topics_json'])
+    return topics
+
+
+def save_topics(query_id: int, response_txt: str) -> list[str]:
+    ''' Parse a topics completion and save the topics into the queries table for the given query.
+    Returns the topics, or an empty list if the completion is not a valid list of topics. '''
     # Verify it is actually JSON
     # May be "Error (..." if an API error occurs, or every now and then may get "Here is the JSON: ..." or similar.
     try:
@@ -277,8 +661,22 @@ def get_topics(llm_dict: LLMDict, query_id: int) -> list[str]:
     except json.decoder.JSONDecodeError:
         return []
 
-    # Save topics into queries table for the given query
-    db = get_db()
-    db.execute("UPDATE queries SET topics_json=? WHERE id=?", [response_txt, query_id])
-    db.commit()
+    run_write(lambda db: db.execute("UPDATE queries SET topics_json=? WHERE id=?", [response_txt, query_id]))
     return topics
+
+
+def get_topics(llm_dict: LLMDict, query_id: int) -> list[str]:
+    messages = get_topics_messages(query_id)
+
+    if not messages:
+        return []
+
+    response, response_txt = run_async(get_completion(
+        api_key=llm_dict['key'],
+        messages=messages,
+        model=llm_dict['model'],
+        kind='topics',
+        query_id=query_id,
+    ))
+
+    return save_topics(query_id, response_txt)
@@ -0,0 +1,72 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+from collections.abc import Iterable
+
+
+class KeywordMatcher:
+    ''' Counts occurrences of a fixed set of keywords in response texts.
+
+    Prepared once per set of keywords (e.g., a class's avoid set; see
+    ClassConfig.avoid_matcher) rather than on every query.  Each keyword's
+    non-overlapping occurrences are counted with str.count()/str.find(),
+    which measured several times faster than a single compiled regular
+    expression alternating over the keywords (see dev/score_bench.py).
+
+    For a text that arrives in pieces (a streamed response), counter() gives
+    a KeywordCounter that counts each piece as it arrives, rather than
+    recounting the whole text every time it grows.
+    '''
+    def __init__(self, keywords: Iterable[str]) -> None:
+        self.keywords = frozenset(kw for kw in keywords if kw)
+        self._ordered = tuple(sorted(self.keywords))
+        self._max_len = max((len(kw) for kw in self._ordered), default=0)
+
+    def count(self, text: str) -> int:
+        ''' Total number of occurrences of all keywords in text. '''
+        return sum(text.count(kw) for kw in self._ordered)
+
+    def counter(self) -> 'KeywordCounter':
+        return KeywordCounter(self._ordered, self._max_len)
+
+
+class KeywordCounter:
+    ''' Incrementally counts keywords (as KeywordMatcher.count() would) in a
+    text fed to it one piece at a time.
+
+    Only the last (longest keyword length - 1) characters already seen are
+    kept, to find occurrences that span pieces, so each piece is searched
+    once: O(keywords x text length) in total, regardless of the number of
+    pieces.  And a new occurrence must end in the new piece, so only keywords
+    whose last character is in the piece are searched for at all.
+    '''
+    def __init__(self, keywords: tuple[str, ...], max_len: int) -> None:
+        self._keywords = keywords
+        self._by_last_char: dict[str, list[int]] = {}
+        for i, kw in enumerate(keywords):
+            self._by_last_char.setdefault(kw[-1], []).append(i)
+        self._keep = max(max_len - 1, 0)
+        self._buf = ""       # the end of the text seen so far
+        self._buf_start = 0  # position of _buf in the text
+        self._next = [0] * len(keywords)  # per keyword: the end of its last occurrence, where the next may start
+        self.total = 0
+
+    def feed(self, piece: str) -> int:
+        ''' Add the next piece of the text, returning the total count so far. '''
+        if not self._keywords:
+            return 0
+        buf = self._buf + piece
+        base = self._buf_start
+        for char in set(piece):
+            for i in self._by_last_char.get(char, ()):
+                kw = self._keywords[i]
+                pos = max(self._next[i] - base, 0)
+                while (pos := buf.find(kw, pos)) != -1:
+                    self.total += 1
+                    pos += len(kw)
+                    self._next[i] = base + pos
+        cut = max(len(buf) - self._keep, 0)
+        self._buf = buf[cut:]
+        self._buf_start = base + cut
+        return self.total
@@ -0,0 +1,27 @@
+-- SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+--
+-- SPDX-License-Identifier: AGPL-3.0-only
+
+-- Run `flask --app codehelp index-queries` afterwards to index existing queries.
+
+BEGIN;
+
+CREATE TABLE query_minhash (
+    query_id INTEGER PRIMARY KEY,
+    signature BLOB NOT NULL,  -- MinHash signature of the query's code, error, and issue
+    FOREIGN KEY(query_id) REFERENCES queries(id)
+);
+
+-- LSH band buckets for finding near-duplicate queries in a class (helpful queries only)
+CREATE TABLE query_lsh (
+    class_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    query_id INTEGER NOT NULL,
+    FOREIGN KEY(class_id) REFERENCES classes(id),
+    FOREIGN KEY(query_id) REFERENCES queries(id)
+);
+-- (query_id: each bucket's most recent entries, without a sort)
+CREATE INDEX query_lsh_by_bucket ON query_lsh(class_id, bucket, query_id);
+CREATE INDEX query_lsh_by_query ON query_lsh(query_id);
+
+COMMIT;
@@ -13,7 +13,7 @@ jinja_env = Environment(
 )
 
 
-def make_main_prompt(language: str, code: str, error: str, issue: str, avoid_set: Iterable[str] | None = None) -> str:
+def make_main_prompt(language: str, code: str, error: str, issue: str, avoid_set: Iterable[str] | None = None, nonce: int | None = None) -> str:
     # generate the extra / avoidance instructions
     if avoid_set is not None:
         extra_text = f"Do not use in your response: {', '.join(avoid_set)}."
@@ -23,7 +23,8 @@ def make_main_prompt(language: str, code: str, error: str, issue: str, avoid_set
     if error.strip() == '':
         error = "[no error message]"
 
-    nonce = random.randint(1000, 9999)
+    if nonce is None:
+        nonce = random.randint(1000, 9999)
     return f"""You are a system for assisting a student with programming.
 The students provide:
  1) the programming language (in "<lang>" delimiters)
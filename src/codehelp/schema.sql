@@ -4,6 +4,10 @@
 
 PRAGMA foreign_keys = ON;
 
+-- drop tables referencing queries first
+DROP TABLE IF EXISTS query_minhash;
+DROP TABLE IF EXISTS query_lsh;
+
 DROP TABLE IF EXISTS queries;
 CREATE TABLE queries (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -22,6 +26,30 @@ CREATE TABLE queries (
     FOREIGN KEY(user_id) REFERENCES users(id),
     FOREIGN KEY(role_id) REFERENCES roles(id)
 );
+DROP INDEX IF EXISTS queries_by_user_time;
+CREATE INDEX queries_by_user_time ON queries(user_id, query_time);
+DROP INDEX IF EXISTS queries_by_role_time;
+CREATE INDEX queries_by_role_time ON queries(role_id, query_time);
+
+-- Keep the query count rollups (see schema_common.sql) up to date
+DROP TRIGGER IF EXISTS queries_count_insert;
+CREATE TRIGGER queries_count_insert AFTER INSERT ON queries BEGIN
+    INSERT INTO user_query_counts (user_id, day, count) VALUES (NEW.user_id, date(NEW.query_time), 1)
+        ON CONFLICT (user_id, day) DO UPDATE SET count=count+1;
+    INSERT INTO role_query_counts (role_id, day, count) SELECT NEW.role_id, date(NEW.query_time), 1 WHERE NEW.role_id IS NOT NULL
+        ON CONFLICT (role_id, day) DO UPDATE SET count=count+1;
+    INSERT INTO user_query_totals (user_id, count) VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET count=count+1;
+    INSERT INTO role_query_totals (role_id, count) SELECT NEW.role_id, 1 WHERE NEW.role_id IS NOT NULL
+        ON CONFLICT (role_id) DO UPDATE SET count=count+1;
+END;
+DROP TRIGGER IF EXISTS queries_count_delete;
+CREATE TRIGGER queries_count_delete AFTER DELETE ON queries BEGIN
+    UPDATE user_query_counts SET count=count-1 WHERE user_id=OLD.user_id AND day=date(OLD.query_time);
+    UPDATE role_query_counts SET count=count-1 WHERE role_id=OLD.role_id AND day=date(OLD.query_time);
+    UPDATE user_query_totals SET count=count-1 WHERE user_id=OLD.user_id;
+    UPDATE role_query_totals SET count=count-1 WHERE role_id=OLD.role_id;
+END;
 
 DROP TABLE IF EXISTS tutor_chats;
 CREATE TABLE tutor_chats (
@@ -34,3 +62,26 @@ CREATE TABLE tutor_chats (
     FOREIGN KEY(user_id) REFERENCES users(id),
     FOREIGN KEY(role_id) REFERENCES roles(id)
 );
+DROP INDEX IF EXISTS tutor_chats_by_user;
+CREATE INDEX tutor_chats_by_user ON tutor_chats(user_id);
+
+-- Near-duplicate query index
+CREATE TABLE query_minhash (
+    query_id INTEGER PRIMARY KEY,
+    signature BLOB NOT NULL,  -- MinHash signature of the query's code, error, and issue
+    FOREIGN KEY(query_id) REFERENCES queries(id)
+);
+
+-- LSH band buckets for finding near-duplicate queries in a class (helpful queries only)
+CREATE TABLE query_lsh (
+    class_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    query_id INTEGER NOT NULL,
+    FOREIGN KEY(class_id) REFERENCES classes(id),
+    FOREIGN KEY(query_id) REFERENCES queries(id)
+);
+DROP INDEX IF EXISTS query_lsh_by_bucket;
+-- (query_id: each bucket's most recent entries, without a sort)
+CREATE INDEX query_lsh_by_bucket ON query_lsh(class_id, bucket, query_id);
+DROP INDEX IF EXISTS query_lsh_by_query;
+CREATE INDEX query_lsh_by_query ON query_lsh(query_id);
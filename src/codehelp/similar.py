@@ -0,0 +1,138 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import json
+import sqlite3
+
+import click
+from flask.cli import with_appcontext
+from gened import minhash
+from gened.db import get_db, register_sql
+
+# A MinHash/LSH index over queries for finding earlier near-duplicate queries
+# in the same class (e.g., the same code with different whitespace, comments,
+# or variable names).  A query's signature is stored as it is recorded, and
+# the query is added to the LSH buckets once it is marked helpful (only
+# helpful queries' responses are offered).  Lookups need only a handful of
+# indexed reads, regardless of the number of queries.
+
+# Minimum estimated similarity for a past query to be considered a near-duplicate
+SIMILARITY_THRESHOLD = 0.8
+
+# Maximum number of LSH candidates to compare signatures against
+MAX_CANDIDATES = 50
+
+# Maximum number of (most recent) queries read from each bucket.  Buckets can
+# be dense (e.g., when many students paste the same starter code), and this
+# keeps the work per lookup bounded as a class's history grows.  Buckets hold
+# only helpful queries, so unrated and unhelpful queries never crowd them out.
+MAX_PER_BUCKET = 20
+
+# Each bucket's most recent entries come from a backwards range scan of the
+# (class_id, bucket, query_id) index, which stops after MAX_PER_BUCKET rows.
+_BUCKET_SQL = "SELECT * FROM (SELECT query_id FROM query_lsh WHERE class_id=? AND bucket=? ORDER BY query_id DESC LIMIT ?)"
+FIND_SIMILAR_SQL = register_sql('find_similar', f"""
+    SELECT DISTINCT queries.id, queries.response_text, query_minhash.signature
+    FROM ({' UNION ALL '.join([_BUCKET_SQL] * minhash.NUM_BANDS)}) AS recent
+    JOIN queries ON queries.id=recent.query_id
+    JOIN query_minhash ON query_minhash.query_id=recent.query_id
+    WHERE queries.helpful=1
+      AND queries.id != ?
+    ORDER BY queries.id DESC
+    LIMIT ?
+""", allow_scan=['recent'])  # at most NUM_BANDS * MAX_PER_BUCKET rows
+
+
+def query_signature(code: str, error: str, issue: str) -> tuple[int, ...] | None:
+    shingles = (
+        minhash.shingles(minhash.code_tokens(code), 3, prefix="c:")
+        | minhash.shingles(minhash.word_tokens(error), 2, prefix="e:")
+        | minhash.shingles(minhash.word_tokens(issue), 2, prefix="i:")
+    )
+    return minhash.signature(shingles)
+
+
+def index_query(db: sqlite3.Connection, query_id: int, class_id: int | None, code: str, error: str, issue: str) -> None:
+    ''' Store a query's signature, for indexing if it is marked helpful
+    (see set_query_helpful()), using the given connection.  Does not commit. '''
+    if class_id is None:
+        return  # only queries in a class are matched
+
+    sig = query_signature(code, error, issue)
+    if sig is None:
+        return
+
+    db.execute("INSERT OR REPLACE INTO query_minhash (query_id, signature) VALUES (?, ?)", [query_id, minhash.pack_signature(sig)])
+
+
+def set_query_helpful(db: sqlite3.Connection, query_id: int, helpful: bool) -> None:
+    ''' Add a query with a stored signature to its class's LSH buckets if it
+    is helpful, or remove it from them if not, using the given connection.
+    Does not commit. '''
+    db.execute("DELETE FROM query_lsh WHERE query_id=?", [query_id])
+    if not helpful:
+        return
+
+    row = db.execute("""
+        SELECT roles.class_id, query_minhash.signature
+        FROM query_minhash
+        JOIN queries ON queries.id=query_minhash.query_id
+        JOIN roles ON roles.id=queries.role_id
+        WHERE query_minhash.query_id=?
+    """, [query_id]).fetchone()
+    if row is None:
+        return
+
+    db.executemany(
+        "INSERT INTO query_lsh (class_id, bucket, query_id) VALUES (?, ?, ?)",
+        [(row['class_id'], bucket, query_id) for bucket in minhash.band_buckets(minhash.unpack_signature(row['signature']))]
+    )
+
+
+def find_similar(class_id: int | None, code: str, error: str, issue: str, exclude_id: int | None = None) -> str | None:
+    ''' Find the main response text of the most similar earlier query in the
+    given class that was marked helpful, if any is similar enough. '''
+    if class_id is None:
+        return None
+
+    sig = query_signature(code, error, issue)
+    if sig is None:
+        return None
+
+    db = get_db()
+    buckets = minhash.band_buckets(sig)
+    params = [param for bucket in buckets for param in (class_id, bucket, MAX_PER_BUCKET)]
+    candidates = db.execute(FIND_SIMILAR_SQL, [*params, exclude_id or -1, MAX_CANDIDATES]).fetchall()
+
+    best_score = SIMILARITY_THRESHOLD
+    best_text = None
+    for row in candidates:
+        score = minhash.similarity(sig, minhash.unpack_signature(row['signature']))
+        if score >= best_score:
+            texts = json.loads(row['response_text'] or '{}')
+            if 'main' in texts:
+                best_score = score
+                best_text = texts['main']
+
+    return best_text
+
+
+@click.command('index-queries')
+@with_appcontext
+def index_queries_command() -> None:
+    """Rebuild the near-duplicate index for all existing queries."""
+    db = get_db()
+    db.execute("DELETE FROM query_lsh")
+    db.execute("DELETE FROM query_minhash")
+    rows = db.execute("""
+        SELECT queries.id, queries.code, queries.error, queries.issue, queries.helpful, roles.class_id
+        FROM queries
+        JOIN roles ON queries.role_id=roles.id
+    """).fetchall()
+    for row in rows:
+        index_query(db, row['id'], row['class_id'], row['code'] or '', row['error'] or '', row['issue'] or '')
+        if row['helpful'] == 1:
+            set_query_helpful(db, row['id'], True)
+    db.commit()
+    click.echo(f"Indexed {len(rows)} queries.")
@@ -2,20 +2,23 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
-import asyncio
 import json
 
 from flask import Blueprint, flash, redirect, render_template, request, url_for
 
-from gened.db import get_db
+from gened.db import get_db, register_sql, run_write
 from gened.auth import get_auth, login_required, tester_required
 from gened.admin import bp as bp_admin, register_admin_link
-from gened.openai import with_llm, get_completion
+from gened.jobs import enqueue_job, is_job_pending, jobs_enabled
+from gened.openai import with_llm, get_completion, run_async
 from gened.queries import get_query
+from gened.tokens import refund_spent_token
 
 
 bp = Blueprint('tutor', __name__, url_prefix="/tutor", template_folder='templates')
 
+CHAT_HISTORY_SQL = register_sql('chat_history', "SELECT * FROM tutor_chats WHERE user_id=? ORDER BY id DESC LIMIT ?")
+
 
 @bp.before_request
 @tester_required
@@ -73,7 +76,13 @@ def chat_interface(chat_id):
 
     chat_history = get_chat_history()
 
-    return render_template("tutor_view.html", chat_id=chat_id, topic=topic, context=context, chat=chat, chat_history=chat_history)
+    pending = is_job_pending(chat_job_name(chat_id))
+
+    return render_template("tutor_view.html", chat_id=chat_id, topic=topic, context=context, chat=chat, chat_history=chat_history, pending=pending)
+
+
+def chat_job_name(chat_id):
+    return f"chat:{chat_id}"
 
 
 def create_chat(topic, context=None):
@@ -81,13 +90,10 @@ def create_chat(topic, context=None):
     user_id = auth['user_id']
     role_id = auth['role_id']
 
-    db = get_db()
-    cur = db.execute(
+    new_row_id = run_write(lambda db: db.execute(
         "INSERT INTO tutor_chats (user_id, role_id, topic, context, chat_json) VALUES (?, ?, ?, ?, ?)",
         [user_id, role_id, topic, context, json.dumps([])]
-    )
-    new_row_id = cur.lastrowid
-    db.commit()
+    ).lastrowid)
     return new_row_id
 
 
@@ -96,7 +102,7 @@ def get_chat_history(limit=10):
     db = get_db()
     auth = get_auth()
 
-    history = db.execute("SELECT * FROM tutor_chats WHERE user_id=? ORDER BY id DESC LIMIT ?", [auth['user_id'], limit]).fetchall()
+    history = db.execute(CHAT_HISTORY_SQL, [auth['user_id'], limit]).fetchall()
     return history
 
 
@@ -132,34 +138,35 @@ def get_chat(chat_id):
     return chat, topic, context
 
 
-def get_response(llm_dict, chat):
+def get_response(llm_dict, chat, chat_id=None):
     ''' Get a new 'assistant' completion for the specified chat.
 
     Parameters:
       - chat: A list of dicts, each containing a message with 'role' and 'content' keys,
               following the OpenAI chat completion API spec.
+      - chat_id: The id of the chat (in tutor_chats), for recording the API call.
 
     Returns a tuple containing:
       1) A response object from the OpenAI completion (to be stored in the database).
       2) The response text.
     '''
-    response, text = asyncio.run(get_completion(
+    response, text = run_async(get_completion(
         api_key=llm_dict['key'],
         messages=chat,
         model=llm_dict['model'],
         n=1,
+        kind='tutor',
+        chat_id=chat_id,
     ))
 
     return response, text
 
 
 def save_chat(chat_id, chat):
-    db = get_db()
-    db.execute(
+    run_write(lambda db: db.execute(
         "UPDATE tutor_chats SET chat_json=? WHERE id=?",
         [json.dumps(chat), chat_id]
-    )
-    db.commit()
+    ))
 
 
 def run_chat_round(llm_dict, chat_id, message=None):
@@ -204,14 +211,27 @@ I can use Markdown formatting in my responses."""
         {'role': 'assistant', 'content': monologue},
     ]
 
-    response_obj, response_txt = get_response(llm_dict, expanded_chat)
+    def add_response(response_txt):
+        # Update the chat w/ the response
+        chat.append({
+            'role': 'assistant',
+            'content': response_txt,
+        })
+        save_chat(chat_id, chat)
+
+    if jobs_enabled():
+        enqueue_job(chat_job_name(chat_id), llm_dict['key'], get_completion(
+            api_key=llm_dict['key'],
+            messages=expanded_chat,
+            model=llm_dict['model'],
+            n=1,
+            kind='tutor',
+            chat_id=chat_id,
+        ), lambda result: add_response(result[1]))
+        return
 
-    # Update the chat w/ the response
-    chat.append({
-        'role': 'assistant',
-        'content': response_txt,
-    })
-    save_chat(chat_id, chat)
+    response_obj, response_txt = get_response(llm_dict, expanded_chat, chat_id)
+    add_response(response_txt)
 
 
 @bp.route("/message", methods=["POST"])
@@ -222,6 +242,12 @@ def new_message(llm_dict):
 
     # TODO: limit length
 
+    if is_job_pending(chat_job_name(chat_id)):
+        # Still waiting on a response to the previous message.
+        refund_spent_token()  # no LLM call is made
+        flash("Please wait for a response before sending another message.", "warning")
+        return redirect(url_for("tutor.chat_interface", chat_id=chat_id))
+
     # Run a round of the chat with the given message.
     run_chat_round(llm_dict, chat_id, new_msg)
 
@@ -6,13 +6,14 @@ from collections.abc import Callable, Iterator
 from dataclasses import dataclass
 from datetime import date
 from pathlib import Path
-from sqlite3 import Row
+from sqlite3 import Cursor
 from tempfile import NamedTemporaryFile
 from typing import Any, ParamSpec, TypeVar
 from urllib.parse import urlencode
 
 from flask import (
     Blueprint,
+    abort,
     current_app,
     flash,
     redirect,
@@ -25,9 +26,13 @@ from flask.app import Flask
 from werkzeug.wrappers.response import Response
 
 from .auth import admin_required
+from .backup import get_snapshot_dir, list_snapshots
 from .csv import csv_response
-from .db import backup_db, get_db
+from .db import backup_db, get_db, get_db_pool_stats, get_db_ro, get_db_writer_stats, register_sql
+from .llm_config import invalidate_llm_config
 from .openai import get_models
+from .queries import QueriesPage, get_page_args, get_queries_page, page_json, search_condition
+from .rate_limit import parse_rate_limits
 
 bp = Blueprint('admin', __name__, url_prefix="/admin", template_folder='templates')
 
@@ -106,15 +111,16 @@ class Filters:
     def add(self, spec: FilterSpec, value: str, display_value: str) -> None:
         self._filters.append(Filter(spec, value, display_value))
 
-    def make_where(self, selected: list[str]) -> tuple[str, list[Any]]:
+    def make_conditions(self, selected: list[str]) -> tuple[list[str], list[Any]]:
         filters = [f for f in self._filters if f.spec.name in selected]
-        if not filters:
+        return [f"{f.spec.column}=?" for f in filters], [f.value for f in filters]
+
+    def make_where(self, selected: list[str]) -> tuple[str, list[Any]]:
+        conditions, params = self.make_conditions(selected)
+        if not conditions:
             return "", []
         else:
-            return (
-                "WHERE " + " AND ".join(f"{f.spec.column}=?" for f in filters),
-                [f.value for f in filters]
-            )
+            return "WHERE " + " AND ".join(conditions), params
 
     def filter_string(self) -> str:
         filter_dict = {f.spec.name: f.value for f in self._filters}
@@ -137,46 +143,201 @@ class Filters:
         return self.filter_string_without(selected_name) + f"&{selected_name}=${{value}}"
 
 
-def get_queries_filtered(where_clause: str, where_params: list[str], queries_limit: int | None = None) -> list[Row]:
-    db = get_db()
-    sql = f"""
-        SELECT
-            queries.*,
-            users.id AS user_id,
-            users.display_name,
-            users.email,
-            users.auth_name,
-            auth_providers.name AS auth_provider
-        FROM queries
-        JOIN users ON queries.user_id=users.id
-        LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
-        LEFT JOIN roles ON queries.role_id=roles.id
-        LEFT JOIN classes ON roles.class_id=classes.id
-        LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
-        LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
-        {where_clause}
-        ORDER BY query_time DESC
-    """
-    if queries_limit is not None:
-        sql += f"LIMIT {int(queries_limit)}"
-    queries = db.execute(sql, [*where_params]).fetchall()
-    return queries
+# Admin listings, each over every row of its outer table (optionally filtered
+# by a WHERE clause inserted as {where_clause}), grouped by the outer table's
+# id.  They are paged by that id (see get_admin_table_page()).  Query counts
+# are taken from the query count rollups (see schema_common.sql), not the
+# queries table.
+ADMIN_CONSUMERS_SQL = """
+    SELECT
+        consumers.*,
+        models.shortname AS model,
+        COALESCE(SUM(role_query_totals.count), 0) AS num_queries,
+        COUNT(DISTINCT classes.id) AS num_classes,
+        COUNT(DISTINCT roles.id) AS num_users,
+        SUM((SELECT COALESCE(SUM(count), 0) FROM role_query_counts WHERE role_id=roles.id AND day >= date('now', '-7 days'))) AS num_recent_queries
+    FROM consumers
+    LEFT JOIN models ON models.id=consumers.model_id
+    LEFT JOIN classes_lti ON classes_lti.lti_consumer_id=consumers.id
+    LEFT JOIN classes ON classes.id=classes_lti.class_id
+    LEFT JOIN roles ON roles.class_id=classes.id
+    LEFT JOIN role_query_totals ON role_query_totals.role_id=roles.id
+    {where_clause}
+    GROUP BY consumers.id
+"""
+
+ADMIN_CLASSES_SQL = """
+    SELECT
+        classes.id,
+        classes.name,
+        COALESCE(consumers.lti_consumer, class_owner.display_name) AS owner,
+        models.shortname AS model,
+        COUNT(DISTINCT roles.id) AS num_users,
+        COALESCE(SUM(role_query_totals.count), 0) AS num_queries,
+        SUM((SELECT COALESCE(SUM(count), 0) FROM role_query_counts WHERE role_id=roles.id AND day >= date('now', '-7 days'))) AS num_recent_queries
+    FROM classes
+    LEFT JOIN classes_user ON classes.id=classes_user.class_id
+    LEFT JOIN users AS class_owner ON classes_user.creator_user_id=class_owner.id
+    LEFT JOIN models ON models.id=classes_user.model_id
+    LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
+    LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
+    LEFT JOIN roles ON roles.class_id=classes.id
+    LEFT JOIN role_query_totals ON role_query_totals.role_id=roles.id
+    {where_clause}
+    GROUP BY classes.id
+"""
+
+ADMIN_USERS_SQL = """
+    SELECT
+        users.id,
+        users.display_name,
+        users.email,
+        users.auth_name,
+        auth_providers.name AS auth_provider,
+        users.query_tokens,
+        (SELECT COALESCE(SUM(count), 0) FROM user_query_totals WHERE user_id=users.id) AS num_queries,
+        (SELECT COALESCE(SUM(count), 0) FROM user_query_counts WHERE user_id=users.id AND day >= date('now', '-7 days')) AS num_recent_queries
+    FROM users
+    LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
+    LEFT JOIN roles ON roles.user_id=users.id
+    LEFT JOIN classes ON roles.class_id=classes.id
+    LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
+    LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
+    {where_clause}
+    GROUP BY users.id
+"""
+
+ADMIN_ROLES_SQL = """
+    SELECT
+        roles.*,
+        users.id,
+        users.display_name,
+        users.email,
+        users.auth_name,
+        classes.name AS class_name,
+        COALESCE(consumers.lti_consumer, class_owner.display_name) AS class_owner,
+        auth_providers.name AS auth_provider,
+        COALESCE(SUM(role_query_totals.count), 0) AS num_queries
+    FROM roles
+    LEFT JOIN users ON users.id=roles.user_id
+    LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
+    LEFT JOIN classes ON roles.class_id=classes.id
+    LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
+    LEFT JOIN classes_user ON classes.id=classes_user.class_id
+    LEFT JOIN users AS class_owner ON classes_user.creator_user_id=class_owner.id
+    LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
+    LEFT JOIN role_query_totals ON role_query_totals.role_id=roles.id
+    {where_clause}
+    GROUP BY roles.id
+"""
+
+ADMIN_QUERIES_SQL = """
+    SELECT
+        queries.*,
+        users.id AS user_id,
+        users.display_name,
+        users.email,
+        users.auth_name,
+        auth_providers.name AS auth_provider
+    FROM queries
+    JOIN users ON queries.user_id=users.id
+    LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
+    LEFT JOIN roles ON queries.role_id=roles.id
+    LEFT JOIN classes ON roles.class_id=classes.id
+    LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
+    LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
+    {where_clause}
+"""
+register_sql('admin_queries', ADMIN_QUERIES_SQL.format(where_clause="") + " ORDER BY query_time DESC", allow_scan=['queries'])
+register_sql('admin_queries_page', ADMIN_QUERIES_SQL.format(where_clause="WHERE (queries.query_time, queries.id) < (?, ?)")
+             + " ORDER BY queries.query_time DESC, queries.id DESC LIMIT ?", allow_scan=['queries'])
 
 
-@bp.route("/csv/queries/")
-def get_queries_csv() -> str | Response:
-    filters = Filters()
+@dataclass(frozen=True)
+class AdminTable:
+    sql: str  # one of the admin listings above
+    id_column: str  # the outer table's id, for ordering and paging
+    filters: list[str]  # names of the FILTER_SPECS applied to it
+    search_columns: list[str]
+    edit_handler: str | None = None
+
+
+ADMIN_TABLES = {
+    'consumers': AdminTable(ADMIN_CONSUMERS_SQL, 'consumers.id', [], ['consumers.lti_consumer'], edit_handler="admin.consumer_form"),
+    'classes': AdminTable(ADMIN_CLASSES_SQL, 'classes.id', ['consumer'], ['classes.name', 'consumers.lti_consumer', 'class_owner.display_name']),
+    'users': AdminTable(ADMIN_USERS_SQL, 'users.id', ['consumer', 'class'], ['users.display_name', 'users.email', 'users.auth_name']),
+    'roles': AdminTable(ADMIN_ROLES_SQL, 'roles.id', ['consumer', 'class', 'user'], ['users.display_name', 'users.email', 'users.auth_name', 'classes.name']),
+}
+
+for _name, _table in ADMIN_TABLES.items():
+    # the first page of each, newest first (later pages search the id's index from the cursor)
+    register_sql(f'admin_{_name}', _table.sql.format(where_clause="") + f" ORDER BY {_table.id_column} DESC LIMIT ?", allow_scan=[_table.id_column.split('.')[0]])
+
+
+def get_admin_table_page(table: AdminTable, filters: Filters, cursor: str | None = None, search: str = "", ascending: bool = False) -> QueriesPage:
+    ''' One page of an admin table, newest (highest id) first unless
+    ascending, starting after the id given by `cursor` (as in
+    get_queries_page(), whose arguments these match). '''
+    conditions, params = filters.make_conditions(table.filters)
+    if cursor:
+        try:
+            params.append(int(cursor))
+        except ValueError:
+            return abort(400)  # invalid cursor
+        conditions.append(f"{table.id_column} {'>' if ascending else '<'} ?")
+    if search:
+        search_cond, search_params = search_condition(table.search_columns, search)
+        conditions.append(search_cond)
+        params.extend(search_params)
+
+    direction = "ASC" if ascending else "DESC"
+    page_size = current_app.config['QUERIES_PAGE_SIZE']
+    where_clause = "WHERE " + " AND ".join(conditions) if conditions else ""
+    sql = table.sql.format(where_clause=where_clause) + f" ORDER BY {table.id_column} {direction} LIMIT ?"
+    rows = get_db_ro().execute(sql, [*params, page_size + 1]).fetchall()  # one extra to see whether there is a next page
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return QueriesPage(rows, str(rows[-1]['id']))
+    else:
+        return QueriesPage(rows, None)
+
+
+def get_queries_filtered(where_clause: str, where_params: list[str]) -> Cursor:
+    ''' All matching queries, as a cursor to be read incrementally (e.g., for export). '''
+    db = get_db_ro()
+    sql = ADMIN_QUERIES_SQL.format(where_clause=where_clause) + " ORDER BY query_time DESC"
+    return db.execute(sql, [*where_params])
 
-    specs = [
-        FilterSpec('consumer', 'consumers.id', 'consumers.lti_consumer'),
-        FilterSpec('class', 'classes.id', 'classes.name'),
-        FilterSpec('user', 'users.id', 'users.display_name'),
-        FilterSpec('role', 'roles.id', 'printf("%s (%s:%s)", users.display_name, role_class.name, roles.role)'),
-    ]
-    for spec in specs:
+
+def get_queries_paged(filters: Filters, **page_args: Any) -> QueriesPage:
+    conditions, params = filters.make_conditions(['consumer', 'class', 'user', 'role'])
+    try:
+        return get_queries_page(ADMIN_QUERIES_SQL, conditions, params, **page_args)
+    except ValueError:
+        return abort(400)  # invalid cursor
+
+
+FILTER_SPECS = [
+    FilterSpec('consumer', 'consumers.id', 'consumers.lti_consumer'),
+    FilterSpec('class', 'classes.id', 'classes.name'),
+    FilterSpec('user', 'users.id', 'users.display_name'),
+    FilterSpec('role', 'roles.id', 'printf("%s (%s:%s)", users.display_name, role_class.name, roles.role)'),
+]
+
+
+def get_request_filters() -> Filters:
+    ''' Filters from the request's arguments, without display values (for exports and JSON). '''
+    filters = Filters()
+    for spec in FILTER_SPECS:
         if spec.name in request.args:
-            value = request.args[spec.name]
-            filters.add(spec, value, "dummy value")  # display value not used in CSV export
+            filters.add(spec, request.args[spec.name], "dummy value")  # display value not used
+    return filters
+
+
+@bp.route("/csv/queries/")
+def get_queries_csv() -> str | Response:
+    filters = get_request_filters()
 
     # queries, filtered by consumer, class, user, and role
     where_clause, where_params = filters.make_where(['consumer', 'class', 'user', 'role'])
@@ -187,16 +348,10 @@ def get_queries_csv() -> str | Response:
 
 @bp.route("/")
 def main() -> str:
-    db = get_db()
+    db = get_db_ro()
     filters = Filters()
 
-    specs = [
-        FilterSpec('consumer', 'consumers.id', 'consumers.lti_consumer'),
-        FilterSpec('class', 'classes.id', 'classes.name'),
-        FilterSpec('user', 'users.id', 'users.display_name'),
-        FilterSpec('role', 'roles.id', 'printf("%s (%s:%s)", users.display_name, role_class.name, roles.role)'),
-    ]
-    for spec in specs:
+    for spec in FILTER_SPECS:
         if spec.name in request.args:
             value = request.args[spec.name]
             # bit of a hack to have a single SQL query cover all different filters...
@@ -211,105 +366,26 @@ def main() -> str:
             display_value = display_row[0]
             filters.add(spec, value, display_value)
 
-    # all consumers
-    consumers = db.execute("""
-        SELECT
-            consumers.*,
-            models.shortname AS model,
-            COUNT(queries.id) AS num_queries,
-            COUNT(DISTINCT classes.id) AS num_classes,
-            COUNT(DISTINCT roles.id) AS num_users,
-            SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries
-        FROM consumers
-        LEFT JOIN models ON models.id=consumers.model_id
-        LEFT JOIN classes_lti ON classes_lti.lti_consumer_id=consumers.id
-        LEFT JOIN classes ON classes.id=classes_lti.class_id
-        LEFT JOIN roles ON roles.class_id=classes.id
-        LEFT JOIN queries ON queries.role_id=roles.id
-        GROUP BY consumers.id
-        ORDER BY num_recent_queries DESC, consumers.id DESC
-    """).fetchall()
+    # first page of each of consumers, classes, users, and roles, filtered as set in ADMIN_TABLES
+    tables = {name: get_admin_table_page(table, filters) for name, table in ADMIN_TABLES.items()}
 
-    # classes, filtered by consumer
-    where_clause, where_params = filters.make_where(['consumer'])
-    classes = db.execute(f"""
-        SELECT
-            classes.id,
-            classes.name,
-            COALESCE(consumers.lti_consumer, class_owner.display_name) AS owner,
-            models.shortname AS model,
-            COUNT(DISTINCT roles.id) AS num_users,
-            COUNT(queries.id) AS num_queries,
-            SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries
-        FROM classes
-        LEFT JOIN classes_user ON classes.id=classes_user.class_id
-        LEFT JOIN users AS class_owner ON classes_user.creator_user_id=class_owner.id
-        LEFT JOIN models ON models.id=classes_user.model_id
-        LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
-        LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
-        LEFT JOIN roles ON roles.class_id=classes.id
-        LEFT JOIN queries ON queries.role_id=roles.id
-        {where_clause}
-        GROUP BY classes.id
-        ORDER BY num_recent_queries DESC, classes.id DESC
-    """, where_params).fetchall()
-
-    # users, filtered by consumer and class
-    where_clause, where_params = filters.make_where(['consumer', 'class'])
-    users = db.execute(f"""
-        SELECT
-            users.id,
-            users.display_name,
-            users.email,
-            users.auth_name,
-            auth_providers.name AS auth_provider,
-            users.query_tokens,
-            COUNT(queries.id) AS num_queries,
-            SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries
-        FROM users
-        LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
-        LEFT JOIN roles ON roles.user_id=users.id
-        LEFT JOIN classes ON roles.class_id=classes.id
-        LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
-        LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
-        LEFT JOIN queries ON queries.user_id=users.id
-        {where_clause}
-        GROUP BY users.id
-        ORDER BY num_recent_queries DESC, users.id DESC
-    """, where_params).fetchall()
-
-    # roles, filtered by consumer, class, and user
-    where_clause, where_params = filters.make_where(['consumer', 'class', 'user'])
-    roles = db.execute(f"""
-        SELECT
-            roles.*,
-            users.id,
-            users.display_name,
-            users.email,
-            users.auth_name,
-            classes.name AS class_name,
-            COALESCE(consumers.lti_consumer, class_owner.display_name) AS class_owner,
-            auth_providers.name AS auth_provider,
-            COUNT(queries.id) AS num_queries
-        FROM roles
-        LEFT JOIN users ON users.id=roles.user_id
-        LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
-        LEFT JOIN classes ON roles.class_id=classes.id
-        LEFT JOIN classes_lti ON classes.id=classes_lti.class_id
-        LEFT JOIN classes_user ON classes.id=classes_user.class_id
-        LEFT JOIN users AS class_owner ON classes_user.creator_user_id=class_owner.id
-        LEFT JOIN consumers ON consumers.id=classes_lti.lti_consumer_id
-        LEFT JOIN queries ON roles.id=queries.role_id
-        {where_clause}
-        GROUP BY roles.id
-        ORDER BY roles.id DESC
-    """, where_params).fetchall()
+    # first page of queries, filtered by consumer, class, user, and role
+    page = get_queries_paged(filters)
+
+    return render_template("admin.html", tables=tables, queries=page.rows, next_cursor=page.next_cursor, filters=filters)
 
-    # queries, filtered by consumer, class, user, and role
-    where_clause, where_params = filters.make_where(['consumer', 'class', 'user', 'role'])
-    queries = get_queries_filtered(where_clause, where_params, queries_limit=200)
 
-    return render_template("admin.html", consumers=consumers, classes=classes, users=users, roles=roles, queries=queries, filters=filters)
+@bp.route("/queries.json")
+def get_queries_json() -> Response:
+    page = get_queries_paged(get_request_filters(), **get_page_args())
+    return page_json(page)
+
+
+@bp.route("/<any(consumers, classes, users, roles):name>.json")
+def get_table_json(name: str) -> Response:
+    table = ADMIN_TABLES[name]
+    page = get_admin_table_page(table, get_request_filters(), **get_page_args())
+    return page_json(page, table.edit_handler)
 
 
 @register_admin_link("Download DB", right=True)
@@ -323,6 +399,65 @@ def get_db_file() -> Response:
     return send_file(db_backup_file, mimetype='application/vnd.sqlite3', as_attachment=True, download_name=dl_name)
 
 
+@register_admin_link("LLM Usage")
+@bp.route("/llm_usage/")
+def llm_usage_view() -> str:
+    db = get_db_ro()
+    days = db.execute("""
+        SELECT
+            date(call_time) AS day,
+            COUNT(*) AS calls,
+            SUM(prompt_tokens) AS prompt_tokens,
+            SUM(completion_tokens) AS completion_tokens,
+            ROUND(AVG(latency), 2) AS avg_latency,
+            SUM(error IS NOT NULL) AS errors,
+            SUM(retries) AS retries
+        FROM llm_calls
+        WHERE call_time > date('now', '-30 days')
+        GROUP BY day
+        ORDER BY day DESC
+    """).fetchall()
+    classes = db.execute("""
+        SELECT
+            llm_calls.class_id,
+            classes.name AS class_name,
+            COUNT(*) AS calls,
+            SUM(prompt_tokens) AS prompt_tokens,
+            SUM(completion_tokens) AS completion_tokens,
+            SUM(error IS NOT NULL) AS errors
+        FROM llm_calls
+        LEFT JOIN classes ON classes.id=llm_calls.class_id
+        WHERE call_time > date('now', '-30 days')
+        GROUP BY llm_calls.class_id
+        ORDER BY calls DESC
+    """).fetchall()
+    kinds = db.execute("""
+        SELECT
+            kind,
+            model,
+            COUNT(*) AS calls,
+            ROUND(AVG(prompt_tokens)) AS avg_prompt_tokens,
+            ROUND(AVG(completion_tokens)) AS avg_completion_tokens,
+            ROUND(AVG(latency), 2) AS avg_latency
+        FROM llm_calls
+        WHERE call_time > date('now', '-30 days')
+        GROUP BY kind, model
+        ORDER BY calls DESC
+    """).fetchall()
+
+    return render_template("admin_llm_usage.html", days=days, classes=classes, kinds=kinds)
+
+
+@register_admin_link("Database")
+@bp.route("/database/")
+def database_view() -> str:
+    db = get_db()
+    pragmas = {name: db.execute(f"PRAGMA {name}").fetchone()[0] for name in current_app.config['SQLITE_PRAGMAS']}
+    snapshot_dir = get_snapshot_dir()
+    snapshots = list_snapshots(snapshot_dir) if snapshot_dir.exists() else []
+    return render_template("admin_database.html", pool_stats=get_db_pool_stats(), writer_stats=get_db_writer_stats(), pragmas=pragmas, snapshots=snapshots)
+
+
 @bp.route("/consumer/new")
 def consumer_new() -> str:
     return render_template("consumer_form.html", models=get_models())
@@ -343,8 +478,13 @@ def consumer_update() -> Response:
 
     if consumer_id is None:
         # Adding a new consumer
-        cur = db.execute("INSERT INTO consumers (lti_consumer, lti_secret, openai_key) VALUES (?, ?, ?)",
-                         [request.form['lti_consumer'], request.form['lti_secret'], request.form['openai_key']])
+        try:
+            rpm, tpm = parse_rate_limits(request.form)
+        except ValueError:
+            flash("Rate limits must be positive whole numbers, or blank for no limit.", "warning")
+            return redirect(url_for(".consumer_new"))
+        cur = db.execute("INSERT INTO consumers (lti_consumer, lti_secret, openai_key, rate_limit_rpm, rate_limit_tpm) VALUES (?, ?, ?, ?, ?)",
+                         [request.form['lti_consumer'], request.form['lti_secret'], request.form['openai_key'], rpm, tpm])
         consumer_id = cur.lastrowid
         db.commit()
         flash(f"Consumer {request.form['lti_consumer']} created.")
@@ -361,16 +501,24 @@ def consumer_update() -> Response:
 
     else:
         # Updating
+        try:
+            rpm, tpm = parse_rate_limits(request.form)
+        except ValueError:
+            flash("Rate limits must be positive whole numbers, or blank for no limit.", "warning")
+            return redirect(url_for(".consumer_form", id=consumer_id))
         if request.form.get('lti_secret', ''):
             db.execute("UPDATE consumers SET lti_secret=? WHERE id=?", [request.form['lti_secret'], consumer_id])
         if request.form.get('openai_key', ''):
             db.execute("UPDATE consumers SET openai_key=? WHERE id=?", [request.form['openai_key'], consumer_id])
         if request.form.get('model_id', ''):
             db.execute("UPDATE consumers SET model_id=? WHERE id=?", [request.form['model_id'], consumer_id])
+        # blank = no limit
+        db.execute("UPDATE consumers SET rate_limit_rpm=?, rate_limit_tpm=? WHERE id=?", [rpm, tpm, consumer_id])
         db.commit()
         flash("Consumer updated.")
 
     # anything might have changed: reload all consumers
     reload_consumers()
+    invalidate_llm_config()
 
     return redirect(url_for(".consumer_form", id=consumer_id))
@@ -2,14 +2,20 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import json
+import threading
+import time
+from collections import OrderedDict
 from collections.abc import Callable
+from dataclasses import dataclass
 from functools import wraps
-from sqlite3 import Row
+from sqlite3 import Connection, Row
 from typing import ParamSpec, TypedDict, TypeVar
 
 from flask import (
     Blueprint,
     abort,
+    current_app,
     flash,
     g,
     redirect,
@@ -21,11 +27,40 @@ from flask import (
 from werkzeug.security import check_password_hash
 from werkzeug.wrappers.response import Response
 
-from .db import get_db
+from .db import get_db, on_init_db, register_sql, run_write
+from .llm_config import ClassLLMConfig, get_class_llm_config
 
 # Constants
 AUTH_SESSION_KEY = "__gened_auth"
 
+# A user's data and active roles, in one query (run for a logged-in user's
+# request on an auth cache miss)
+USER_AUTH_SQL = register_sql('user_auth', """
+    SELECT
+        users.display_name,
+        users.is_admin,
+        users.is_tester,
+        auth_providers.name AS auth_provider,
+        (
+            SELECT json_group_array(json_object('id', id, 'class_id', class_id, 'name', name, 'enabled', enabled, 'role', role))
+            FROM (
+                SELECT
+                    roles.id,
+                    roles.class_id,
+                    classes.name,
+                    classes.enabled,
+                    roles.role
+                FROM roles
+                JOIN classes ON classes.id=roles.class_id
+                WHERE roles.user_id=users.id AND roles.active=1
+                ORDER BY roles.id DESC
+            )
+        ) AS roles_json
+    FROM users
+    LEFT JOIN auth_providers ON auth_providers.id=users.auth_provider
+    WHERE users.id=?
+""")
+
 
 class ClassDict(TypedDict):
     class_id: int
@@ -46,12 +81,70 @@ class AuthDict(TypedDict, total=False):
     other_classes: list[ClassDict]  # for storing active classes that are not the user's current class
 
 
+# A process-wide LRU cache of each logged-in user's AuthDict, keyed by
+# (database, user_id, role_id), so the user and roles queries are not run on
+# every request.
+#
+# Entries are invalidated explicitly wherever a user's auth data is written
+# (see invalidate_auth()): on login, on switching classes, and when a role or
+# class changes.  As in gened.llm_config, a generation counter prevents a
+# lookup that raced with an invalidation from storing stale data, and entries
+# expire after AUTH_CACHE_TTL seconds, which bounds staleness when the
+# application runs in multiple processes.
+_auth_cache: OrderedDict[tuple[str, int, int | None], tuple[float, AuthDict]] = OrderedDict()
+_auth_generation = 0
+_auth_lock = threading.Lock()
+
+
+def _auth_cache_get(key: tuple[str, int, int | None]) -> AuthDict | None:
+    with _auth_lock:
+        entry = _auth_cache.get(key)
+        if entry is None:
+            return None
+        expires, auth_dict = entry
+        if time.monotonic() >= expires:
+            del _auth_cache[key]
+            return None
+        _auth_cache.move_to_end(key)
+    return auth_dict
+
+
+def _auth_cache_put(key: tuple[str, int, int | None], auth_dict: AuthDict, generation: int) -> None:
+    expires = time.monotonic() + current_app.config['AUTH_CACHE_TTL']
+    max_size = current_app.config['AUTH_CACHE_SIZE']
+    with _auth_lock:
+        if generation != _auth_generation:
+            return
+        _auth_cache[key] = (expires, auth_dict)
+        _auth_cache.move_to_end(key)
+        while len(_auth_cache) > max_size:
+            _auth_cache.popitem(last=False)
+
+
+@on_init_db
+def invalidate_auth(user_id: int | None = None) -> None:
+    """ Invalidate cached auth data for one user, or for all users if user_id
+        is None.  Call after committing any change to a user's name or admin
+        status, to any of their roles, or to a class (name or enabled status;
+        these affect all of the class's users, so invalidate all users).
+    """
+    global _auth_generation  # noqa: PLW0603 (global statement)
+    with _auth_lock:
+        _auth_generation += 1
+        if user_id is None:
+            _auth_cache.clear()
+        else:
+            for key in [key for key in _auth_cache if key[1] == user_id]:
+                del _auth_cache[key]
+
+
 def _invalidate_g_auth() -> None:
     """ Ensure no auth data is cached in the g object.
         Use after modifying auth data stored in the session,
         so g.auth will be regenerated on next access in get_auth().
     """
     g.pop('auth', None)
+    g.pop('request_context', None)
 
 
 def set_session_auth_user(user_id: int) -> None:
@@ -62,6 +155,8 @@ def set_session_auth_user(user_id: int) -> None:
         'user_id': user_id,
     }
     session[AUTH_SESSION_KEY] = auth
+    # logins may have updated the user's data or created roles for them
+    invalidate_auth(user_id)
     _invalidate_g_auth()
 
 
@@ -77,7 +172,7 @@ def set_session_auth_role(role_id: int | None) -> None:
 
 def _get_auth_from_session() -> AuthDict:
     """ Populate auth data for the current session based on its current
-        user_id and role_id (if any).
+        user_id and role_id (if any), from the cache if possible.
     """
     base: AuthDict = {
         'user_id': None,
@@ -96,23 +191,32 @@ def _get_auth_from_session() -> AuthDict:
         # No logged in user; return the base/empty auth data
         return base
 
+    key = (current_app.config['DATABASE'], sess_user, sess_role)
+    cached = _auth_cache_get(key)
+    if cached is not None:
+        return cached.copy()
+
+    generation = _auth_generation
+    auth_dict = _load_auth(sess_user, sess_role)
+    if auth_dict is None:
+        # Fall through if user_id is not in database (deleted from DB?)
+        return base
+
+    _auth_cache_put(key, auth_dict, generation)
+    return auth_dict.copy()
+
+
+def _load_auth(sess_user: int, sess_role: int | None) -> AuthDict | None:
+    """ Query the database for a user's auth data with the given current role.
+        Returns None if the user does not exist.
+    """
     db = get_db()
 
-    # Get user's data
-    user_row = db.execute("""
-        SELECT
-            users.display_name,
-            users.is_admin,
-            users.is_tester,
-            auth_providers.name AS auth_provider
-        FROM users
-        LEFT JOIN auth_providers ON auth_providers.id=users.auth_provider
-        WHERE users.id=?
-    """, [sess_user]).fetchone()
+    # Get user's data and active roles
+    user_row = db.execute(USER_AUTH_SQL, [sess_user]).fetchone()
 
     if not user_row:
-        # Fall through if user_id is not in database (deleted from DB?)
-        return base
+        return None
 
     # Create a new AuthDict and populate with data from the database
     auth_dict: AuthDict = {
@@ -131,21 +235,10 @@ def _get_auth_from_session() -> AuthDict:
         'other_classes': [],
     }
 
-    # Check the database for any active roles (may be changed by another user)
-    # and populate class/role information.
+    # Populate class/role information from the user's roles in the database
+    # (may be changed by another user).
     # Uses WHERE active=1 to only allow active roles.
-    role_rows = db.execute("""
-        SELECT
-            roles.id,
-            roles.class_id,
-            classes.name,
-            classes.enabled,
-            roles.role
-        FROM roles
-        JOIN classes ON classes.id=roles.class_id
-        WHERE roles.user_id=? AND roles.active=1
-        ORDER BY roles.id DESC
-    """, [auth_dict['user_id']]).fetchall()
+    role_rows = json.loads(user_row['roles_json'])
 
     found_role = False  # track whether the current role from auth is actually found as an active role
     if role_rows:
@@ -178,6 +271,29 @@ def get_auth() -> AuthDict:
     return g.auth
 
 
+@dataclass(frozen=True)
+class RequestContext:
+    """ The current user and class, as needed by views that use the class
+        (its enabled status, LLM configuration, and app-specific configuration).
+    """
+    auth: AuthDict
+    llm_config: ClassLLMConfig | None  # None if there is no current class
+
+
+def get_request_context() -> RequestContext:
+    """ Load the request's context once per request.  Both parts are cached
+        across requests (see _auth_cache and gened.llm_config), so this
+        usually runs no queries, and at most one for each part.
+    """
+    if 'request_context' not in g:
+        auth = get_auth()
+        class_id = auth['class_id']
+        llm_config = get_class_llm_config(class_id) if class_id is not None else None
+        g.request_context = RequestContext(auth=auth, llm_config=llm_config)
+
+    return g.request_context
+
+
 def get_last_role(user_id: int) -> int | None:
     """ Find and return the last role (as a role ID) for the given user,
         as long as that role still exists and is currently active.
@@ -234,21 +350,22 @@ def ext_login_update_or_create(provider_name: str, user_normed: dict[str, str |
     if auth_row:
         user_id = auth_row['user_id']
         # Update w/ latest user info (name, email, etc. could conceivably change)
-        cur = db.execute(
+        run_write(lambda db: db.execute(
             "UPDATE users SET full_name=?, email=?, auth_name=? WHERE id=?",
             [user_normed['full_name'], user_normed['email'], user_normed['auth_name'], user_id]
-        )
-        db.commit()
+        ))
 
     else:
         # Create a new user account.
-        cur = db.execute(
-            "INSERT INTO users (auth_provider, full_name, email, auth_name, query_tokens) VALUES (?, ?, ?, ?, ?)",
-            [provider_id, user_normed['full_name'], user_normed['email'], user_normed['auth_name'], query_tokens]
-        )
-        user_id = cur.lastrowid
-        db.execute("INSERT INTO auth_external(user_id, auth_provider, ext_id) VALUES (?, ?, ?)", [user_id, provider_id, user_normed['ext_id']])
-        db.commit()
+        def create_user(db: Connection) -> int | None:
+            cur = db.execute(
+                "INSERT INTO users (auth_provider, full_name, email, auth_name, query_tokens) VALUES (?, ?, ?, ?, ?)",
+                [provider_id, user_normed['full_name'], user_normed['email'], user_normed['auth_name'], query_tokens]
+            )
+            db.execute("INSERT INTO auth_external(user_id, auth_provider, ext_id) VALUES (?, ?, ?)", [cur.lastrowid, provider_id, user_normed['ext_id']])
+            return cur.lastrowid
+
+        user_id = run_write(create_user)
 
     # get all values in newly updated/inserted row
     user_row = db.execute("SELECT * FROM users WHERE id=?", [user_id]).fetchone()
@@ -320,17 +437,14 @@ def instructor_required(f: Callable[P, R]) -> Callable[P, Response | R]:
 def class_enabled_required(f: Callable[P, R]) -> Callable[P, str | R]:
     @wraps(f)
     def decorated_function(*args: P.args, **kwargs: P.kwargs) -> str | R:
-        auth = get_auth()
-        class_id = auth['class_id']
+        llm_config = get_request_context().llm_config
 
-        if class_id is None:
+        if llm_config is None:
             # No active class, no problem
             return f(*args, **kwargs)
 
         # Otherwise, there's an active class, so we require it to be enabled.
-        db = get_db()
-        class_row = db.execute("SELECT * FROM classes WHERE id=?", [class_id]).fetchone()
-        if not class_row['enabled']:
+        if not llm_config.enabled:
             flash("The current class is archived or disabled.  New requests cannot be made.", "warning")
             return render_template("error.html")
 
@@ -0,0 +1,238 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# Incremental, compressed snapshots of the database, in the instance's
+# backups/ directory.
+#
+# Each snapshot is taken with an online backup (gened.db.backup_db) into a
+# staging file, which is then compared page by page with the previous
+# snapshot (via a stored hash of each page).  A snapshot is either full (the
+# whole file, gzipped), starting a new chain, or a diff (just the pages that
+# changed, gzipped) on the one before it.  Restoring a snapshot applies the
+# diffs of its chain, in order, to the chain's full snapshot.  Only the most
+# recent BACKUP_SNAPSHOT_KEEP_CHAINS chains are kept.
+#
+# Intended to be run periodically (e.g., from cron) with `flask backup-snapshot`.
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import struct
+from collections.abc import Iterator
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+import click
+from flask import current_app
+from flask.app import Flask
+from flask.cli import with_appcontext
+
+from .db import backup_db
+
+DIFF_MAGIC = b"GenEdPageDiff1\n"
+_DIFF_HEADER = struct.Struct(">II")  # page size, page count (after DIFF_MAGIC)
+_DIFF_PAGE = struct.Struct(">I")  # page number (0-based), before each changed page
+_HASH_SIZE = 16
+STATE_FILE = 'state.json'  # the latest snapshot and its chain
+HASHES_FILE = 'pages.hashes'  # hashes of the latest snapshot's pages
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    path: Path
+    name: str  # timestamp, e.g. 20240312-101500-123456
+    full: bool
+
+    @property
+    def size(self) -> int:
+        return self.path.stat().st_size
+
+
+def get_snapshot_dir() -> Path:
+    return Path(current_app.instance_path) / "backups" / f"{current_app.config['DATABASE_NAME']}.snapshots"
+
+
+def list_snapshots(snapshot_dir: Path) -> list[Snapshot]:
+    ''' All snapshots in the directory, oldest first. '''
+    snapshots = []
+    for path in snapshot_dir.glob("*.gz"):
+        name, _, kind = path.name.removesuffix(".gz").partition(".")
+        if kind in ('full', 'diff'):
+            snapshots.append(Snapshot(path, name, kind == 'full'))
+    return sorted(snapshots, key=lambda s: s.name)
+
+
+def _chains(snapshots: list[Snapshot]) -> list[list[Snapshot]]:
+    chains: list[list[Snapshot]] = []
+    for snapshot in snapshots:
+        if snapshot.full or not chains:
+            chains.append([])
+        chains[-1].append(snapshot)
+    return chains
+
+
+def _page_size(path: Path) -> int:
+    with path.open('rb') as f:
+        header = f.read(100)
+    page_size = int.from_bytes(header[16:18], 'big')
+    return 65536 if page_size == 1 else page_size
+
+
+def _read_pages(path: Path, page_size: int) -> Iterator[bytes]:
+    with path.open('rb') as f:
+        while page := f.read(page_size):
+            yield page
+
+
+def _page_hash(page: bytes) -> bytes:
+    return hashlib.blake2b(page, digest_size=_HASH_SIZE).digest()
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
+
+def take_snapshot(snapshot_dir: Path | None = None) -> Snapshot:
+    ''' Take a snapshot of the database: full if starting a new chain, otherwise a diff on the previous snapshot. '''
+    if snapshot_dir is None:
+        snapshot_dir = get_snapshot_dir()
+    snapshot_dir.mkdir(mode=0o770, parents=True, exist_ok=True)
+
+    state_path = snapshot_dir / STATE_FILE
+    hashes_path = snapshot_dir / HASHES_FILE
+    state = json.loads(state_path.read_text()) if state_path.exists() else None
+    prev_hashes = hashes_path.read_bytes() if state and hashes_path.exists() else b""
+
+    full = state is None or not prev_hashes or state['chain_length'] >= current_app.config['BACKUP_SNAPSHOT_FULL_EVERY']
+    name = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    path = snapshot_dir / f"{name}.{'full' if full else 'diff'}.gz"
+    tmp_path = snapshot_dir / f"{name}.tmp"
+
+    staging = snapshot_dir / "staging.db"
+    staging.unlink(missing_ok=True)
+    try:
+        backup_db(staging)
+
+        page_size = _page_size(staging)
+        page_count = staging.stat().st_size // page_size
+        if state and state['page_size'] != page_size:
+            full = True  # the page size has changed (VACUUM), so no pages can be diffed
+            path = snapshot_dir / f"{name}.full.gz"
+        hashes = bytearray()
+        with gzip.open(tmp_path, 'wb') as out:
+            if not full:
+                out.write(DIFF_MAGIC)
+                out.write(_DIFF_HEADER.pack(page_size, page_count))
+            for page_num, page in enumerate(_read_pages(staging, page_size)):
+                page_hash = _page_hash(page)
+                hashes += page_hash
+                if full:
+                    out.write(page)
+                elif prev_hashes[page_num * _HASH_SIZE:(page_num + 1) * _HASH_SIZE] != page_hash:
+                    out.write(_DIFF_PAGE.pack(page_num))
+                    out.write(page)
+        os.replace(tmp_path, path)
+    finally:
+        staging.unlink(missing_ok=True)
+        tmp_path.unlink(missing_ok=True)
+
+    _write_atomic(hashes_path, bytes(hashes))
+    _write_atomic(state_path, json.dumps({
+        'latest': name,
+        'page_size': page_size,
+        'chain_length': 1 if full else state['chain_length'] + 1,
+    }).encode())
+
+    _evict(snapshot_dir)
+
+    return Snapshot(path, name, full)
+
+
+def _evict(snapshot_dir: Path) -> list[Snapshot]:
+    ''' Remove all but the most recent BACKUP_SNAPSHOT_KEEP_CHAINS chains of snapshots. '''
+    chains = _chains(list_snapshots(snapshot_dir))
+    keep = max(1, current_app.config['BACKUP_SNAPSHOT_KEEP_CHAINS'])
+    evicted = [snapshot for chain in chains[:-keep] for snapshot in chain]
+    for snapshot in evicted:
+        snapshot.path.unlink()
+    return evicted
+
+
+def _apply_diff(path: Path, db_file: Path) -> None:
+    with gzip.open(path, 'rb') as diff, db_file.open('r+b') as f:
+        if diff.read(len(DIFF_MAGIC)) != DIFF_MAGIC:
+            raise ValueError(f"Not a snapshot diff: {path}")
+        page_size, page_count = _DIFF_HEADER.unpack(diff.read(_DIFF_HEADER.size))
+        while page_num_bytes := diff.read(_DIFF_PAGE.size):
+            (page_num,) = _DIFF_PAGE.unpack(page_num_bytes)
+            f.seek(page_num * page_size)
+            f.write(diff.read(page_size))
+        f.truncate(page_size * page_count)
+
+
+def restore_snapshot(name: str, target: Path, snapshot_dir: Path | None = None) -> None:
+    ''' Reconstruct the database as of the named snapshot into target (which must not exist). '''
+    if snapshot_dir is None:
+        snapshot_dir = get_snapshot_dir()
+    if target.exists():
+        raise FileExistsError(f"{target} already exists")
+
+    for chain in _chains(list_snapshots(snapshot_dir)):
+        names = [snapshot.name for snapshot in chain]
+        if name in names:
+            break
+    else:
+        raise FileNotFoundError(f"No snapshot named {name} in {snapshot_dir}")
+
+    chain = chain[:names.index(name) + 1]
+    if not chain[0].full:
+        raise FileNotFoundError(f"The full snapshot for {name} is missing")
+
+    tmp_target = target.with_name(target.name + ".tmp")
+    with gzip.open(chain[0].path, 'rb') as src, tmp_target.open('wb') as dest:
+        shutil.copyfileobj(src, dest)
+    for snapshot in chain[1:]:
+        _apply_diff(snapshot.path, tmp_target)
+    os.replace(tmp_target, target)
+
+
+@click.command('backup-snapshot')
+@with_appcontext
+def snapshot_command() -> None:
+    """Take an incremental, compressed snapshot of the database."""
+    snapshot = take_snapshot()
+    kind = "full" if snapshot.full else "diff"
+    click.echo(f"Snapshot ({kind}, {snapshot.size / 1024:.1f} KiB) saved in \x1B[33m{snapshot.path}\x1B[m.")
+
+
+@click.command('backup-list')
+@with_appcontext
+def list_command() -> None:
+    """List the database's snapshots."""
+    for snapshot in list_snapshots(get_snapshot_dir()):
+        click.echo(f"{snapshot.name}  {'full' if snapshot.full else 'diff':4}  {snapshot.size / 1024:10.1f} KiB")
+
+
+@click.command('backup-restore')
+@click.argument('name')
+@click.argument('target', type=click.Path(dir_okay=False, path_type=Path))
+@with_appcontext
+def restore_command(name: str, target: Path) -> None:
+    """Reconstruct the database as of snapshot NAME into the file TARGET."""
+    try:
+        restore_snapshot(name, target)
+    except (FileExistsError, FileNotFoundError, ValueError) as e:
+        raise click.ClickException(str(e)) from None
+    click.echo(f"Snapshot {name} restored into \x1B[33m{target}\x1B[m.")
+
+
+def init_app(app: Flask) -> None:
+    app.cli.add_command(snapshot_command)
+    app.cli.add_command(list_command)
+    app.cli.add_command(restore_command)
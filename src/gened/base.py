@@ -17,13 +17,17 @@ from werkzeug.middleware.proxy_fix import ProxyFix
 from . import (
     admin,
     auth,
+    backup,
     class_config,
     classes,
+    completion_cache,
     db,
     demo,
     docs,
+    export,
     filters,
     instructor,
+    jobs,
     lti,
     migrate,
     oauth,
@@ -78,6 +82,75 @@ def create_app_base(import_name: str, app_config: dict[str, Any], instance_path:
         SEND_FILE_MAX_AGE_DEFAULT=3*60*60,  # 3 hours
         # Free query tokens given to new users
         DEFAULT_TOKENS=10,
+        # If set, batch token spends in memory and write them every this many
+        # seconds (single-process deployments only; see gened/tokens.py)
+        TOKEN_BATCH_INTERVAL=None,
+        # Completion cache: entry lifetime (seconds) and maximum number of entries
+        COMPLETION_CACHE_TTL=24*60*60,  # 1 day
+        COMPLETION_CACHE_MAX_ENTRIES=10000,
+        # Run LLM requests as background jobs instead of in request threads
+        # (single-process deployments only; see gened/jobs.py)
+        BACKGROUND_JOBS=False,
+        # Maximum LLM calls (or background jobs) in progress at once per API
+        # key; further calls wait up to RATE_LIMIT_MAX_WAIT, jobs indefinitely.
+        LLM_CONCURRENCY_PER_KEY=8,
+        # Rate limits (requests and tokens per minute; None = no limit) for the
+        # system API key.  Limits for other keys are set per consumer / class.
+        OPENAI_RATE_LIMIT_RPM=None,
+        OPENAI_RATE_LIMIT_TPM=None,
+        # Maximum time (seconds) an LLM request will wait for a concurrency slot
+        # and for its key's rate limits
+        RATE_LIMIT_MAX_WAIT=20,
+        # Retries of LLM requests that fail with transient errors, with
+        # exponential backoff (seconds) plus jitter, all within an overall
+        # deadline (seconds) for each completion
+        LLM_RETRIES=2,
+        LLM_RETRY_BASE_DELAY=0.5,
+        LLM_RETRY_MAX_DELAY=8,
+        LLM_DEADLINE=120,
+        # Hedged requests: if a completion takes longer than the model's recent
+        # p95 latency, send a second request and use whichever finishes first.
+        # (Hedging starts once there are enough latency samples.)
+        LLM_HEDGE=False,
+        LLM_HEDGE_MIN_SAMPLES=20,
+        # Maximum lifetime (seconds) of cached class LLM configurations
+        LLM_CONFIG_CACHE_TTL=60,
+        # Number of rendered Markdown texts (responses, chat messages) to cache (see gened.filters)
+        MARKDOWN_CACHE_SIZE=1000,
+        # Maximum lifetime (seconds) and number of cached per-user auth data (see gened.auth)
+        AUTH_CACHE_TTL=30,
+        AUTH_CACHE_SIZE=10000,
+        # Gzip CSV exports for clients that accept it (see gened.csv.csv_response)
+        CSV_GZIP=True,
+        # Rows per page of the instructor and admin queries tables (see gened.queries.get_queries_page)
+        QUERIES_PAGE_SIZE=100,
+        # Columns of the queries table searched by those tables' search boxes, along with users.display_name
+        QUERY_SEARCH_COLUMNS=['response_text'],
+        # Reuse database connections across requests (one per worker thread)
+        DB_POOL=True,
+        # Make frequent writes (queries, responses, chats, logins, ...) in a
+        # single writer thread that group-commits them (see gened.db.run_write)
+        DB_WRITER=True,
+        # Record the statements each request executes (see gened.db.get_db_queries),
+        # logging their number at debug level
+        DB_COUNT_QUERIES=False,
+        # Online backups (see gened.db.backup_db): pages copied per step, and
+        # seconds to sleep between steps to leave I/O for request handling
+        BACKUP_STEP_PAGES=1024,
+        BACKUP_STEP_SLEEP=0.01,
+        # Incremental snapshots (`flask backup-snapshot`; see gened.backup):
+        # every Nth snapshot is full (starting a new chain), the rest are page
+        # diffs; only the most recent chains are kept.
+        BACKUP_SNAPSHOT_FULL_EVERY=24,
+        BACKUP_SNAPSHOT_KEEP_CHAINS=7,
+        # Pragmas applied to each new database connection
+        SQLITE_PRAGMAS={
+            'journal_mode': 'WAL',
+            'busy_timeout': 5000,           # ms to wait for a lock before "database is locked"
+            'synchronous': 'NORMAL',        # safe with WAL; fsync at checkpoints, not every commit
+            'mmap_size': 256 * 1024 * 1024,
+            'cache_size': -16 * 1024,       # negative = KiB (16 MiB per connection)
+        },
         PYLTI_CONFIG={
             # will be loaded from the consumers table in the database
             "consumers": { }
@@ -164,7 +237,9 @@ def create_app_base(import_name: str, app_config: dict[str, Any], instance_path:
         pass
 
     admin.init_app(app)
+    backup.init_app(app)
     db.init_app(app)
+    export.init_app(app)
     filters.init_app(app)
     migrate.init_app(app)
     oauth.init_app(app)
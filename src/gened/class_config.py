@@ -1,5 +1,6 @@
 import datetime as dt
 import json
+import threading
 from collections.abc import Callable
 from dataclasses import Field, asdict
 from sqlite3 import Row
@@ -8,6 +9,7 @@ from typing import Any, ClassVar, TypeVar
 from flask import (
     Blueprint,
     abort,
+    current_app,
     flash,
     g,
     redirect,
@@ -19,8 +21,9 @@ from typing_extensions import Protocol, Self
 from werkzeug.datastructures import ImmutableMultiDict
 from werkzeug.wrappers.response import Response
 
-from .auth import get_auth, instructor_required
-from .db import get_db
+from .auth import get_auth, get_request_context, instructor_required
+from .db import get_db, on_init_db
+from .llm_config import invalidate_llm_config
 from .openai import get_models
 from .tz import date_is_past
 
@@ -86,7 +89,7 @@ def get_common_class_settings() -> tuple[Row, str | None]:
     class_id = auth['class_id']
 
     class_row = db.execute("""
-        SELECT classes.id, classes.enabled, classes_user.link_ident, classes_user.link_reg_expires, classes_user.openai_key, classes_user.model_id
+        SELECT classes.id, classes.enabled, classes_user.link_ident, classes_user.link_reg_expires, classes_user.openai_key, classes_user.model_id, classes_user.rate_limit_rpm, classes_user.rate_limit_tpm
         FROM classes
         LEFT JOIN classes_user
           ON classes.id = classes_user.class_id
@@ -108,18 +111,49 @@ def get_common_class_settings() -> tuple[Row, str | None]:
 
 T = TypeVar('T', bound='IsClassConfig')
 
+# A process-wide cache of parsed class configuration objects, keyed by
+# (database, class_id), each stored with the configuration JSON it was parsed
+# from (its version).  So a class's JSON is parsed into its dataclass once,
+# not on every request, and anything the dataclass derives from its fields
+# (e.g., with functools.cached_property) is computed once per version.
+# Config dataclasses are frozen, so objects are safely shared across requests
+# and threads.  Entries are invalidated by set_config() (see
+# invalidate_class_config()), and a changed version is reparsed regardless.
+_parsed_configs: dict[tuple[str, int], tuple[str, Any]] = {}
+_parsed_lock = threading.Lock()
+
+
+@on_init_db
+def invalidate_class_config(class_id: int | None = None) -> None:
+    ''' Drop the parsed configuration of one class, or of all classes if class_id is None. '''
+    with _parsed_lock:
+        if class_id is None:
+            _parsed_configs.clear()
+        else:
+            for key in [key for key in _parsed_configs if key[1] == class_id]:
+                del _parsed_configs[key]
+
+
 def get_class_config(config_class: type[T]) -> T:
     if 'class_config' not in g:
-        auth = get_auth()
-        class_id = auth['class_id']
+        context = get_request_context()
+        class_id = context.auth['class_id']
+        llm_config = context.llm_config
 
-        if class_id is None:
+        if class_id is None or llm_config is None:
             g.class_config = config_class()
         else:
-            db = get_db()
-            config_row = db.execute("SELECT config FROM classes WHERE id=?", [class_id]).fetchone()
-            class_config_dict = json.loads(config_row['config'])
-            g.class_config = config_class(**class_config_dict)
+            key = (current_app.config['DATABASE'], class_id)
+            version = llm_config.config_json
+            with _parsed_lock:
+                entry = _parsed_configs.get(key)
+            if entry is not None and entry[0] == version and isinstance(entry[1], config_class):
+                g.class_config = entry[1]
+            else:
+                class_config_dict = json.loads(version)
+                g.class_config = config_class(**class_config_dict)
+                with _parsed_lock:
+                    _parsed_configs[key] = (version, g.class_config)
 
     return g.class_config
 
@@ -153,6 +187,8 @@ def set_config() -> Response:
 
     db.execute("UPDATE classes SET config=? WHERE id=?", [class_config_json, class_id])
     db.commit()
+    invalidate_llm_config(class_id)
+    invalidate_class_config(class_id)
 
     flash("Configuration set!", "success")
     return redirect(url_for(".config_form"))
@@ -8,8 +8,8 @@ import secrets
 from flask import Blueprint, abort, flash, redirect, render_template, request, url_for
 from werkzeug.wrappers.response import Response
 
-from .auth import get_auth, login_required, set_session_auth_role
-from .db import get_db
+from .auth import get_auth, invalidate_auth, login_required, set_session_auth_role
+from .db import get_db, run_write
 from .tz import date_is_past
 
 bp = Blueprint('classes', __name__, url_prefix="/classes", template_folder='templates')
@@ -49,6 +49,7 @@ def get_or_create_lti_class(lti_consumer_id: int, lti_context_id: str, class_nam
         if class_row['name'] != class_name:
             db.execute("UPDATE classes SET name=? WHERE id=?", [class_name, class_row['id']])
             db.commit()
+            invalidate_auth()  # the class name is in all of its users' auth data
 
         return class_row['id']
 
@@ -105,6 +106,7 @@ def create_user_class(user_id: int, class_name: str, openai_key: str) -> int:
         [user_id, class_id, 'instructor']
     )
     db.commit()
+    invalidate_auth(user_id)
 
     return class_id
 
@@ -143,9 +145,9 @@ def switch_class(class_id: int | None) -> bool:
         role_id = row['role_id']
 
     set_session_auth_role(role_id)
+    invalidate_auth(user_id)  # refresh the user's classes and roles on any switch
     # record as user's latest active role
-    db.execute("UPDATE users SET last_role_id=? WHERE users.id=?", [role_id, user_id])
-    db.commit()
+    run_write(lambda db: db.execute("UPDATE users SET last_role_id=? WHERE users.id=?", [role_id, user_id]))
     return True
 
 
@@ -0,0 +1,129 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import hashlib
+import json
+import sqlite3
+from typing import Any
+
+from flask import current_app, flash, redirect, render_template, url_for
+from werkzeug.wrappers.response import Response
+
+from .admin import bp as bp_admin
+from .admin import register_admin_link
+from .db import get_db, queue_write, run_write
+
+# A cache of completed responses, keyed by a hash of everything that determines
+# the response (model, normalized prompt text, etc.), stored in the database
+# so it survives restarts.
+#
+# Entries expire COMPLETION_CACHE_TTL seconds after they are created, and the
+# least-recently used entries are evicted once there are more than
+# COMPLETION_CACHE_MAX_ENTRIES.  Hit and miss counts are stored in the
+# completion_cache_stats table and shown on an admin page.
+
+
+def normalize_text(text: str) -> str:
+    ''' Normalize line endings and trailing whitespace so that trivially
+    different inputs produce the same cache key. '''
+    lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    return '\n'.join(line.rstrip() for line in lines).strip()
+
+
+def make_cache_key(model: str, *parts: str) -> str:
+    ''' Create a cache key from a model name and any number of strings
+    (e.g., prompt text) that determine a response. '''
+    data = json.dumps([model, *(normalize_text(part) for part in parts)])
+    return hashlib.sha256(data.encode('utf8')).hexdigest()
+
+
+def _count(db: sqlite3.Connection, name: str) -> None:
+    db.execute("""
+        INSERT INTO completion_cache_stats (name, count) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET count=count+1
+    """, [name])
+
+
+def cache_get(key: str) -> tuple[list[Any], dict[str, str]] | None:
+    ''' Look up an unexpired entry in the cache.
+
+    Returns a tuple of (responses, texts) as stored by cache_put(), or None on a miss.
+    '''
+    db = get_db()
+    ttl = int(current_app.config['COMPLETION_CACHE_TTL'])
+
+    row = db.execute(
+        "SELECT responses_json, texts_json FROM completion_cache WHERE key=? AND created > datetime('now', ?)",
+        [key, f"-{ttl} seconds"]
+    ).fetchone()
+
+    def record_lookup(db: sqlite3.Connection) -> None:
+        if row:
+            db.execute("UPDATE completion_cache SET last_used=CURRENT_TIMESTAMP, hits=hits+1 WHERE key=?", [key])
+            _count(db, 'hit')
+        else:
+            _count(db, 'miss')
+
+    # Nothing here depends on the write, so don't wait for it.
+    queue_write(record_lookup)
+
+    if not row:
+        return None
+    return json.loads(row['responses_json']), json.loads(row['texts_json'])
+
+
+def cache_put(key: str, model: str, responses: list[Any], texts: dict[str, str]) -> None:
+    ''' Store a response in the cache, evicting expired and least-recently used entries. '''
+    ttl = int(current_app.config['COMPLETION_CACHE_TTL'])
+    max_entries = int(current_app.config['COMPLETION_CACHE_MAX_ENTRIES'])
+
+    def write(db: sqlite3.Connection) -> None:
+        db.execute(
+            "INSERT OR REPLACE INTO completion_cache (key, model, responses_json, texts_json) VALUES (?, ?, ?, ?)",
+            [key, model, json.dumps(responses), json.dumps(texts)]
+        )
+        db.execute("DELETE FROM completion_cache WHERE created <= datetime('now', ?)", [f"-{ttl} seconds"])
+        db.execute("""
+            DELETE FROM completion_cache WHERE key IN (
+                SELECT key FROM completion_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, [max_entries])
+
+    run_write(write)
+
+
+# ### Admin routes ###
+
+@register_admin_link("Completion Cache")
+@bp_admin.route("/completion_cache/")
+def completion_cache_view() -> str:
+    db = get_db()
+    stats = {row['name']: row['count'] for row in db.execute("SELECT name, count FROM completion_cache_stats")}
+    hits = stats.get('hit', 0)
+    misses = stats.get('miss', 0)
+    hit_rate = hits / (hits + misses) if hits + misses else None
+    entries = db.execute("""
+        SELECT
+            COUNT(*) AS num_entries,
+            SUM(LENGTH(responses_json) + LENGTH(texts_json)) AS total_size
+        FROM completion_cache
+    """).fetchone()
+    models = db.execute("""
+        SELECT model, COUNT(*) AS num_entries, SUM(hits) AS hits
+        FROM completion_cache
+        GROUP BY model
+        ORDER BY num_entries DESC
+    """).fetchall()
+
+    return render_template("admin_completion_cache.html", hits=hits, misses=misses, hit_rate=hit_rate, entries=entries, models=models)
+
+
+@bp_admin.route("/completion_cache/clear", methods=['POST'])
+def completion_cache_clear() -> Response:
+    db = get_db()
+    db.execute("DELETE FROM completion_cache")
+    db.execute("DELETE FROM completion_cache_stats")
+    db.commit()
+    flash("Completion cache cleared.")
+    return redirect(url_for(".completion_cache_view"))
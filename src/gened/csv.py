@@ -5,26 +5,76 @@
 import csv
 import datetime as dt
 import io
-from sqlite3 import Row
+import itertools
+import zlib
+from collections.abc import Iterable, Iterator
+from sqlite3 import Cursor, Row
 
-from flask import flash, make_response, render_template
+from flask import current_app, flash, render_template, request, stream_with_context
 from werkzeug.wrappers.response import Response
 
+CHUNK_ROWS = 1000  # rows fetched and written per chunk of the response
+
+
+def _fetch_chunks(table: Cursor | Iterable[Row]) -> Iterator[list[Row]]:
+    if isinstance(table, Cursor):
+        while rows := table.fetchmany(CHUNK_ROWS):
+            yield rows
+    else:
+        it = iter(table)
+        while rows := list(itertools.islice(it, CHUNK_ROWS)):
+            yield rows
 
-def csv_response(class_name: str, kind: str, table: list[Row]) -> str | Response:
-    if not table:
-        flash("There are no rows to export yet.", "warning")
-        return render_template("error.html")
 
+def _csv_chunks(first_row: Row, chunks: Iterator[list[Row]]) -> Iterator[bytes]:
     stringio = io.StringIO()
     writer = csv.writer(stringio)
-    writer.writerow(table[0].keys())  # column headers
-    writer.writerows(table)
+    writer.writerow(first_row.keys())  # column headers
+    writer.writerow(first_row)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield stringio.getvalue().encode('utf-8')
+        stringio.seek(0)
+        stringio.truncate()
+    yield stringio.getvalue().encode('utf-8')
+
+
+def _gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(wbits=31)  # 31 = gzip container
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+
+def csv_response(class_name: str, kind: str, table: Cursor | Iterable[Row]) -> str | Response:
+    '''
+    Respond with the rows of `table` as a CSV file download.
+
+    The response is streamed: a cursor is read CHUNK_ROWS rows at a time as the
+    response is sent, so memory use does not grow with the size of the export.
+    It is gzip-compressed if the client accepts that and CSV_GZIP is set.
+    '''
+    chunks = _fetch_chunks(table)
+    first_chunk = next(chunks, None)
+    if not first_chunk:
+        flash("There are no rows to export yet.", "warning")
+        return render_template("error.html")
+
+    first_row, *rest = first_chunk
+    body = _csv_chunks(first_row, itertools.chain([rest], chunks))
+
+    use_gzip = current_app.config['CSV_GZIP'] and 'gzip' in request.accept_encodings
+    if use_gzip:
+        body = _gzip_chunks(body)
+
+    output = Response(stream_with_context(body), mimetype="text/csv")
+    if use_gzip:
+        output.headers["Content-Encoding"] = "gzip"
+    output.vary.add("Accept-Encoding")
 
-    output = make_response(stringio.getvalue())
     class_name = class_name.replace(" ","-")
     timestamp = dt.datetime.now().strftime("%Y%m%d")
     output.headers["Content-Disposition"] = f"attachment; filename={timestamp}_{class_name}_{kind}.csv"
-    output.headers["Content-type"] = "text/csv"
 
     return output
@@ -2,55 +2,462 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import atexit
 import errno
+import queue
+import re
 import secrets
 import sqlite3
 import string
-from collections.abc import Callable
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from collections.abc import Callable, Iterable
+from concurrent.futures import Future
 from getpass import getpass
 from importlib import resources
 from pathlib import Path
+from typing import Any, TypeVar
 
 import click
-from flask import current_app, g
+from flask import current_app, g, request
 from flask.app import Flask
+from flask.cli import with_appcontext
 from werkzeug.security import generate_password_hash
+from werkzeug.wrappers.response import Response
 
 AUTH_PROVIDER_LOCAL = 1
 
+T = TypeVar('T')
+
+
+class _ThreadMarker:
+    ''' Stored in a pool's thread-local data, so the pool is notified (via a
+    weakref finalizer) when a thread exits. '''
+
+
+class _ConnectionPool:
+    ''' A pool of SQLite connections: one per thread (and database), kept
+    open and reused across requests, with pragmas applied once when each is
+    opened.  (A connection must not be used by two threads at once, but WSGI
+    servers like Waitress reuse a fixed set of worker threads.)
+
+    A connection is checked out of the pool for the length of an app context
+    (a nested app context in the same thread gets a separate connection).
+    Read-only connections (see get_db_ro()) are pooled separately.
+    Idle connections are closed when their thread exits, and each thread
+    keeps idle connections to at most MAX_DATABASES databases, closing the
+    least recently used beyond that (e.g., as tests create many temporary
+    databases).
+    '''
+    MAX_DATABASES = 4
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {'opened': 0, 'reused': 0, 'closed': 0}
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def _close_all(self, conns: dict[tuple[str, bool], sqlite3.Connection]) -> None:
+        # Called when a thread exits, possibly from another thread
+        for conn in conns.values():
+            conn.close()
+        self._count('closed', len(conns))
+
+    def _thread_connections(self) -> dict[tuple[str, bool], sqlite3.Connection]:
+        conns: dict[tuple[str, bool], sqlite3.Connection] | None = getattr(self._local, 'conns', None)
+        if conns is None:
+            conns = self._local.conns = {}
+            self._local.marker = _ThreadMarker()
+            weakref.finalize(self._local.marker, self._close_all, conns)
+        return conns
+
+    def acquire(self, db_path: str, pragmas: dict[str, Any], readonly: bool = False) -> sqlite3.Connection:
+        idle = self._thread_connections()
+        conn = idle.pop((db_path, readonly), None)
+        if conn is None:
+            if readonly:
+                pragmas = pragmas | {'query_only': 'ON'}
+            # check_same_thread=False only so _close_all() can close it from another thread
+            conn = open_db(db_path, pragmas, check_same_thread=False)
+            self._count('opened')
+        else:
+            self._count('reused')
+        return conn
+
+    def release(self, db_path: str, conn: sqlite3.Connection, readonly: bool = False) -> None:
+        ''' Return a connection to the pool, discarding any uncommitted changes. '''
+        if conn.in_transaction:
+            conn.rollback()
+        idle = self._thread_connections()
+        key = (db_path, readonly)
+        if key in idle:
+            # An extra connection (from a nested app context); keep just one.
+            conn.close()
+            self._count('closed')
+            return
+        if len(idle) >= self.MAX_DATABASES:
+            oldest = next(iter(idle))
+            idle.pop(oldest).close()
+            self._count('closed')
+        idle[key] = conn
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['open'] = stats['opened'] - stats['closed']
+        return stats
+
+
+_pool = _ConnectionPool()
+
+
+class _Writer:
+    ''' A single thread that makes the writes submitted via run_write() and
+    queue_write(), so that request threads never wait on each other for
+    SQLite's write lock (and never get "database is locked" errors).
+
+    Writes are group-committed: the thread takes every write waiting in its
+    queue (up to MAX_BATCH), runs them in one transaction, each in its own
+    savepoint (so a failing write is rolled back alone), and commits them
+    together.  Under load, many small commits become one.
+
+    The thread keeps a connection (in autocommit mode, as it manages
+    transactions itself) to each of at most MAX_DATABASES databases.
+    '''
+    MAX_BATCH = 100
+    MAX_DATABASES = 4
+
+    def __init__(self) -> None:
+        self._queue: queue.SimpleQueue[tuple[str, dict[str, Any], Callable[[sqlite3.Connection], Any], Future[Any]] | None] = queue.SimpleQueue()
+        self._conns: OrderedDict[str, sqlite3.Connection] = OrderedDict()
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+        self._stats = {'writes': 0, 'failed': 0, 'commits': 0, 'max_batch': 0}
+
+    def submit(self, db_path: str, pragmas: dict[str, Any], func: Callable[[sqlite3.Connection], T]) -> Future[T]:
+        future: Future[T] = Future()
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gened-db-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((db_path, pragmas, func, future))
+        return future
+
+    def stop(self, timeout: float = 5) -> None:
+        ''' Finish all queued writes and stop the thread. '''
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def _connection(self, db_path: str, pragmas: dict[str, Any]) -> sqlite3.Connection:
+        conn = self._conns.pop(db_path, None)
+        if conn is None:
+            if len(self._conns) >= self.MAX_DATABASES:
+                _, oldest = self._conns.popitem(last=False)
+                oldest.close()
+            conn = open_db(db_path, pragmas)
+            conn.isolation_level = None
+        self._conns[db_path] = conn
+        return conn
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            batch = []
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.MAX_BATCH:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            by_db: dict[str, list[tuple[Callable[[sqlite3.Connection], Any], Future[Any]]]] = {}
+            pragmas = {}
+            for db_path, db_pragmas, func, future in batch:
+                by_db.setdefault(db_path, []).append((func, future))
+                pragmas[db_path] = db_pragmas
+            for db_path, writes in by_db.items():
+                self._commit(db_path, pragmas[db_path], writes)
+
+            if item is None:
+                # stop() was called; the sentinel comes after all earlier writes
+                for conn in self._conns.values():
+                    conn.close()
+                self._conns.clear()
+                return
+
+    def _commit(self, db_path: str, pragmas: dict[str, Any], writes: list[tuple[Callable[[sqlite3.Connection], Any], Future[Any]]]) -> None:
+        results: list[tuple[Future[Any], Any]] = []
+        failed = 0
+        try:
+            conn = self._connection(db_path, pragmas)
+            conn.execute("BEGIN IMMEDIATE")
+            for func, future in writes:
+                conn.execute("SAVEPOINT write")
+                try:
+                    result = func(conn)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    future.set_exception(e)
+                    failed += 1
+                else:
+                    conn.execute("RELEASE write")
+                    results.append((future, result))
+            conn.execute("COMMIT")
+        except Exception as e:
+            # The whole batch failed (e.g., the database could not be opened or locked)
+            open_conn = self._conns.get(db_path)
+            if open_conn is not None and open_conn.in_transaction:
+                open_conn.execute("ROLLBACK")
+            for _, future in writes:
+                if not future.done():
+                    future.set_exception(e)
+            failed = len(writes)
+            results = []
+
+        for future, result in results:
+            future.set_result(result)
+
+        with self._lock:
+            self._stats['writes'] += len(writes)
+            self._stats['failed'] += failed
+            self._stats['commits'] += 1
+            self._stats['max_batch'] = max(self._stats['max_batch'], len(writes))
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
+
+
+_writer = _Writer()
+atexit.register(_writer.stop)
+
+
+def open_db(db_path: str, pragmas: dict[str, Any], check_same_thread: bool = True) -> sqlite3.Connection:
+    ''' Open a new connection to the database, applying the given pragmas. '''
+    conn = sqlite3.connect(db_path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=check_same_thread)
+    conn.row_factory = sqlite3.Row
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name} = {value}")
+    return conn
+
+
+def _trace_queries(conn: sqlite3.Connection) -> None:
+    ''' If DB_COUNT_QUERIES is set, record each statement the connection
+    executes in this app context (see get_db_queries()). '''
+    if current_app.config['DB_COUNT_QUERIES']:
+        if 'db_queries' not in g:
+            g.db_queries = []
+        conn.set_trace_callback(g.db_queries.append)
+
+
+def get_db_queries() -> list[str]:
+    ''' The statements executed so far in this app context on get_db() and
+    get_db_ro() connections (not by the writer thread), if DB_COUNT_QUERIES
+    is set.  For checking the number of queries a request makes. '''
+    return g.get('db_queries', [])
+
 
 def get_db() -> sqlite3.Connection:
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        db_path = current_app.config['DATABASE']
+        pragmas = current_app.config['SQLITE_PRAGMAS']
+        if current_app.config['DB_POOL']:
+            g.db = _pool.acquire(db_path, pragmas)
+        else:
+            g.db = open_db(db_path, pragmas)
+        _trace_queries(g.db)
 
     assert isinstance(g.db, sqlite3.Connection)
     return g.db
 
 
+def get_db_ro() -> sqlite3.Connection:
+    ''' Get a read-only connection (PRAGMA query_only) for views that only
+    read, so they are never queued behind writes.  Separate from get_db()'s
+    connection, so it does not see that connection's uncommitted changes. '''
+    if 'db_ro' not in g:
+        db_path = current_app.config['DATABASE']
+        pragmas = current_app.config['SQLITE_PRAGMAS']
+        if current_app.config['DB_POOL']:
+            g.db_ro = _pool.acquire(db_path, pragmas, readonly=True)
+        else:
+            g.db_ro = open_db(db_path, pragmas | {'query_only': 'ON'})
+        _trace_queries(g.db_ro)
+
+    assert isinstance(g.db_ro, sqlite3.Connection)
+    return g.db_ro
+
+
+def run_write(func: Callable[[sqlite3.Connection], T]) -> T:
+    ''' Make a write to the database and commit it, returning func's result.
+
+    func is called with a connection (on which it should execute its writes,
+    but not commit) in the single writer thread (see _Writer), and this waits
+    until the write is committed.  Any exception func raises is re-raised
+    here (and its writes are rolled back).
+
+    The write is instead made directly on get_db()'s connection if DB_WRITER
+    is disabled or if that connection has uncommitted writes of its own
+    (which would hold the write lock the writer thread needs).
+    '''
+    if not current_app.config['DB_WRITER'] or ('db' in g and g.db.in_transaction):
+        db = get_db()
+        try:
+            result = func(db)
+        except Exception:
+            db.rollback()
+            raise
+        db.commit()
+        return result
+
+    future = _writer.submit(current_app.config['DATABASE'], current_app.config['SQLITE_PRAGMAS'], func)
+    return future.result()
+
+
+def queue_write(func: Callable[[sqlite3.Connection], Any]) -> None:
+    ''' Make a write to the database without waiting for it to be committed.
+
+    For writes whose result is not needed, such as logging.  Does not use the
+    request's connection, so it may be called from other threads in a copy of
+    the request's context (e.g., the LLM event loop thread).  A failed write
+    is logged.
+    '''
+    app = current_app._get_current_object()  # type: ignore[attr-defined]
+    db_path = app.config['DATABASE']
+    pragmas = app.config['SQLITE_PRAGMAS']
+
+    if not app.config['DB_WRITER']:
+        db = open_db(db_path, pragmas)
+        try:
+            with db:
+                func(db)
+        except sqlite3.Error as e:
+            app.logger.error(f"Database write failed: {e}")
+        finally:
+            db.close()
+        return
+
+    def log_error(future: Future[Any]) -> None:
+        e = future.exception()
+        if e is not None:
+            app.logger.error(f"Database write failed: {e}")
+
+    _writer.submit(db_path, pragmas, func).add_done_callback(log_error)
+
+
+def flush_writes(timeout: float = 5) -> None:
+    ''' Wait until all writes queued so far (in the writer thread) are committed. '''
+    if not current_app.config['DB_WRITER']:
+        return
+    future = _writer.submit(current_app.config['DATABASE'], current_app.config['SQLITE_PRAGMAS'], lambda db: None)
+    future.result(timeout)
+
+
+def get_db_pool_stats() -> dict[str, int]:
+    ''' Counts of pooled connections opened, reused, closed, and currently open. '''
+    return _pool.stats()
+
+
+def get_db_writer_stats() -> dict[str, int]:
+    ''' Counts of writes made and failed by the writer thread, the commits
+    they were grouped into, and the largest group. '''
+    return _writer.stats()
+
+
 def backup_db(target: str | Path) -> None:
     """ Safely make a backup of the database to the given path.
     target: str or any path-like object.  Must not exist yet or be empty.
+
+    Uses SQLite's online backup, copying BACKUP_STEP_PAGES pages at a time and
+    sleeping BACKUP_STEP_SLEEP seconds between steps, so a large database is
+    copied without holding up other requests' I/O.  In WAL mode, the copy is
+    made within one read transaction: writers are not blocked by it, and their
+    commits do not restart the copy (they are not part of it).
     """
     target = Path(target)
     if target.exists() and target.stat().st_size > 0:
         raise FileExistsError(errno.EEXIST, "File already exists or is not empty", target)
 
-    db = get_db()
-    tmp_db = sqlite3.connect(target)
-    with tmp_db:
-        db.backup(tmp_db)
-    tmp_db.close()
+    step_pages = current_app.config['BACKUP_STEP_PAGES']
+    step_sleep = current_app.config['BACKUP_STEP_SLEEP']
+
+    def progress(status: int, remaining: int, total: int) -> None:  # noqa: ARG001 - unused function argument
+        if remaining:
+            time.sleep(step_sleep)
+
+    # A connection of its own, as it may be in a transaction for a while
+    src = open_db(current_app.config['DATABASE'], current_app.config['SQLITE_PRAGMAS'])
+    try:
+        if src.execute("PRAGMA journal_mode").fetchone()[0] == 'wal':
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1")  # start the read transaction (snapshot) now
+        dest = sqlite3.connect(target)
+        try:
+            with dest:
+                src.backup(dest, pages=step_pages, progress=progress)
+        finally:
+            dest.close()
+    finally:
+        src.close()
 
 
 def close_db(e: BaseException | None = None) -> None:  # noqa: ARG001 - unused function argument
-    db = g.pop('db', None)
+    for name, readonly in [('db', False), ('db_ro', True)]:
+        db = g.pop(name, None)
+        if db is not None:
+            db.set_trace_callback(None)
+            if current_app.config['DB_POOL']:
+                _pool.release(current_app.config['DATABASE'], db, readonly=readonly)
+            else:
+                db.close()
+
+
+# SQL statements to be checked by `flask db-explain`, by name: (statement, tables it may scan)
+_explain_statements: dict[str, tuple[str, frozenset[str]]] = {}
+
+
+def register_sql(name: str, sql: str, allow_scan: Iterable[str] = ()) -> str:
+    ''' Register a SQL statement to be checked for full scans by `flask
+    db-explain`.  Returns the statement, so it can be defined and registered
+    in one place, e.g.: HISTORY_SQL = register_sql('history', "SELECT ...")
+
+    allow_scan: tables (or aliases) the statement is meant to scan in full,
+    such as the outer table of an admin listing of every class.
+    '''
+    _explain_statements[name] = (sql, frozenset(allow_scan))
+    return sql
+
 
-    if db is not None:
-        db.close()
+def explain_sql() -> list[tuple[str, list[str], list[str]]]:
+    ''' Run EXPLAIN QUERY PLAN on each registered statement, with NULL for
+    each parameter.  Returns a list of (name, plan lines, unexpected scans).
+    '''
+    db = get_db()
+    results = []
+    for name, (sql, allow_scan) in sorted(_explain_statements.items()):
+        rows = db.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count('?')).fetchall()
+        depths: dict[int, int] = {0: -1}
+        plan = []
+        scans = []
+        for row in rows:
+            depths[row['id']] = depths.get(row['parent'], -1) + 1
+            plan.append("  " * depths[row['id']] + row['detail'])
+            match = re.match(r"SCAN (\w+)", row['detail'])
+            if match and match[1] != 'CONSTANT' and match[1] not in allow_scan:
+                scans.append(match[1])
+        results.append((name, plan, scans))
+    return results
 
 
 # Functions to be called at the end of init_db().
@@ -91,6 +498,31 @@ def init_db_command() -> None:
     click.echo('Initialized the database.')
 
 
+@click.command('db-explain')
+@with_appcontext
+@click.option('--verbose', '-v', is_flag=True, help="Show the query plan of every statement, not just those with full scans.")
+def db_explain_command(verbose: bool) -> None:
+    """Check the query plans of registered SQL statements for full table scans.
+
+    Exits with status 1 if any statement scans a table it is not registered to scan.
+    """
+    flagged = 0
+    for name, plan, scans in explain_sql():
+        if scans:
+            flagged += 1
+            click.secho(f"{name}: full scan of {', '.join(scans)}", fg='red')
+        elif verbose:
+            click.secho(f"{name}: ok", fg='green')
+        if scans or verbose:
+            for line in plan:
+                click.echo(f"    {line}")
+
+    if flagged:
+        click.secho(f"{flagged} of {len(_explain_statements)} statements have full scans.", fg='red')
+        raise click.exceptions.Exit(1)
+    click.secho(f"No full scans in {len(_explain_statements)} statements.", fg='green')
+
+
 @click.command('newuser')
 @click.argument('username')
 @click.option('--admin', is_flag=True, help="Make the new user an admin.")
@@ -144,8 +576,16 @@ def setpassword_command(username: str) -> None:
     click.secho(f"Password updated for user {username}.", fg='green')
 
 
+def _log_query_count(response: Response) -> Response:
+    if current_app.config['DB_COUNT_QUERIES']:
+        current_app.logger.debug(f"{request.method} {request.path}: {len(get_db_queries())} database statements")
+    return response
+
+
 def init_app(app: Flask) -> None:
     app.teardown_appcontext(close_db)
+    app.after_request(_log_query_count)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(db_explain_command)
     app.cli.add_command(newuser_command)
     app.cli.add_command(setpassword_command)
@@ -8,6 +8,8 @@ from pathlib import Path
 from flask import Blueprint, abort, current_app, render_template
 from markdown import Markdown
 
+from .filters import get_markdown_processor
+
 bp = Blueprint('docs', __name__, url_prefix="/docs", template_folder='templates')
 
 
@@ -25,7 +27,7 @@ def _process_doc(md: Markdown, docfile_path: Path) -> Document:
     return a Document for that page.
     '''
     md_text = docfile_path.read_text()
-    html = md.convert(md_text)
+    html = md.reset().convert(md_text)
     metadata = md.Meta  # type: ignore[attr-defined] # https://python-markdown.github.io/extensions/meta_data/
 
     title = metadata['title'][0]
@@ -45,7 +47,7 @@ def main() -> str:
     docs_dir = current_app.config.get('DOCS_DIR')
     assert docs_dir  # base.py shouldn't load this blueprint if we have no documentation directory configured
 
-    md = current_app.markdown_processor  # type: ignore[attr-defined]
+    md = get_markdown_processor()
 
     docs_pages = []
     for md_file in docs_dir.glob("*.md"):
@@ -81,6 +83,6 @@ def page(name: str) -> str:
     with full_path.open() as file:
         md_content = file.read()
 
-    html_content = current_app.markdown_processor.convert(md_content)  # type: ignore[attr-defined]
+    html_content = get_markdown_processor().reset().convert(md_content)
 
     return render_template('docs_page.html', html_content=html_content)
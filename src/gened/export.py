@@ -0,0 +1,425 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+# Bulk export of queries, tutor chats (with each chat's messages as rows of
+# their own), and usage data for analytics, as newline-delimited JSON or
+# Parquet.  Available as an admin page (one dataset per download) and as the
+# `flask export` command, which writes every dataset into a directory,
+# partitioned by month where a dataset has a time, and can export
+# incrementally (rows with ids after the last export's).
+#
+# Rows are read from a cursor in chunks and written as they are read, so
+# memory use does not depend on the size of the database.
+
+import datetime as dt
+import json
+import sqlite3
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any
+
+import click
+from flask import abort, current_app, render_template, request, send_file, stream_with_context
+from flask.app import Flask
+from flask.cli import with_appcontext
+from werkzeug.wrappers.response import Response
+
+from .admin import bp as bp_admin
+from .admin import register_admin_link
+from .db import get_db_ro
+
+FORMATS = ('jsonl', 'parquet')
+CHUNK_ROWS = 1000  # rows fetched from the database at a time
+PARQUET_ROW_GROUP_ROWS = 10_000  # rows buffered per Parquet row group (per partition)
+STATE_FILE = 'export_state.json'  # last exported ids, in an export directory
+
+
+class ExportError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class Dataset:
+    name: str
+    table: str  # the table the rows come from; the dataset is only available if it exists
+    sql: str  # rows in id order, with one parameter (the "since" id) if id_column is set
+    id_column: str | None  # result column compared to "since" in incremental exports; None = always exported in full
+    partition_by: str | None = None  # result column giving each row's partition (not included in the rows themselves)
+    json_columns: tuple[str, ...] = ()  # columns holding JSON text, decoded in JSONL exports
+    column_types: dict[str, str] = field(default_factory=dict)  # declared types of columns not in `table`
+
+
+DATASETS = [
+    Dataset(
+        name='queries',
+        table='queries',
+        sql="""
+            SELECT strftime('%Y-%m', queries.query_time) AS month, queries.*, roles.class_id
+            FROM queries
+            LEFT JOIN roles ON roles.id=queries.role_id
+            WHERE queries.id > ?
+            ORDER BY queries.id
+        """,
+        id_column='id',
+        partition_by='month',
+        json_columns=('response_json', 'response_text', 'topics_json'),
+        column_types={'class_id': 'INTEGER'},
+    ),
+    Dataset(
+        name='tutor_chats',
+        table='tutor_chats',
+        sql="""
+            SELECT
+                tutor_chats.id,
+                tutor_chats.topic,
+                tutor_chats.context,
+                tutor_chats.user_id,
+                tutor_chats.role_id,
+                roles.class_id,
+                json_array_length(tutor_chats.chat_json) AS num_messages
+            FROM tutor_chats
+            LEFT JOIN roles ON roles.id=tutor_chats.role_id
+            WHERE tutor_chats.id > ?
+            ORDER BY tutor_chats.id
+        """,
+        id_column='id',
+        column_types={'class_id': 'INTEGER', 'num_messages': 'INTEGER'},
+    ),
+    # Each tutor chat's chat_json exploded into one row per message.  (Messages
+    # added to a chat after it has been exported are not picked up by later
+    # incremental exports, which only include chats with newer ids.)
+    Dataset(
+        name='tutor_chat_messages',
+        table='tutor_chats',
+        sql="""
+            SELECT
+                tutor_chats.id AS chat_id,
+                CAST(json_each.key AS INTEGER) AS seq,
+                json_extract(json_each.value, '$.role') AS role,
+                json_extract(json_each.value, '$.content') AS content,
+                tutor_chats.user_id,
+                roles.class_id
+            FROM tutor_chats
+            JOIN json_each(tutor_chats.chat_json)
+            LEFT JOIN roles ON roles.id=tutor_chats.role_id
+            WHERE tutor_chats.id > ?
+            ORDER BY tutor_chats.id, json_each.key
+        """,
+        id_column='chat_id',
+        column_types={'chat_id': 'INTEGER', 'seq': 'INTEGER', 'role': 'TEXT', 'content': 'TEXT', 'class_id': 'INTEGER'},
+    ),
+    Dataset(
+        name='llm_calls',
+        table='llm_calls',
+        sql="""
+            SELECT strftime('%Y-%m', call_time) AS month, *
+            FROM llm_calls
+            WHERE id > ?
+            ORDER BY id
+        """,
+        id_column='id',
+        partition_by='month',
+    ),
+    Dataset(
+        name='user_query_counts',
+        table='user_query_counts',
+        sql="SELECT * FROM user_query_counts ORDER BY user_id, day",
+        id_column=None,
+    ),
+    Dataset(
+        name='role_query_counts',
+        table='role_query_counts',
+        sql="SELECT * FROM role_query_counts ORDER BY role_id, day",
+        id_column=None,
+    ),
+]
+_datasets_by_name = {dataset.name: dataset for dataset in DATASETS}
+
+
+def get_datasets(db: sqlite3.Connection) -> list[Dataset]:
+    ''' The datasets available in this application's database. '''
+    tables = {row[0] for row in db.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+    return [dataset for dataset in DATASETS if dataset.table in tables]
+
+
+def get_dataset(db: sqlite3.Connection, name: str) -> Dataset:
+    dataset = _datasets_by_name.get(name)
+    if dataset is None or dataset not in get_datasets(db):
+        raise ExportError(f"Unknown dataset: {name}")
+    return dataset
+
+
+def _iter_rows(db: sqlite3.Connection, dataset: Dataset, since: int) -> Iterator[tuple[str | None, dict[str, Any]]]:
+    ''' Yield (partition, row) for each row of the dataset after id `since`. '''
+    params = [since] if dataset.id_column else []
+    cur = db.execute(dataset.sql, params)
+    while rows := cur.fetchmany(CHUNK_ROWS):
+        for row in rows:
+            row_dict = dict(row)
+            partition = row_dict.pop(dataset.partition_by) if dataset.partition_by else None
+            yield partition, row_dict
+
+
+def _json_default(value: Any) -> str:
+    if isinstance(value, dt.date | dt.datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _jsonl_line(dataset: Dataset, row: dict[str, Any]) -> str:
+    for col in dataset.json_columns:
+        if row.get(col):
+            try:
+                row[col] = json.loads(row[col])
+            except json.JSONDecodeError:
+                pass  # leave it as text
+    return json.dumps(row, default=_json_default) + "\n"
+
+
+def _import_pyarrow() -> tuple[Any, Any]:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ExportError("Parquet export requires pyarrow (pip install pyarrow).") from None
+    return pa, pq
+
+
+def _arrow_schema(db: sqlite3.Connection, dataset: Dataset, columns: list[str]) -> Any:
+    ''' An Arrow schema for the dataset's columns, from their declared types in SQLite. '''
+    pa, _ = _import_pyarrow()
+    declared = {row['name']: row['type'].upper() for row in db.execute(f"PRAGMA table_xinfo({dataset.table})")}
+    declared |= dataset.column_types
+
+    def arrow_type(decl: str) -> Any:
+        if 'INT' in decl or 'BOOL' in decl:
+            return pa.int64()
+        if 'REAL' in decl or 'FLOA' in decl or 'DOUB' in decl:
+            return pa.float64()
+        if 'TIMESTAMP' in decl:
+            return pa.timestamp('us')  # values are datetimes (see PARSE_DECLTYPES in gened.db)
+        if decl == 'DATE':
+            return pa.date32()
+        return pa.string()
+
+    return pa.schema([(col, arrow_type(declared.get(col, 'TEXT'))) for col in columns])
+
+
+def _result_columns(db: sqlite3.Connection, dataset: Dataset) -> list[str]:
+    params = [0] if dataset.id_column else []
+    cur = db.execute(f"SELECT * FROM ({dataset.sql}) LIMIT 0", params)
+    return [d[0] for d in cur.description if d[0] != dataset.partition_by]
+
+
+class _ParquetWriters:
+    ''' Parquet files, one per partition, written in row groups of buffered rows. '''
+    def __init__(self, schema: Any) -> None:
+        self._pa, self._pq = _import_pyarrow()
+        self._schema = schema
+        self._writers: dict[Path, Any] = {}
+        self._buffers: dict[Path, list[dict[str, Any]]] = {}
+
+    def write(self, path: Path | str, row: dict[str, Any]) -> None:
+        path = Path(path)
+        buffer = self._buffers.setdefault(path, [])
+        buffer.append(row)
+        if len(buffer) >= PARQUET_ROW_GROUP_ROWS:
+            self._flush(path)
+
+    def touch(self, path: Path | str) -> None:
+        ''' Write the file at path on close even if it gets no rows. '''
+        self._buffers.setdefault(Path(path), [])
+
+    def _flush(self, path: Path) -> None:
+        buffer = self._buffers[path]
+        if not buffer and path in self._writers:
+            return
+        if path not in self._writers:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._writers[path] = self._pq.ParquetWriter(path, self._schema)
+        self._writers[path].write_table(self._pa.Table.from_pylist(buffer, schema=self._schema))
+        buffer.clear()
+
+    def close(self) -> None:
+        for path in self._buffers:
+            self._flush(path)
+        for writer in self._writers.values():
+            writer.close()
+
+
+@dataclass
+class ExportResult:
+    rows: int = 0
+    last_id: int | None = None
+    files: set[Path] = field(default_factory=set)
+
+
+def export_dataset(db: sqlite3.Connection, dataset: Dataset, out_dir: Path, fmt: str, since: int = 0) -> ExportResult:
+    '''
+    Write the dataset's rows with ids after `since` (or all of its rows, if it
+    has no id_column) into out_dir/<dataset name>/, in one file per partition
+    (in hive-style directories, e.g. month=2024-03/).  Files are named for the
+    first id they could contain, so an incremental export adds new files
+    alongside those of earlier exports.
+    '''
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format: {fmt}")
+
+    base_dir = out_dir / dataset.name
+    filename = f"part-from-{since + 1}.{fmt}" if dataset.id_column else f"data.{fmt}"
+    result = ExportResult()
+
+    def path_for(partition: str | None) -> Path:
+        if partition is None:
+            return base_dir / filename
+        return base_dir / f"{dataset.partition_by}={partition}" / filename
+
+    if fmt == 'parquet':
+        writers = _ParquetWriters(_arrow_schema(db, dataset, _result_columns(db, dataset)))
+        try:
+            for partition, row in _iter_rows(db, dataset, since):
+                path = path_for(partition)
+                writers.write(path, row)
+                result.files.add(path)
+                result.rows += 1
+                if dataset.id_column:
+                    result.last_id = row[dataset.id_column]
+        finally:
+            writers.close()
+
+    else:
+        files: dict[Path, Any] = {}
+        try:
+            for partition, row in _iter_rows(db, dataset, since):
+                path = path_for(partition)
+                if path not in files:
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    files[path] = path.open('w', encoding='utf-8')
+                if dataset.id_column:
+                    result.last_id = row[dataset.id_column]
+                files[path].write(_jsonl_line(dataset, row))
+                result.rows += 1
+        finally:
+            for f in files.values():
+                f.close()
+        result.files = set(files)
+
+    return result
+
+
+def _load_state(out_dir: Path) -> dict[str, int]:
+    state_path = out_dir / STATE_FILE
+    if not state_path.exists():
+        return {}
+    with state_path.open() as f:
+        state: dict[str, int] = json.load(f)
+    return state
+
+
+def _save_state(out_dir: Path, state: dict[str, int]) -> None:
+    with (out_dir / STATE_FILE).open('w') as f:
+        json.dump(state, f, indent=2)
+
+
+@click.command('export')
+@click.argument('out_dir', type=click.Path(file_okay=False, path_type=Path))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default='jsonl', show_default=True, help="Output format.")
+@click.option('--dataset', '-d', 'names', multiple=True, help="Dataset to export (repeatable; default: all).")
+@click.option('--since', type=int, help="Export only rows with ids greater than this.")
+@click.option('--incremental', is_flag=True, help=f"Export only rows added since the last export into OUT_DIR (recorded in OUT_DIR/{STATE_FILE}).")
+@with_appcontext
+def export_command(out_dir: Path, fmt: str, names: tuple[str, ...], since: int | None, incremental: bool) -> None:
+    """Export queries, tutor chats, and usage data for analytics.
+
+    Each dataset is written to OUT_DIR/<dataset>/, partitioned by month where
+    it has a time.  Datasets without ids (the usage rollups) are always
+    exported in full.
+    """
+    if since is not None and incremental:
+        raise click.UsageError("--since and --incremental cannot be combined.")
+
+    db = get_db_ro()
+    try:
+        datasets = [get_dataset(db, name) for name in names] if names else get_datasets(db)
+    except ExportError as e:
+        raise click.UsageError(str(e)) from None
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    state = _load_state(out_dir)
+
+    for dataset in datasets:
+        dataset_since = since or 0
+        if incremental and dataset.id_column:
+            dataset_since = state.get(dataset.name, 0)
+        try:
+            result = export_dataset(db, dataset, out_dir, fmt, dataset_since)
+        except ExportError as e:
+            raise click.ClickException(str(e)) from None
+
+        if dataset.id_column:
+            state[dataset.name] = max(state.get(dataset.name, 0), result.last_id or dataset_since)
+            since_text = f" after id {dataset_since}" if dataset_since else ""
+            click.echo(f"{dataset.name}: {result.rows} rows{since_text} in {len(result.files)} files (last id {state[dataset.name]})")
+        else:
+            click.echo(f"{dataset.name}: {result.rows} rows")
+
+    _save_state(out_dir, state)
+
+
+def init_app(app: Flask) -> None:
+    app.cli.add_command(export_command)
+
+
+@register_admin_link("Export")
+@bp_admin.route("/export/")
+def export_view() -> str:
+    db = get_db_ro()
+    datasets = []
+    for dataset in get_datasets(db):
+        last_id = None
+        if dataset.id_column:
+            last_id = db.execute(f"SELECT MAX(id) FROM {dataset.table}").fetchone()[0]
+        datasets.append({'name': dataset.name, 'incremental': dataset.id_column is not None, 'last_id': last_id})
+    return render_template("admin_export.html", datasets=datasets, formats=FORMATS)
+
+
+@bp_admin.route("/export/download")
+def export_download() -> Response:
+    db = get_db_ro()
+    fmt = request.args.get('format', 'jsonl')
+    since = request.args.get('since', 0, type=int)
+    try:
+        dataset = get_dataset(db, request.args.get('dataset', ''))
+    except ExportError:
+        return abort(404)
+    if fmt not in FORMATS:
+        return abort(404)
+
+    db_basename = Path(current_app.config['DATABASE_NAME']).stem
+    since_text = f"_since{since}" if since and dataset.id_column else ""
+    dl_name = f"{db_basename}_{dataset.name}{since_text}_{dt.date.today().strftime('%Y%m%d')}.{fmt}"
+
+    if fmt == 'jsonl':
+        # stream it
+        lines = (_jsonl_line(dataset, row) for _, row in _iter_rows(db, dataset, since))
+        response = Response(stream_with_context(lines), mimetype='application/x-ndjson')
+        response.headers["Content-Disposition"] = f"attachment; filename={dl_name}"
+        return response
+
+    else:
+        # Parquet files are written whole (the footer comes last), so write a single, unpartitioned file to send.
+        try:
+            writers = _ParquetWriters(_arrow_schema(db, dataset, _result_columns(db, dataset)))
+        except ExportError as e:
+            return abort(501, str(e))
+        tmpfile = NamedTemporaryFile(suffix=".parquet")
+        writers.touch(tmpfile.name)
+        try:
+            for _, row in _iter_rows(db, dataset, since):
+                writers.write(tmpfile.name, row)
+        finally:
+            writers.close()
+        return send_file(tmpfile, mimetype='application/vnd.apache.parquet', as_attachment=True, download_name=dl_name)
@@ -2,20 +2,73 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import hashlib
 import json
+import threading
+from collections import OrderedDict
 from collections.abc import Callable, Generator
 from sqlite3 import Row
 from typing import Any
 
 import markupsafe
 import mdx_truly_sane_lists
-from flask import url_for
+from flask import current_app, url_for
 from flask.app import Flask
 from markdown import Markdown
 from markdown import util as md_util
 from markdown.extensions import fenced_code, meta, smarty
 
 
+# Python-Markdown processors keep state while converting, so one must not be
+# used by two threads at once: each thread gets its own (see
+# get_markdown_processor()).
+_markdown_local = threading.local()
+
+# Rendered Markdown, keyed by a hash of its (escaped) source text, so stored
+# responses and chat messages are converted once rather than on every page
+# view.  An LRU cache of at most MARKDOWN_CACHE_SIZE entries.
+_markdown_cache: OrderedDict[bytes, str] = OrderedDict()
+_markdown_cache_lock = threading.Lock()
+
+
+def _make_markdown_processor() -> Markdown:
+    markdown_extensions = [
+        fenced_code.makeExtension(),
+        meta.makeExtension(),
+        #sane_lists.makeExtension(),
+        mdx_truly_sane_lists.makeExtension(),
+        smarty.makeExtension(),
+    ]
+    return Markdown(output_format="html", extensions=markdown_extensions)
+
+
+def get_markdown_processor() -> Markdown:
+    ''' Get this thread's Markdown processor (created on first use, then reused). '''
+    md = getattr(_markdown_local, 'md', None)
+    if md is None:
+        md = _markdown_local.md = _make_markdown_processor()
+    return md
+
+
+def render_markdown(text: str) -> str:
+    ''' Convert Markdown to HTML, reusing the result of any earlier conversion of the same text. '''
+    key = hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+    with _markdown_cache_lock:
+        html = _markdown_cache.get(key)
+        if html is not None:
+            _markdown_cache.move_to_end(key)
+            return html
+
+    html = get_markdown_processor().reset().convert(text)
+
+    max_size = current_app.config['MARKDOWN_CACHE_SIZE']
+    with _markdown_cache_lock:
+        _markdown_cache[key] = html
+        while len(_markdown_cache) > max_size:
+            _markdown_cache.popitem(last=False)
+    return html
+
+
 def make_titled_span(title: str, text: str) -> str:
     title = title.replace('\n', markupsafe.Markup('&#13;'))
     title = title.replace('\'', markupsafe.Markup('&#39;'))
@@ -68,23 +121,12 @@ def init_app(app: Flask) -> None:
     # code or not, so...
     md_util.code_escape = lambda text: text
     fenced_code.FencedBlockPreprocessor._escape = lambda self, text: text  # type: ignore[attr-defined]
-    # only configure/init these once, not every time the filter is called
-    markdown_extensions = [
-        fenced_code.makeExtension(),
-        meta.makeExtension(),
-        #sane_lists.makeExtension(),
-        mdx_truly_sane_lists.makeExtension(),
-        smarty.makeExtension(),
-    ]
-    markdown_processor = Markdown(output_format="html", extensions=markdown_extensions)
-    # make available to request handlers, not just as a Jinja filter
-    app.markdown_processor = markdown_processor  # type: ignore[attr-defined]
 
     @app.template_filter('markdown')
     def markdown_filter(value: str) -> str:
         '''Convert markdown to HTML (after escaping).'''
         escaped = jinja_escape(value)
-        html = markdown_processor.reset().convert(escaped)
+        html = render_markdown(escaped)
         return markupsafe.Markup(html)
 
     # Jinja filter for displaying users w/ dynamic info popups in datatables
@@ -110,11 +152,12 @@ def init_app(app: Flask) -> None:
         html = f"{display_name} <span class='is-size-7 has-text-grey' title='{extra_info}'>({auth_provider})</span>"
         return markupsafe.Markup(html)
 
-    # If I ever want to use it...  Testing (10x repeating render_template
-    # on a large instructor view page) yielded no appreciable speedup
-    # over existing tables.html macro.
+    # Renders cells as the tables.html macro does, for the rows of paged
+    # tables fetched as JSON (see gened.queries.page_json()).
+    # Testing (10x repeating render_template on a large instructor view page)
+    # yielded no appreciable speedup over the tables.html macro itself.
     #
-    # Usage would be:
+    # Usage in a template would be:
     #  {% set builder = columns | row_builder(edit_handler) %}
     #  {% for row in data %}
     #    <tr>
@@ -141,9 +184,9 @@ def init_app(app: Flask) -> None:
         filters = [filter_for(col) for col in col_names]
 
         if edit_handler:
-            filters.append(lambda r: f"""
+            filters.append(lambda r: markupsafe.Markup(f"""
             <a class="button is-warning is-small p-2" href="{ url_for(edit_handler, id=r['id'])}">Edit</a>
-            """)
+            """))
 
         def doit(row: Row) -> Generator[str, None, None]:
             for filt in filters:
@@ -3,7 +3,8 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import datetime as dt
-from sqlite3 import Row
+from sqlite3 import Cursor, Row
+from typing import Any
 
 from flask import (
     Blueprint,
@@ -15,64 +16,83 @@ from flask import (
 )
 from werkzeug.wrappers.response import Response
 
-from .auth import get_auth, instructor_required
+from .auth import get_auth, instructor_required, invalidate_auth
 from .csv import csv_response
-from .db import get_db
+from .db import get_db, get_db_ro, register_sql
+from .llm_config import invalidate_llm_config
+from .queries import QueriesPage, get_page_args, get_queries_page, page_json
+from .rate_limit import parse_rate_limits
 
 bp = Blueprint('instructor', __name__, url_prefix="/instructor", template_folder='templates')
 
-
-def get_queries(class_id: int, user: int | None = None) -> list[Row]:
-    db = get_db()
-
-    where_clause = "WHERE roles.class_id=?"
+QUERIES_SQL = """
+    SELECT
+        queries.id,
+        users.display_name,
+        users.email,
+        queries.*
+    FROM queries
+    JOIN users
+        ON queries.user_id=users.id
+    JOIN roles
+        ON queries.role_id=roles.id
+    {where_clause}
+"""
+register_sql('instructor_queries', QUERIES_SQL.format(where_clause="WHERE roles.class_id=?") + " ORDER BY query_time DESC")
+register_sql('instructor_queries_page', QUERIES_SQL.format(where_clause="WHERE roles.class_id=? AND (queries.query_time, queries.id) < (?, ?)")
+             + " ORDER BY queries.query_time DESC, queries.id DESC LIMIT ?")
+register_sql('instructor_user_queries_page', QUERIES_SQL.format(where_clause="WHERE roles.class_id=? AND users.id=? AND (queries.query_time, queries.id) < (?, ?)")
+             + " ORDER BY queries.query_time DESC, queries.id DESC LIMIT ?")
+
+USERS_SQL = """
+    SELECT
+        {role_id_column}
+        users.id,
+        users.display_name,
+        users.email,
+        auth_providers.name AS auth_provider,
+        users.auth_name,
+        COALESCE(SUM(role_query_totals.count), 0) AS num_queries,
+        SUM((SELECT COALESCE(SUM(count), 0) FROM role_query_counts WHERE role_id=roles.id AND day >= date('now', '-7 days'))) AS num_recent_queries,
+        roles.active,
+        roles.role = "instructor" AS instructor_role
+    FROM users
+    LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
+    JOIN roles ON roles.user_id=users.id
+    LEFT JOIN role_query_totals ON role_query_totals.role_id=roles.id
+    WHERE roles.class_id=?
+    GROUP BY users.id
+    ORDER BY display_name
+"""
+register_sql('instructor_users', USERS_SQL.format(role_id_column="roles.id AS role_id,"))
+
+
+def get_queries(class_id: int) -> Cursor:
+    ''' All of a class's queries, as a cursor to be read incrementally (e.g., for export). '''
+    db = get_db_ro()
+
+    return db.execute(QUERIES_SQL.format(where_clause="WHERE roles.class_id=?") + " ORDER BY query_time DESC", [class_id])
+
+
+def get_queries_paged(class_id: int, user: int | None = None, **page_args: Any) -> QueriesPage:
+    conditions = ["roles.class_id=?"]
     params = [class_id]
 
     if user is not None:
-        where_clause += " AND users.id=?"
-        params += [user]
-
-    queries = db.execute(f"""
-        SELECT
-            queries.id,
-            users.display_name,
-            users.email,
-            queries.*
-        FROM queries
-        JOIN users
-            ON queries.user_id=users.id
-        JOIN roles
-            ON queries.role_id=roles.id
-        {where_clause}
-        ORDER BY query_time DESC
-    """, params).fetchall()
-
-    return queries
+        conditions.append("users.id=?")
+        params.append(user)
+
+    try:
+        return get_queries_page(QUERIES_SQL, conditions, params, **page_args)
+    except ValueError:
+        return abort(400)  # invalid cursor
 
 
 def get_users(class_id: int, for_export: bool = False) -> list[Row]:
-    db = get_db()
+    db = get_db_ro()
 
-    users = db.execute(f"""
-        SELECT
-            {'roles.id AS role_id,' if not for_export else ''}
-            users.id,
-            users.display_name,
-            users.email,
-            auth_providers.name AS auth_provider,
-            users.auth_name,
-            COUNT(queries.id) AS num_queries,
-            SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries,
-            roles.active,
-            roles.role = "instructor" AS instructor_role
-        FROM users
-        LEFT JOIN auth_providers ON users.auth_provider=auth_providers.id
-        JOIN roles ON roles.user_id=users.id
-        LEFT JOIN queries ON queries.role_id=roles.id
-        WHERE roles.class_id=?
-        GROUP BY users.id
-        ORDER BY display_name
-    """, [class_id]).fetchall()
+    role_id_column = 'roles.id AS role_id,' if not for_export else ''
+    users = db.execute(USERS_SQL.format(role_id_column=role_id_column), [class_id]).fetchall()
 
     return users
 
@@ -93,9 +113,21 @@ def main() -> str | Response:
         if sel_user_row:
             sel_user_name = sel_user_row['display_name']
 
-    queries = get_queries(class_id, sel_user_id)
+    page = get_queries_paged(class_id, sel_user_id)
+
+    return render_template("instructor.html", users=users, queries=page.rows, next_cursor=page.next_cursor, user=sel_user_name, sel_user_id=sel_user_id)
+
+
+@bp.route("/queries.json")
+@instructor_required
+def get_queries_json() -> Response:
+    auth = get_auth()
+    class_id = auth['class_id']
+    assert class_id is not None
+
+    page = get_queries_paged(class_id, request.args.get('user', type=int), **get_page_args())
 
-    return render_template("instructor.html", users=users, queries=queries, user=sel_user_name)
+    return page_json(page)
 
 
 @bp.route("/csv/<string:kind>")
@@ -110,6 +142,7 @@ def get_csv(kind: str) -> str | Response:
     assert class_id is not None
     assert class_name is not None
 
+    table: Cursor | list[Row]
     if kind == "queries":
         table = get_queries(class_id)
     elif kind == "users":
@@ -130,6 +163,7 @@ def set_user_class_setting() -> Response:
     if 'clear_openai_key' in request.form:
         db.execute("UPDATE classes_user SET openai_key='' WHERE class_id=?", [class_id])
         db.commit()
+        invalidate_llm_config(class_id)
         flash("Class API key cleared.", "success")
 
     elif 'save_access_form' in request.form:
@@ -146,13 +180,23 @@ def set_user_class_setting() -> Response:
         class_enabled = 1 if 'class_enabled' in request.form else 0
         db.execute("UPDATE classes SET enabled=? WHERE id=?", [class_enabled, class_id])
         db.commit()
+        invalidate_llm_config(class_id)
+        invalidate_auth()  # the class's enabled status is in all of its users' auth data
         flash("Class access configuration updated.", "success")
 
     elif 'save_llm_form' in request.form:
+        try:
+            rpm, tpm = parse_rate_limits(request.form)
+        except ValueError:
+            flash("Rate limits must be positive whole numbers, or blank for no limit.", "warning")
+            return redirect(request.referrer)
         if 'openai_key' in request.form:
             db.execute("UPDATE classes_user SET openai_key=? WHERE class_id=?", [request.form['openai_key'], class_id])
         db.execute("UPDATE classes_user SET model_id=? WHERE class_id=?", [request.form['model_id'], class_id])
+        # blank = no limit
+        db.execute("UPDATE classes_user SET rate_limit_rpm=?, rate_limit_tpm=? WHERE class_id=?", [rpm, tpm, class_id])
         db.commit()
+        invalidate_llm_config(class_id)
         flash("Class language model configuration updated.", "success")
 
     return redirect(request.referrer)
@@ -174,8 +218,10 @@ def set_role_active(role_id: int, bool_active: int) -> str:
     # only trust class_id from auth, not from user
     class_id = auth['class_id']
 
-    db.execute("UPDATE roles SET active=? WHERE id=? AND class_id=?", [bool_active, role_id, class_id])
+    role_row = db.execute("UPDATE roles SET active=? WHERE id=? AND class_id=? RETURNING user_id", [bool_active, role_id, class_id]).fetchone()
     db.commit()
+    if role_row:
+        invalidate_auth(role_row['user_id'])
 
     return "okay"
 
@@ -198,7 +244,9 @@ def set_role_instructor(role_id: int, bool_instructor: int) -> str:
 
     new_role = 'instructor' if bool_instructor else 'student'
 
-    db.execute("UPDATE roles SET role=? WHERE id=? AND class_id=?", [new_role, role_id, class_id])
+    role_row = db.execute("UPDATE roles SET role=? WHERE id=? AND class_id=? RETURNING user_id", [new_role, role_id, class_id]).fetchone()
     db.commit()
+    if role_row:
+        invalidate_auth(role_row['user_id'])
 
     return "okay"
@@ -0,0 +1,174 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+import threading
+import time
+from collections.abc import Callable, Coroutine
+from dataclasses import dataclass
+from typing import Any, TypeVar
+
+from flask import current_app, render_template
+
+from .admin import bp as bp_admin
+from .admin import register_admin_link
+from .llm_config import api_key_id
+from .openai import submit_async
+from .rate_limit import concurrency_slot, get_rate_limit_stats
+
+# Background jobs for LLM work, so that request threads (of which a WSGI
+# server like Waitress has a small, fixed number) are not held for the
+# duration of a completion.
+#
+# A view enqueues a job and returns right away; the job's coroutine runs on
+# the persistent LLM event loop (see gened.openai), and its result is then
+# passed to a callback that runs in a worker thread with a fresh application
+# context (so it can use get_db(), but not get_auth()).  Pages poll
+# is_job_pending() (or a status route built on it) until the job is done.
+#
+# Each running job holds one of its API key's LLM_CONCURRENCY_PER_KEY
+# concurrency slots (see gened.rate_limit), shared with calls made outside of
+# jobs; further jobs for that key wait in a queue.  Jobs are kept in memory,
+# so they are lost if the process exits, and their status is only visible to
+# the process running them.
+
+R = TypeVar('R')
+
+
+@dataclass
+class _Job:
+    key_id: str
+    running: bool = False
+    progress: str = ""
+
+
+class _JobQueue:
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._jobs: dict[str, _Job] = {}
+        self._completed = 0
+        self._max_depth = 0
+
+    def enqueue(self, name: str, api_key: str, coro: Coroutine[Any, Any, R], on_result: Callable[[R], None]) -> None:
+        app = current_app._get_current_object()  # type: ignore[attr-defined]
+
+        with self._cond:
+            if name in self._jobs:
+                coro.close()
+                return  # already queued or running
+            self._jobs[name] = _Job(key_id=api_key_id(api_key))
+            self._max_depth = max(self._max_depth, self.queue_depth())
+
+        def complete(result: R) -> None:
+            with app.app_context():
+                on_result(result)
+
+        async def run() -> None:
+            try:
+                async with concurrency_slot(api_key, None):  # (waits as long as needed)
+                    with self._cond:
+                        self._jobs[name].running = True
+                    result = await coro
+                await asyncio.to_thread(complete, result)
+            except Exception as e:
+                app.logger.exception(f"Background job {name} failed: {e}")
+            finally:
+                with self._cond:
+                    del self._jobs[name]
+                    self._completed += 1
+                    self._cond.notify_all()
+
+        submit_async(run())
+
+    def is_pending(self, name: str) -> bool:
+        with self._cond:
+            return name in self._jobs
+
+    def set_progress(self, name: str, progress: str) -> None:
+        with self._cond:
+            if name in self._jobs:
+                self._jobs[name].progress = progress
+
+    def get_progress(self, name: str) -> str | None:
+        with self._cond:
+            job = self._jobs.get(name)
+            return job.progress if job else None
+
+    def queue_depth(self) -> int:
+        ''' Number of jobs waiting to run (not including those running). '''
+        with self._cond:
+            return sum(1 for job in self._jobs.values() if not job.running)
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            by_key: dict[str, dict[str, int]] = {}
+            for job in self._jobs.values():
+                counts = by_key.setdefault(job.key_id, {'queued': 0, 'running': 0})
+                counts['running' if job.running else 'queued'] += 1
+            return {
+                'queued': sum(counts['queued'] for counts in by_key.values()),
+                'running': sum(counts['running'] for counts in by_key.values()),
+                'completed': self._completed,
+                'max_depth': self._max_depth,
+                'by_key': by_key,
+            }
+
+    def wait(self, timeout: float | None = None) -> bool:
+        ''' Wait until no jobs are queued or running.  Returns False on timeout. '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._jobs:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+
+_queue = _JobQueue()
+
+
+def jobs_enabled() -> bool:
+    return bool(current_app.config['BACKGROUND_JOBS'])
+
+
+def enqueue_job(name: str, api_key: str, coro: Coroutine[Any, Any, R], on_result: Callable[[R], None]) -> None:
+    ''' Run a coroutine on the LLM event loop in the background, then call
+    on_result with its result in a new application context.
+
+    name identifies the job (e.g., "query:123"); a job with the same name as
+    one already pending is ignored.  api_key is the key the coroutine will
+    use, for limiting concurrency per key.
+    '''
+    _queue.enqueue(name, api_key, coro, on_result)
+
+
+def is_job_pending(name: str) -> bool:
+    return _queue.is_pending(name)
+
+
+def set_job_progress(name: str, progress: str) -> None:
+    ''' Record a job's partial result (e.g., response text so far) for status pages. '''
+    _queue.set_progress(name, progress)
+
+
+def get_job_progress(name: str) -> str | None:
+    ''' Get a pending job's partial result, or None if the job is not pending. '''
+    return _queue.get_progress(name)
+
+
+def get_queue_depth() -> int:
+    return _queue.queue_depth()
+
+
+def wait_for_jobs(timeout: float | None = None) -> bool:
+    return _queue.wait(timeout)
+
+
+# ### Admin routes ###
+
+@register_admin_link("LLM Jobs")
+@bp_admin.route("/jobs/")
+def jobs_view() -> str:
+    return render_template("admin_jobs.html", stats=_queue.stats(), rate_limits=get_rate_limit_stats())
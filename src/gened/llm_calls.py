@@ -0,0 +1,52 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+from dataclasses import dataclass
+
+from flask import g
+
+from .db import queue_write
+
+# A log of every LLM API call (one row per call, including failed ones) in the
+# llm_calls table, with its token usage, latency, and outcome, for usage and
+# cost reporting and capacity planning.
+#
+# Calls are made from the LLM event loop thread (see gened.openai), so rows
+# are written via queue_write() rather than with the request's connection.
+
+
+@dataclass
+class LLMCall:
+    ''' Details of one LLM API call, filled in as the call proceeds. '''
+    kind: str | None       # what the prompt is for, e.g. 'main', 'cleanup', 'sufficient', 'topics', 'tutor'
+    model: str | None
+    query_id: int | None = None
+    chat_id: int | None = None
+    prompt_tokens: int | None = None
+    completion_tokens: int | None = None
+    latency: float | None = None   # wall-clock time (seconds), including retries
+    finish_reason: str | None = None
+    error: str | None = None       # exception class name, if the call failed
+    retries: int = 0
+
+
+def record_llm_call(call: LLMCall) -> None:
+    ''' Queue a write of an LLM call to the llm_calls table.
+
+    Run in a worker thread (via asyncio.to_thread(), which copies the
+    caller's context), so current_app and the request's g (with its cached
+    auth, if any) are available, but not the request's database connection.
+    A failed write is logged by queue_write(), never failing the completion.
+    '''
+    auth = g.get('auth') or {}
+    queue_write(lambda db: db.execute("""
+        INSERT INTO llm_calls (
+            user_id, class_id, kind, query_id, chat_id, model,
+            prompt_tokens, completion_tokens, latency, finish_reason, error, retries
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [
+        auth.get('user_id'), auth.get('class_id'), call.kind, call.query_id, call.chat_id, call.model,
+        call.prompt_tokens, call.completion_tokens, call.latency, call.finish_reason, call.error, call.retries,
+    ]))
+
@@ -0,0 +1,141 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import threading
+import time
+from dataclasses import dataclass
+from typing import TypeVar
+
+from flask import current_app
+
+from .db import get_db, on_init_db
+
+# A process-wide cache of each class's resolved LLM configuration (enabled
+# status, API key, and model, plus its app-specific class configuration), so
+# that the joins across classes, LTI consumers, user classes, and models are
+# not run on every request that uses the class.
+#
+# Entries are invalidated explicitly wherever that configuration is written
+# (see invalidate_llm_config()).  A generation counter prevents a lookup that
+# raced with an invalidation from storing stale data.  Entries also expire
+# after LLM_CONFIG_CACHE_TTL seconds, which bounds staleness when the
+# application runs in multiple processes (where only the process handling a
+# change sees its invalidation).
+
+
+@dataclass(frozen=True)
+class ClassLLMConfig:
+    enabled: bool
+    openai_key: str | None
+    model: str | None
+    rate_limit_rpm: int | None = None
+    rate_limit_tpm: int | None = None
+    config_json: str = '{}'  # app-specific class configuration (see gened.class_config)
+
+
+def api_key_id(api_key: str) -> str:
+    ''' A short, non-secret identifier for an API key (e.g., for admin pages). '''
+    return f"...{api_key[-4:]}" if len(api_key) > 8 else "..."
+
+
+K = TypeVar('K')
+T = TypeVar('T')
+
+# Cached values with their expiration times, keyed by database path (so
+# multiple apps in one process, e.g. in tests, do not share entries).
+_default_models: dict[str, tuple[float, str]] = {}
+_class_configs: dict[tuple[str, int], tuple[float, ClassLLMConfig]] = {}
+_generation = 0
+_lock = threading.Lock()
+
+
+def _cache_get(cache: dict[K, tuple[float, T]], key: K) -> T | None:
+    with _lock:
+        entry = cache.get(key)
+    if entry is None:
+        return None
+    expires, value = entry
+    if time.monotonic() >= expires:
+        return None
+    return value
+
+
+def _cache_put(cache: dict[K, tuple[float, T]], key: K, value: T, generation: int) -> None:
+    expires = time.monotonic() + current_app.config['LLM_CONFIG_CACHE_TTL']
+    with _lock:
+        if generation == _generation:
+            cache[key] = (expires, value)
+
+
+def get_default_model() -> str:
+    ''' Get the name of the default model (used with the system API key). '''
+    key = current_app.config['DATABASE']
+    model = _cache_get(_default_models, key)
+    if model is None:
+        generation = _generation
+        db = get_db()
+        # TODO: better control than just id=1
+        model_row = db.execute("SELECT models.model FROM models WHERE models.id=1").fetchone()
+        model = model_row['model']
+        _cache_put(_default_models, key, model, generation)
+
+    return model
+
+
+def get_class_llm_config(class_id: int) -> ClassLLMConfig:
+    ''' Get the LLM configuration for a class: whether it is enabled, plus its
+    API key, model, and rate limits from the linked LTI consumer or user class config,
+    and its app-specific configuration. '''
+    key = (current_app.config['DATABASE'], class_id)
+    config = _cache_get(_class_configs, key)
+    if config is None:
+        generation = _generation
+        db = get_db()
+        class_row = db.execute("""
+            SELECT
+                classes.enabled,
+                classes.config,
+                COALESCE(consumers.openai_key, classes_user.openai_key) AS openai_key,
+                COALESCE(consumers.model_id, classes_user.model_id) AS _model_id,
+                COALESCE(consumers.rate_limit_rpm, classes_user.rate_limit_rpm) AS rate_limit_rpm,
+                COALESCE(consumers.rate_limit_tpm, classes_user.rate_limit_tpm) AS rate_limit_tpm,
+                models.model
+            FROM classes
+            LEFT JOIN classes_lti
+              ON classes.id = classes_lti.class_id
+            LEFT JOIN consumers
+              ON classes_lti.lti_consumer_id = consumers.id
+            LEFT JOIN classes_user
+              ON classes.id = classes_user.class_id
+            LEFT JOIN models
+              ON models.id = _model_id
+            WHERE classes.id = ?
+        """, [class_id]).fetchone()
+        config = ClassLLMConfig(
+            enabled=bool(class_row['enabled']),
+            openai_key=class_row['openai_key'],
+            model=class_row['model'],
+            rate_limit_rpm=class_row['rate_limit_rpm'],
+            rate_limit_tpm=class_row['rate_limit_tpm'],
+            config_json=class_row['config'],
+        )
+        _cache_put(_class_configs, key, config, generation)
+
+    return config
+
+
+@on_init_db
+def invalidate_llm_config(class_id: int | None = None) -> None:
+    ''' Invalidate cached LLM configuration for one class, or for all classes
+    if class_id is None.  Call after committing any change to a class's
+    enabled status, API key, model, or configuration, or to an LTI consumer's. '''
+    global _generation  # noqa: PLW0603 (global statement)
+    with _lock:
+        _generation += 1
+        if class_id is None:
+            _default_models.clear()
+            _class_configs.clear()
+        else:
+            for key in [key for key in _class_configs if key[1] == class_id]:
+                del _class_configs[key]
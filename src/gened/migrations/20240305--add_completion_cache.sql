@@ -0,0 +1,24 @@
+-- SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+--
+-- SPDX-License-Identifier: AGPL-3.0-only
+
+BEGIN;
+
+CREATE TABLE completion_cache (
+    key             TEXT PRIMARY KEY,
+    model           TEXT NOT NULL,
+    responses_json  TEXT NOT NULL,
+    texts_json      TEXT NOT NULL,
+    hits            INTEGER NOT NULL DEFAULT 0,
+    created         TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX completion_cache_by_last_used ON completion_cache(last_used);
+CREATE INDEX completion_cache_by_created ON completion_cache(created);
+
+CREATE TABLE completion_cache_stats (
+    name   TEXT PRIMARY KEY,
+    count  INTEGER NOT NULL DEFAULT 0
+);
+
+COMMIT;
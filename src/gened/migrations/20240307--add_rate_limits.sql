@@ -0,0 +1,12 @@
+-- SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+--
+-- SPDX-License-Identifier: AGPL-3.0-only
+
+BEGIN;
+
+ALTER TABLE consumers ADD COLUMN rate_limit_rpm INTEGER;
+ALTER TABLE consumers ADD COLUMN rate_limit_tpm INTEGER;
+ALTER TABLE classes_user ADD COLUMN rate_limit_rpm INTEGER;
+ALTER TABLE classes_user ADD COLUMN rate_limit_tpm INTEGER;
+
+COMMIT;
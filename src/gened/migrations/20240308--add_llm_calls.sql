@@ -0,0 +1,26 @@
+-- SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+--
+-- SPDX-License-Identifier: AGPL-3.0-only
+
+BEGIN;
+
+CREATE TABLE llm_calls (
+    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+    call_time          TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    user_id            INTEGER,
+    class_id           INTEGER,
+    kind               TEXT,
+    query_id           INTEGER,
+    chat_id            INTEGER,
+    model              TEXT,
+    prompt_tokens      INTEGER,
+    completion_tokens  INTEGER,
+    latency            REAL,
+    finish_reason      TEXT,
+    error              TEXT,
+    retries            INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX llm_calls_by_time ON llm_calls(call_time);
+CREATE INDEX llm_calls_by_class_time ON llm_calls(class_id, call_time);
+
+COMMIT;
@@ -0,0 +1,10 @@
+-- SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+--
+-- SPDX-License-Identifier: AGPL-3.0-only
+
+BEGIN;
+
+CREATE INDEX roles_by_user_class ON roles(user_id, class_id);
+CREATE INDEX roles_by_class ON roles(class_id);
+
+COMMIT;
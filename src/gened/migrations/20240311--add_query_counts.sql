@@ -0,0 +1,56 @@
+-- SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+--
+-- SPDX-License-Identifier: AGPL-3.0-only
+
+-- Applies to any application with a queries table (user_id, role_id, query_time).
+
+BEGIN;
+
+CREATE TABLE user_query_counts (
+    user_id  INTEGER NOT NULL,
+    day      DATE NOT NULL,
+    count    INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE role_query_counts (
+    role_id  INTEGER NOT NULL,
+    day      DATE NOT NULL,
+    count    INTEGER NOT NULL,
+    PRIMARY KEY (role_id, day)
+) WITHOUT ROWID;
+CREATE TABLE user_query_totals (
+    user_id  INTEGER PRIMARY KEY,
+    count    INTEGER NOT NULL
+);
+CREATE TABLE role_query_totals (
+    role_id  INTEGER PRIMARY KEY,
+    count    INTEGER NOT NULL
+);
+
+INSERT INTO user_query_counts (user_id, day, count)
+    SELECT user_id, date(query_time), COUNT(*) FROM queries GROUP BY user_id, date(query_time);
+INSERT INTO role_query_counts (role_id, day, count)
+    SELECT role_id, date(query_time), COUNT(*) FROM queries WHERE role_id IS NOT NULL GROUP BY role_id, date(query_time);
+INSERT INTO user_query_totals (user_id, count)
+    SELECT user_id, COUNT(*) FROM queries GROUP BY user_id;
+INSERT INTO role_query_totals (role_id, count)
+    SELECT role_id, COUNT(*) FROM queries WHERE role_id IS NOT NULL GROUP BY role_id;
+
+CREATE TRIGGER queries_count_insert AFTER INSERT ON queries BEGIN
+    INSERT INTO user_query_counts (user_id, day, count) VALUES (NEW.user_id, date(NEW.query_time), 1)
+        ON CONFLICT (user_id, day) DO UPDATE SET count=count+1;
+    INSERT INTO role_query_counts (role_id, day, count) SELECT NEW.role_id, date(NEW.query_time), 1 WHERE NEW.role_id IS NOT NULL
+        ON CONFLICT (role_id, day) DO UPDATE SET count=count+1;
+    INSERT INTO user_query_totals (user_id, count) VALUES (NEW.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET count=count+1;
+    INSERT INTO role_query_totals (role_id, count) SELECT NEW.role_id, 1 WHERE NEW.role_id IS NOT NULL
+        ON CONFLICT (role_id) DO UPDATE SET count=count+1;
+END;
+CREATE TRIGGER queries_count_delete AFTER DELETE ON queries BEGIN
+    UPDATE user_query_counts SET count=count-1 WHERE user_id=OLD.user_id AND day=date(OLD.query_time);
+    UPDATE role_query_counts SET count=count-1 WHERE role_id=OLD.role_id AND day=date(OLD.query_time);
+    UPDATE user_query_totals SET count=count-1 WHERE user_id=OLD.user_id;
+    UPDATE role_query_totals SET count=count-1 WHERE role_id=OLD.role_id;
+END;
+
+COMMIT;
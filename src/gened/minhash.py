@@ -0,0 +1,99 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import hashlib
+import random
+import re
+import struct
+from collections.abc import Iterable
+
+# MinHash signatures and locality-sensitive hashing (LSH) for finding
+# near-duplicate texts, computed locally.
+#
+# A text is converted to a set of shingles (overlapping n-grams of tokens),
+# and its signature is the minimum hash of those shingles under each of
+# NUM_PERM hash functions.  The fraction of equal positions in two signatures
+# estimates the Jaccard similarity of the two shingle sets.
+#
+# For indexing, a signature is split into NUM_BANDS bands, each hashed to a
+# single bucket value.  Texts sharing any bucket are candidates for being
+# near-duplicates: with 16 bands of 4 rows, a pair with Jaccard similarity 0.8
+# shares a bucket with probability ~0.999, while a pair at 0.3 does so with
+# probability ~0.12.
+
+NUM_PERM = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_PERM // NUM_BANDS
+
+_PRIME = (1 << 61) - 1  # Mersenne prime for the universal hash functions
+_rng = random.Random(8675309)  # fixed seed: signatures must be stable across processes
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+_SIG_STRUCT = struct.Struct(f"<{NUM_PERM}Q")
+
+_comment_re = re.compile(r"/\*.*?\*/|\(\*.*?\*\)|//[^\n]*|#[^\n]*", re.DOTALL)
+_code_token_re = re.compile(r"[A-Za-z_]\w*|\d+|\S")
+_word_re = re.compile(r"\w+")
+
+
+def code_tokens(code: str) -> list[str]:
+    ''' Tokenize code, ignoring comments and whitespace and canonicalizing
+    identifiers by order of first appearance, so that code differing only in
+    formatting, comments, or (consistent) naming produces the same tokens. '''
+    names: dict[str, str] = {}
+    tokens = []
+    for tok in _code_token_re.findall(_comment_re.sub(" ", code)):
+        if tok[0].isalpha() or tok[0] == '_':
+            tok = names.setdefault(tok, f"v{len(names)}")
+        tokens.append(tok)
+    return tokens
+
+
+def word_tokens(text: str) -> list[str]:
+    ''' Tokenize prose (e.g., an issue description) into lowercase words. '''
+    return _word_re.findall(text.lower())
+
+
+def shingles(tokens: list[str], n: int, prefix: str = "") -> set[str]:
+    ''' Return the set of n-grams of the given tokens, each as a string w/ an optional prefix. '''
+    if len(tokens) < n:
+        return {prefix + " ".join(tokens)} if tokens else set()
+    return {prefix + " ".join(tokens[i:i+n]) for i in range(len(tokens) - n + 1)}
+
+
+def _hash64(data: bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+def signature(shingle_set: Iterable[str]) -> tuple[int, ...] | None:
+    ''' Compute the MinHash signature of a set of shingles (None if the set is empty). '''
+    hashes = [_hash64(s.encode('utf8')) for s in shingle_set]
+    if not hashes:
+        return None
+    return tuple(min((a * x + b) % _PRIME for x in hashes) for a, b in _PERMS)
+
+
+def similarity(sig1: tuple[int, ...], sig2: tuple[int, ...]) -> float:
+    ''' Estimate the Jaccard similarity of the sets with the given signatures. '''
+    return sum(1 for x, y in zip(sig1, sig2) if x == y) / NUM_PERM
+
+
+def band_buckets(sig: tuple[int, ...]) -> list[int]:
+    ''' Hash each band of a signature into a bucket value (a signed 64-bit
+    integer, for storing in SQLite).  The band number is included in the hash,
+    so buckets from different bands never collide. '''
+    buckets = []
+    for band in range(NUM_BANDS):
+        rows = sig[band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND]
+        data = struct.pack(f"<B{ROWS_PER_BAND}Q", band, *rows)
+        buckets.append(int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little', signed=True))
+    return buckets
+
+
+def pack_signature(sig: tuple[int, ...]) -> bytes:
+    return _SIG_STRUCT.pack(*sig)
+
+
+def unpack_signature(data: bytes) -> tuple[int, ...]:
+    return _SIG_STRUCT.unpack(data)
@@ -3,21 +3,38 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
 import asyncio
-from collections.abc import Callable
+import atexit
+import concurrent.futures
+import contextlib
+import contextvars
+import queue
+import random
+import threading
+import time
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Coroutine, Iterator
 from functools import wraps
 from sqlite3 import Row
-from typing import ParamSpec, TypedDict, TypeVar
+from typing import Any, ParamSpec, TypedDict, TypeVar
 
+import aiohttp
 import openai
 from flask import current_app, flash, render_template
 
-from .auth import get_auth
+from .auth import get_request_context
 from .db import get_db
+from .llm_calls import LLMCall, record_llm_call
+from .llm_config import get_default_model
+from .rate_limit import RateLimitWaitError, estimate_tokens, rate_limited, record_usage, set_rate_limits
+from .tokens import refund_spent_token, spend_token
 
 # When this is provided as an API key to get_completion(), no API call will be made.
 # The function will sleep to simulate a request, then return test data.
 TEST_API_KEY = '__TESTING__'
 
+# Maximum length of a response (in tokens)
+MAX_TOKENS = 1000
+
 
 class ClassDisabledError(Exception):
     pass
@@ -51,85 +68,56 @@ def _get_llm(use_system_key: bool) -> LLMDict:
            The user must have 1 or more tokens remaining.
              If they have 0 tokens, raise an error.
              Otherwise, their token count is decremented, and the system API
-             key is used with GPT-3.5.
+             key is used with GPT-3.5.  (The token is refunded if an API call
+             in the request returns an error.)
 
     Returns:
       Dictionary with keys 'key' and 'model'.
 
     Raises various exceptions in cases where a key and model are not available.
     '''
-    db = get_db()
-
-    # Get the default model (TODO: better control than just id=1)
-    model_row = db.execute("SELECT models.model FROM models WHERE models.id=1").fetchone()
     system_default: LLMDict = {
         'key': current_app.config["OPENAI_API_KEY"],
-        'model': model_row['model'],
+        'model': get_default_model(),
     }
+    set_rate_limits(system_default['key'], current_app.config['OPENAI_RATE_LIMIT_RPM'], current_app.config['OPENAI_RATE_LIMIT_TPM'])
 
     if use_system_key:
         return system_default
 
-    auth = get_auth()
+    context = get_request_context()
+    auth = context.auth
 
     # Get class data, if there is an active class
-    if auth['class_id']:
-        class_row = db.execute("""
-            SELECT
-                classes.enabled,
-                COALESCE(consumers.openai_key, classes_user.openai_key) AS openai_key,
-                COALESCE(consumers.model_id, classes_user.model_id) AS _model_id,
-                models.model
-            FROM classes
-            LEFT JOIN classes_lti
-              ON classes.id = classes_lti.class_id
-            LEFT JOIN consumers
-              ON classes_lti.lti_consumer_id = consumers.id
-            LEFT JOIN classes_user
-              ON classes.id = classes_user.class_id
-            LEFT JOIN models
-              ON models.id = _model_id
-            WHERE classes.id = ?
-        """, [auth['class_id']]).fetchone()
-
-        if not class_row['enabled']:
+    class_config = context.llm_config
+    if class_config is not None:
+        if not class_config.enabled:
             raise ClassDisabledError
 
-        if not class_row['openai_key']:
+        if not class_config.openai_key:
             raise NoKeyFoundError
 
+        assert class_config.model is not None
+        set_rate_limits(class_config.openai_key, class_config.rate_limit_rpm, class_config.rate_limit_tpm)
         return {
-            'key': class_row['openai_key'],
-            'model': class_row['model'],
+            'key': class_config.openai_key,
+            'model': class_config.model,
         }
 
-    # Get user data for tokens, auth_provider
-    user_row = db.execute("""
-        SELECT
-            users.query_tokens,
-            auth_providers.name AS auth_provider_name
-        FROM users
-        JOIN auth_providers
-          ON users.auth_provider = auth_providers.id
-        WHERE users.id = ?
-    """, [auth['user_id']]).fetchone()
-
-    if user_row['auth_provider_name'] == "local":
+    if auth['auth_provider'] == "local":
         return system_default
 
-    tokens = user_row['query_tokens']
-    if tokens == 0:
+    # spend one of the user's tokens, if they have any, and use the system key
+    if not spend_token(auth['user_id']):
         raise NoTokensError
 
-    # user.tokens > 0, so decrement it and use the system key
-    db.execute("UPDATE users SET query_tokens=query_tokens-1 WHERE id=?", [auth['user_id']])
-    db.commit()
     return system_default
 
 
 # For decorator type hints
 P = ParamSpec('P')
 R = TypeVar('R')
+T = TypeVar('T')
 
 
 def with_llm(use_system_key: bool = False) -> Callable[[Callable[P, R]], Callable[P, str | R]]:
@@ -167,6 +155,160 @@ def with_llm(use_system_key: bool = False) -> Callable[[Callable[P, R]], Callabl
     return decorator
 
 
+class _LLMClientPool:
+    ''' A long-lived event loop, running in a daemon thread, that all request
+    threads submit their LLM coroutines to.
+
+    Running every completion on one persistent loop lets us keep a pooled,
+    keep-alive HTTP session per API key, so repeated requests reuse existing
+    TLS connections instead of creating a new event loop and a new connection
+    for every completion (as asyncio.run() + openai's default session does).
+    '''
+    # Per-session connection limits
+    MAX_CONNECTIONS = 100
+    KEEPALIVE_TIMEOUT = 60  # seconds
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        # Only ever accessed from within the pool's event loop thread.
+        self._sessions: dict[str, aiohttp.ClientSession] = {}
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._thread is None or not self._thread.is_alive():
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="gened-llm-loop", daemon=True)
+                thread.start()
+                self._loop = loop
+                self._thread = thread
+                self._sessions = {}
+            return self._loop
+
+    def submit(self, coro: Coroutine[Any, Any, R]) -> concurrent.futures.Future[R]:
+        ''' Schedule a coroutine on the shared loop and return a future for its result.
+
+        The coroutine runs in a copy of the caller's context, so current_app
+        (e.g., for logging) is available.  It must not use the caller's
+        database connection, though, as that is bound to the calling thread.
+        Cancelling the returned future cancels the coroutine.
+        '''
+        loop = self._ensure_loop()
+        future: concurrent.futures.Future[R] = concurrent.futures.Future()
+
+        def on_done(task: asyncio.Task[R]) -> None:
+            if future.cancelled():
+                return
+            if task.cancelled():
+                future.cancel()
+            elif (exc := task.exception()) is not None:
+                future.set_exception(exc)
+            else:
+                future.set_result(task.result())
+
+        def start() -> None:
+            # Runs in the copied context, so the new task inherits it.
+            task = loop.create_task(coro)
+            task.add_done_callback(on_done)
+            future.add_done_callback(lambda f: loop.call_soon_threadsafe(task.cancel) if f.cancelled() else None)
+
+        loop.call_soon_threadsafe(start, context=contextvars.copy_context())
+        return future
+
+    def run(self, coro: Coroutine[Any, Any, R]) -> R:
+        ''' Run a coroutine on the shared loop, blocking the calling thread until it completes. '''
+        return self.submit(coro).result()
+
+    def get_session(self, api_key: str) -> aiohttp.ClientSession | None:
+        ''' Return the pooled HTTP session for the given API key.
+
+        Returns None if not called from within the pool's own event loop
+        (e.g., if a caller used asyncio.run() directly), in which case the
+        openai library falls back to a single-use session.
+        '''
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return None
+        if running_loop is not self._loop:
+            return None
+
+        session = self._sessions.get(api_key)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.MAX_CONNECTIONS, keepalive_timeout=self.KEEPALIVE_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[api_key] = session
+        return session
+
+    async def _close_sessions(self) -> None:
+        sessions = list(self._sessions.values())
+        self._sessions = {}
+        for session in sessions:
+            await session.close()
+
+    def close(self) -> None:
+        ''' Close all pooled sessions and stop the loop. '''
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = None
+            self._thread = None
+        if loop is None or thread is None or not thread.is_alive():
+            return
+        asyncio.run_coroutine_threadsafe(self._close_sessions(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+        loop.close()
+
+
+_client_pool = _LLMClientPool()
+atexit.register(_client_pool.close)
+
+
+def run_async(coro: Coroutine[Any, Any, R]) -> R:
+    ''' Run an LLM coroutine (e.g., one or more get_completion() calls) to
+    completion from synchronous code, such as a request handler.
+
+    Use this instead of asyncio.run() so that completions share the pooled,
+    keep-alive HTTP sessions of the persistent LLM event loop.
+    '''
+    return _client_pool.run(coro)
+
+
+def submit_async(coro: Coroutine[Any, Any, R]) -> concurrent.futures.Future[R]:
+    ''' Start an LLM coroutine on the persistent LLM event loop without
+    waiting for it, returning a future for its result. '''
+    return _client_pool.submit(coro)
+
+
+def iter_async(agen: AsyncIterator[T]) -> Iterator[T]:
+    ''' Consume an async iterator (e.g., get_completion_stream()) on the
+    persistent LLM event loop, yielding its items to synchronous code, such as
+    a streaming response generator.
+
+    The async iterator runs as a single task, and items are handed over
+    through a queue.  If the consumer stops early, the task is cancelled.
+    '''
+    items: queue.Queue[tuple[bool, Any]] = queue.Queue()
+
+    async def pump() -> None:
+        async for item in agen:
+            items.put((False, item))
+
+    future = _client_pool.submit(pump())
+    future.add_done_callback(lambda _: items.put((True, None)))
+
+    try:
+        while True:
+            finished, item = items.get()
+            if finished:
+                break
+            yield item
+        future.result()  # raise any exception from the iterator
+    finally:
+        future.cancel()
+
+
 def get_models() -> list[Row]:
     """Enumerate the models available in the database."""
     db = get_db()
@@ -174,10 +316,174 @@ def get_models() -> list[Row]:
     return models
 
 
-async def get_completion(api_key: str, prompt: str | None = None, messages: list[dict[str, str]] | None = None, model: str | None = None, n: int = 1, score_func: Callable[[str], int] | None = None) -> tuple[dict[str, str], str]:
+def _get_error_text(e: Exception) -> str:
+    ''' Log an exception raised by an API call and return the error text to show the user. '''
+    common_error_text = "Error ({error_type}).  Something went wrong with this query.  The error has been logged, and we'll work on it.  For now, please try again."
+    if isinstance(e, openai.error.APIError):
+        response_txt = common_error_text.format(error_type='APIError')
+        current_app.logger.error(f"OpenAI APIError: {e}")
+    elif isinstance(e, openai.error.Timeout):
+        response_txt = common_error_text.format(error_type='Timeout')
+        current_app.logger.error(f"OpenAI Timeout: {e}")
+    elif isinstance(e, openai.error.ServiceUnavailableError):
+        response_txt = common_error_text.format(error_type='ServiceUnavailableError')
+        current_app.logger.error(f"OpenAI ServiceUnavailableError: {e}")
+    elif isinstance(e, openai.error.RateLimitError):
+        if "exceeded your current quota" in str(e):
+            response_txt = "Error (RateLimitError).  The API key for this class has exceeded its current quota (https://platform.openai.com/docs/guides/rate-limits).  Check your API plan and billing details."
+        else:
+            response_txt = "Error (RateLimitError).  The system is receiving too many requests right now.  Please try again in one minute."
+        current_app.logger.error(f"OpenAI RateLimitError: {e}")
+    elif isinstance(e, RateLimitWaitError):
+        response_txt = "Error (RateLimitError).  Too many requests are being made with this API key right now.  Please try again in one minute."
+        current_app.logger.warning(f"Local rate limit: {e}")
+    elif isinstance(e, openai.error.AuthenticationError):
+        response_txt = "Error (AuthenticationError).  The API key is invalid, expired, or revoked.  If you are a student, please inform the instructor for your class."
+        current_app.logger.error(f"OpenAI AuthenticationError: {e}")
+    elif isinstance(e, openai.error.InvalidRequestError):
+        if "maximum context length" in str(e):
+            response_txt = "Error (InvalidRequestError).  Your query is too long for the model to process.  Please reduce the length of your input."
+        else:
+            response_txt = common_error_text.format(error_type='InvalidRequestError')
+        current_app.logger.error(f"OpenAI InvalidRequestError: {e}")
+    else:
+        response_txt = common_error_text.format(error_type='Exception')
+        current_app.logger.error(f"Exception (OpenAI {type(e).__name__}, but I don't handle that specifically yet): {e}")
+
+    return response_txt
+
+
+# Errors worth retrying: transient network or server problems.  (Rate limit
+# errors are not retried: they usually mean a key's quota is exhausted, and
+# per-minute limits are handled before sending by gened.rate_limit.)
+_RETRYABLE_ERRORS = (
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+    openai.error.TryAgain,
+)
+
+
+class _LatencyTracker:
+    ''' Recent completion latencies for each model, used to decide when to
+    send a hedged request. '''
+    WINDOW = 200  # number of recent latencies kept per model
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._latencies: dict[str, deque[float]] = {}
+
+    def record(self, model: str, latency: float) -> None:
+        with self._lock:
+            self._latencies.setdefault(model, deque(maxlen=self.WINDOW)).append(latency)
+
+    def percentile(self, model: str, pct: int, min_samples: int) -> float | None:
+        ''' Return the given percentile of the model's recent latencies, or
+        None if fewer than min_samples have been recorded. '''
+        with self._lock:
+            latencies = sorted(self._latencies.get(model, ()))
+        if not latencies or len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, len(latencies) * pct // 100)]
+
+
+_latencies = _LatencyTracker()
+
+
+async def _create_once(api_key: str, reserved_tokens: int, params: dict[str, Any]) -> Any:
+    ''' Make a single chat completion request, within the key's rate limits. '''
+    # Wait for a concurrency slot and the key's rate limits, if needed,
+    # reserving an estimate of the tokens used
+    async with rate_limited(api_key, reserved_tokens):
+        # Use the pooled session for this key (a no-op outside the shared loop).
+        # Sets a context variable, so it only affects the current task.
+        openai.aiosession.set(_client_pool.get_session(api_key))
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            response = await openai.ChatCompletion.acreate(api_key=api_key, **params)
+        except Exception:
+            record_usage(api_key, reserved_tokens, 0)  # failed requests are not billed
+            raise
+    _latencies.record(params['model'], loop.time() - start)
+    record_usage(api_key, reserved_tokens, response.get('usage', {}).get('total_tokens', reserved_tokens))
+    return response
+
+
+async def _create_hedged(api_key: str, reserved_tokens: int, params: dict[str, Any]) -> Any:
+    ''' Make a chat completion request.  If hedging is enabled and the
+    request has not completed within the model's recent p95 latency, send a
+    second, identical request and use whichever completes first. '''
+    hedge_delay = None
+    if current_app.config['LLM_HEDGE']:
+        hedge_delay = _latencies.percentile(params['model'], 95, current_app.config['LLM_HEDGE_MIN_SAMPLES'])
+    if hedge_delay is None:
+        return await _create_once(api_key, reserved_tokens, params)
+
+    pending = {asyncio.create_task(_create_once(api_key, reserved_tokens, params))}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+        if not done:
+            current_app.logger.info(f"Sending hedged LLM request after {hedge_delay:.1f}s")
+            pending.add(asyncio.create_task(_create_once(api_key, reserved_tokens, params)))
+        error: BaseException | None = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        assert error is not None
+        raise error
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def _create_with_retries(api_key: str, reserved_tokens: int, params: dict[str, Any], call: LLMCall) -> Any:
+    ''' Make a chat completion request, retrying transient errors with
+    exponential backoff and full jitter, up to LLM_RETRIES times, as long as
+    the whole process fits within LLM_DEADLINE seconds.  Retries are counted
+    in call.retries. '''
+    config = current_app.config
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + config['LLM_DEADLINE']
+    attempt = 0
+    while True:
+        # (asyncio.wait() rather than asyncio.timeout_at(), which needs Python
+        # 3.11, and so that a timeout raised within the request itself is not
+        # mistaken for the deadline passing.)
+        task = asyncio.ensure_future(_create_hedged(api_key, reserved_tokens, params))
+        try:
+            done, _ = await asyncio.wait({task}, timeout=max(deadline - loop.time(), 0))
+        finally:
+            task.cancel()  # (no effect if it is done)
+        if not done:
+            raise openai.error.Timeout(f"No response within the {config['LLM_DEADLINE']}s deadline")
+        try:
+            return task.result()
+        except (*_RETRYABLE_ERRORS, asyncio.TimeoutError) as e:
+            attempt += 1
+            delay = random.uniform(0, min(config['LLM_RETRY_MAX_DELAY'], config['LLM_RETRY_BASE_DELAY'] * 2 ** (attempt - 1)))
+            if attempt > config['LLM_RETRIES'] or loop.time() + delay >= deadline:
+                raise
+            call.retries = attempt
+            current_app.logger.warning(f"Retrying LLM request ({attempt}/{config['LLM_RETRIES']}) in {delay:.1f}s after {type(e).__name__}: {e}")
+            await asyncio.sleep(delay)
+
+
+async def get_completion(api_key: str, prompt: str | None = None, messages: list[dict[str, str]] | None = None, model: str | None = None, n: int = 1, score_func: Callable[[str], int] | None = None, kind: str | None = None, query_id: int | None = None, chat_id: int | None = None) -> tuple[dict[str, str], str]:
     '''
     model can be any valid OpenAI model name that can be used via the chat completion API.
 
+    Each call is recorded in the llm_calls table, identified by kind (what the
+    prompt is for, e.g. 'main' or 'tutor') and the query or chat it is for, if given.
+
+    Transient errors are retried (see _create_with_retries()), and a slow
+    request may be hedged (see _create_hedged()).  Any remaining error is
+    returned as error text in place of the response text.
+
     Returns:
        - A tuple containing:
            - An OpenAI response object
@@ -188,20 +494,24 @@ async def get_completion(api_key: str, prompt: str | None = None, messages: list
         await asyncio.sleep(2)  # simulate a 2 second delay for a network request
         return {"TEST DATA" : "x "*500}, "TEST DATA: " + "x "*500
 
-    common_error_text = "Error ({error_type}).  Something went wrong with this query.  The error has been logged, and we'll work on it.  For now, please try again."
+    call = LLMCall(kind=kind, model=model, query_id=query_id, chat_id=chat_id)
+    start = time.monotonic()
     try:
         if messages is None:
             assert prompt is not None
             messages = [{"role": "user", "content": prompt}]
-        response = await openai.ChatCompletion.acreate(
-            api_key=api_key,
-            model=model,
-            messages=messages,
-            temperature=0.25,
-            max_tokens=1000,
-            n=n,
+        reserved_tokens = estimate_tokens(messages, MAX_TOKENS * n)
+        response = await _create_with_retries(api_key, reserved_tokens, {
+            'model': model,
+            'messages': messages,
+            'temperature': 0.25,
+            'max_tokens': MAX_TOKENS,
+            'n': n,
             # TODO: add user= parameter w/ unique ID of user (e.g., hash of username+email or similar)
-        )
+        }, call)
+        usage = response.get('usage', {})
+        call.prompt_tokens = usage.get('prompt_tokens')
+        call.completion_tokens = usage.get('completion_tokens')
 
         if n > 1:
             assert score_func is not None
@@ -211,44 +521,203 @@ async def get_completion(api_key: str, prompt: str | None = None, messages: list
         response_txt = best_choice.message['content']
 
         response_reason = best_choice.finish_reason  # e.g. "length" if max_tokens reached
+        call.finish_reason = response_reason
 
         if response_reason == "length":
             response_txt += "\n\n[error: maximum length exceeded]"
 
-    except openai.error.APIError as e:
-        response = str(e)
-        response_txt = common_error_text.format(error_type='APIError')
-        current_app.logger.error(f"OpenAI APIError: {e}")
-    except openai.error.Timeout as e:
-        response = str(e)
-        response_txt = common_error_text.format(error_type='Timeout')
-        current_app.logger.error(f"OpenAI Timeout: {e}")
-    except openai.error.ServiceUnavailableError as e:
-        current_app.logger.error(e)
-        response = str(e)
-        response_txt = common_error_text.format(error_type='ServiceUnavailableError')
-        current_app.logger.error(f"OpenAI ServiceUnavailableError: {e}")
-    except openai.error.RateLimitError as e:
-        response = str(e)
-        if "exceeded your current quota" in response:
-            response_txt = "Error (RateLimitError).  The API key for this class has exceeded its current quota (https://platform.openai.com/docs/guides/rate-limits).  Check your API plan and billing details."
-        else:
-            response_txt = "Error (RateLimitError).  The system is receiving too many requests right now.  Please try again in one minute."
-        current_app.logger.error(f"OpenAI RateLimitError: {e}")
-    except openai.error.AuthenticationError as e:
-        response = str(e)
-        response_txt = "Error (AuthenticationError).  The API key is invalid, expired, or revoked.  If you are a student, please inform the instructor for your class."
-        current_app.logger.error(f"OpenAI AuthenticationError: {e}")
-    except openai.error.InvalidRequestError as e:
-        response = str(e)
-        if "maximum context length" in response:
-            response_txt = "Error (InvalidRequestError).  Your query is too long for the model to process.  Please reduce the length of your input."
-        else:
-            response_txt = common_error_text.format(error_type='InvalidRequestError')
-        current_app.logger.error(f"OpenAI InvalidRequestError: {e}")
     except Exception as e:
+        call.error = type(e).__name__
         response = str(e)
-        response_txt = common_error_text.format(error_type='Exception')
-        current_app.logger.error(f"Exception (OpenAI {type(e).__name__}, but I don't handle that specifically yet): {e}")
+        response_txt = _get_error_text(e)
+        refund_spent_token()
+
+    call.latency = time.monotonic() - start
+    await asyncio.to_thread(record_llm_call, call)
 
     return response, response_txt.strip()
+
+
+async def get_completion_stream(api_key: str, prompt: str | None = None, messages: list[dict[str, str]] | None = None, model: str | None = None, kind: str | None = None, query_id: int | None = None, chat_id: int | None = None) -> AsyncIterator[str]:
+    '''
+    Streaming version of get_completion(): an async generator yielding the
+    response text in pieces (token deltas) as they are generated.
+
+    Calls are recorded in the llm_calls table as in get_completion(), but
+    with token counts estimated from the text, as streamed responses do not
+    report their usage.
+
+    Errors are reported the same way as in get_completion(): the error text is
+    yielded in place of (or following) the response text.
+    '''
+
+    if api_key == TEST_API_KEY:
+        for _ in range(20):
+            await asyncio.sleep(0.1)  # simulate a 2 second stream of tokens
+            yield "x "*25
+        return
+
+    call = LLMCall(kind=kind, model=model, query_id=query_id, chat_id=chat_id)
+    start = time.monotonic()
+    # Streamed responses do not report usage, so estimate it from the text.
+    response_len = 0
+    reserved_tokens = 0  # taken from the key's rate limits, to be returned in record_usage()
+    limits = contextlib.AsyncExitStack()  # holds the key's concurrency slot for the call
+    try:
+        if messages is None:
+            assert prompt is not None
+            messages = [{"role": "user", "content": prompt}]
+        estimate = estimate_tokens(messages, MAX_TOKENS)
+        await limits.enter_async_context(rate_limited(api_key, estimate))
+        reserved_tokens = estimate
+        openai.aiosession.set(_client_pool.get_session(api_key))
+        response = await openai.ChatCompletion.acreate(
+            api_key=api_key,
+            model=model,
+            messages=messages,
+            temperature=0.25,
+            max_tokens=MAX_TOKENS,
+            stream=True,
+        )
+
+        async for chunk in response:
+            choice = chunk.choices[0]
+            delta = choice.delta.get('content')
+            if delta:
+                response_len += len(delta)
+                yield delta
+            if choice.finish_reason:
+                call.finish_reason = choice.finish_reason
+            if choice.finish_reason == "length":
+                yield "\n\n[error: maximum length exceeded]"
+
+    except GeneratorExit:
+        # The consumer stopped early (e.g., to start a speculative cleanup).
+        # Close the response to end the API call, and record what it used.
+        call.finish_reason = 'cancelled'
+        await response.aclose()
+        raise
+
+    except Exception as e:
+        call.error = type(e).__name__
+        refund_spent_token()
+        yield _get_error_text(e)
+
+    finally:
+        if reserved_tokens:
+            # (a call that failed partway through its response is billed for what was sent)
+            if call.error is None or response_len:
+                call.prompt_tokens = reserved_tokens - MAX_TOKENS
+                call.completion_tokens = response_len // 4
+                record_usage(api_key, reserved_tokens, call.prompt_tokens + call.completion_tokens)
+            else:
+                record_usage(api_key, reserved_tokens, 0)  # failed requests are not billed
+        await limits.aclose()
+        call.latency = time.monotonic() - start
+        await asyncio.to_thread(record_llm_call, call)
+
+
+async def get_completion_candidates(api_key: str, prompt: str | None = None, messages: list[dict[str, str]] | None = None, model: str | None = None, n: int = 2, score_func: Callable[[str], int] | None = None, new_scorer: Callable[[], Callable[[str], int]] | None = None, abandon_at: int | None = None, kind: str | None = None, query_id: int | None = None, chat_id: int | None = None) -> tuple[dict[str, Any], str]:
+    '''
+    Generate n candidate responses in one streamed call, scoring each one
+    with score_func as its text arrives, and return the first candidate to
+    finish with a score of 0 (or more) without waiting for the others.
+
+    score_func is called with a candidate's whole text so far each time it
+    grows.  Alternatively, to score incrementally, new_scorer is called once
+    per candidate for a function that is called with each new piece of its
+    text and returns the score of the text so far.
+
+    Scores must never increase as a text grows (e.g., counting unwanted
+    phrases), so a candidate with a negative score cannot recover.  If every
+    candidate's score falls to abandon_at or below, the call is abandoned
+    early.  Otherwise, if no candidate finishes with a score of 0, the
+    highest-scoring one is used once all have finished.
+
+    Returns the same as get_completion(), except that the response object is
+    a summary of the candidates (the API does not report usage for streamed
+    calls), and the chosen text may be partial if the call was abandoned.
+    '''
+    assert (score_func is None) != (new_scorer is None)
+
+    if api_key == TEST_API_KEY:
+        return await get_completion(api_key, prompt=prompt, messages=messages, model=model, kind=kind, query_id=query_id, chat_id=chat_id)
+
+    call = LLMCall(kind=kind, model=model, query_id=query_id, chat_id=chat_id)
+    start = time.monotonic()
+    texts = [""] * n
+    scores = [0] * n
+    scorers = [new_scorer() for _ in range(n)] if new_scorer is not None else None
+    finish_reasons: list[str | None] = [None] * n
+    chosen = None
+    response = None
+    reserved_tokens = 0  # taken from the key's rate limits, to be returned in record_usage()
+    limits = contextlib.AsyncExitStack()  # holds the key's concurrency slot for the call
+    try:
+        if messages is None:
+            assert prompt is not None
+            messages = [{"role": "user", "content": prompt}]
+        estimate = estimate_tokens(messages, MAX_TOKENS * n)
+        await limits.enter_async_context(rate_limited(api_key, estimate))
+        reserved_tokens = estimate
+        openai.aiosession.set(_client_pool.get_session(api_key))
+        response = await openai.ChatCompletion.acreate(
+            api_key=api_key,
+            model=model,
+            messages=messages,
+            temperature=0.25,
+            max_tokens=MAX_TOKENS,
+            n=n,
+            stream=True,
+        )
+
+        async for chunk in response:
+            for choice in chunk.choices:
+                i = choice.index
+                delta = choice.delta.get('content')
+                if delta:
+                    texts[i] += delta
+                    if scorers is not None:
+                        scores[i] = scorers[i](delta)
+                    else:
+                        assert score_func is not None
+                        scores[i] = score_func(texts[i])
+                if choice.finish_reason:
+                    finish_reasons[i] = choice.finish_reason
+                    if choice.finish_reason == "stop" and scores[i] >= 0:
+                        chosen = i
+            if chosen is not None:
+                break
+            if abandon_at is not None and all(score <= abandon_at for score in scores):
+                break
+
+        if chosen is None:
+            chosen = max(range(n), key=lambda i: scores[i])
+        call.finish_reason = finish_reasons[chosen] or 'cancelled'
+        call.prompt_tokens = reserved_tokens - MAX_TOKENS * n
+        call.completion_tokens = sum(len(text) for text in texts) // 4
+        record_usage(api_key, reserved_tokens, call.prompt_tokens + call.completion_tokens)
+        reserved_tokens = 0
+
+        response_txt = texts[chosen]
+        if finish_reasons[chosen] == "length":
+            response_txt += "\n\n[error: maximum length exceeded]"
+        summary: Any = {'model': model, 'candidates': n, 'chosen': chosen, 'scores': scores, 'finish_reasons': finish_reasons}
+
+    except Exception as e:
+        call.error = type(e).__name__
+        summary = str(e)
+        response_txt = _get_error_text(e)
+        refund_spent_token()
+        if reserved_tokens:
+            record_usage(api_key, reserved_tokens, 0)  # failed requests are not billed
+
+    finally:
+        if response is not None:
+            await response.aclose()  # ends the API call if any candidates are unfinished
+        await limits.aclose()
+
+    call.latency = time.monotonic() - start
+    await asyncio.to_thread(record_llm_call, call)
+
+    return summary, response_txt.strip()
@@ -5,28 +5,30 @@
 from flask import Blueprint, render_template
 
 from .auth import get_auth, login_required
-from .db import get_db
+from .db import get_db_ro, register_sql
 
 bp = Blueprint('profile', __name__, url_prefix="/profile", template_folder='templates')
 
+USER_SQL = register_sql('profile_user', """
+    SELECT
+        users.*,
+        auth_providers.name AS provider_name,
+        COALESCE(user_query_totals.count, 0) AS num_queries,
+        (SELECT COALESCE(SUM(count), 0) FROM user_query_counts WHERE user_id=users.id AND day >= date('now', '-7 days')) AS num_recent_queries
+    FROM users
+    LEFT JOIN user_query_totals ON user_query_totals.user_id=users.id
+    LEFT JOIN auth_providers ON auth_providers.id=users.auth_provider
+    WHERE users.id=?
+""")
+
 
 @bp.route("/")
 @login_required
 def main() -> str:
-    db = get_db()
+    db = get_db_ro()
     auth = get_auth()
     user_id = auth['user_id']
-    user = db.execute("""
-        SELECT
-            users.*,
-            auth_providers.name AS provider_name,
-            COUNT(queries.id) AS num_queries,
-            SUM(CASE WHEN queries.query_time > date('now', '-7 days') THEN 1 ELSE 0 END) AS num_recent_queries
-        FROM users
-        LEFT JOIN queries ON queries.user_id=users.id
-        LEFT JOIN auth_providers ON auth_providers.id=users.auth_provider
-        WHERE users.id=?
-    """, [user_id]).fetchone()
+    user = db.execute(USER_SQL, [user_id]).fetchone()
 
     class_id = auth['class_id'] or -1   # can't do a != to None/null, so convert that to -1 to match all classes in that case
     other_classes = db.execute("""
@@ -2,13 +2,20 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import datetime as dt
 import json
+from dataclasses import dataclass
 from sqlite3 import Row
+from typing import Any
 
-from flask import flash
+import markupsafe
+from flask import abort, current_app, flash, jsonify, request
+from werkzeug.wrappers.response import Response
 
 from .auth import get_auth
-from .db import get_db
+from .db import get_db, get_db_ro, register_sql
+
+HISTORY_SQL = register_sql('history', "SELECT * FROM queries WHERE queries.user_id=? ORDER BY query_time DESC LIMIT ?")
 
 
 def get_query(query_id: int) -> tuple[Row, dict[str, str]] | tuple[None, None]:
@@ -39,9 +46,107 @@ def get_query(query_id: int) -> tuple[Row, dict[str, str]] | tuple[None, None]:
 
 def get_history(limit: int = 10) -> list[Row]:
     '''Fetch current user's query history.'''
-    db = get_db()
+    db = get_db_ro()
     auth = get_auth()
 
-    cur = db.execute("SELECT * FROM queries WHERE queries.user_id=? ORDER BY query_time DESC LIMIT ?", [auth['user_id'], limit])
+    cur = db.execute(HISTORY_SQL, [auth['user_id'], limit])
     history = cur.fetchall()
     return history
+
+
+@dataclass(frozen=True)
+class QueriesPage:
+    rows: list[Row]
+    next_cursor: str | None  # None if this is the last page
+
+
+def _make_cursor(row: Row) -> str:
+    return f"{row['query_time'].isoformat(' ')},{row['id']}"
+
+
+def _parse_cursor(cursor: str) -> tuple[str, int]:
+    time_str, id_str = cursor.rsplit(',', 1)
+    return dt.datetime.fromisoformat(time_str).isoformat(' '), int(id_str)
+
+
+def search_condition(columns: list[str], search: str) -> tuple[str, list[str]]:
+    ''' A condition (and its parameters) matching rows with `search` as a
+    substring of any of `columns`.  LIKE wildcards in `search` are matched
+    literally. '''
+    pattern = "%" + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + "%"
+    return "(" + " OR ".join(f"{col} LIKE ? ESCAPE '\\'" for col in columns) + ")", [pattern] * len(columns)
+
+
+def get_queries_page(
+    sql: str,
+    conditions: list[str],
+    params: list[Any],
+    cursor: str | None = None,
+    search: str = "",
+    ascending: bool = False,
+) -> QueriesPage:
+    '''
+    Fetch one page of queries from `sql` (a SELECT over queries, with a
+    {where_clause} placeholder and no ORDER BY), filtered by `conditions`,
+    ordered by (query_time, id), starting after the row given by `cursor` (from
+    a previous page's next_cursor).  Keyset pagination: each page is a range
+    scan from the cursor, so its cost does not depend on how many pages came
+    before it.
+
+    `search`, if given, is matched (as a substring) against users.display_name
+    and the QUERY_SEARCH_COLUMNS of the queries table.
+
+    Raises ValueError for an invalid cursor.
+    '''
+    conditions = list(conditions)
+    params = list(params)
+
+    if cursor:
+        conditions.append(f"(queries.query_time, queries.id) {'>' if ascending else '<'} (?, ?)")
+        params.extend(_parse_cursor(cursor))
+
+    if search:
+        columns = ['users.display_name', *(f"queries.{col}" for col in current_app.config['QUERY_SEARCH_COLUMNS'])]
+        search_cond, search_params = search_condition(columns, search)
+        conditions.append(search_cond)
+        params.extend(search_params)
+
+    direction = "ASC" if ascending else "DESC"
+    page_size = current_app.config['QUERIES_PAGE_SIZE']
+    where_clause = "WHERE " + " AND ".join(conditions) if conditions else ""
+    sql = sql.format(where_clause=where_clause) + f" ORDER BY queries.query_time {direction}, queries.id {direction} LIMIT ?"
+
+    db = get_db_ro()
+    rows = db.execute(sql, [*params, page_size + 1]).fetchall()  # one extra to see whether there is a next page
+
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return QueriesPage(rows, _make_cursor(rows[-1]))
+    else:
+        return QueriesPage(rows, None)
+
+
+def get_page_args() -> dict[str, Any]:
+    ''' Get get_queries_page()'s cursor, search, and ascending arguments from the request. '''
+    return {
+        'cursor': request.args.get('cursor'),
+        'search': request.args.get('q', '').strip(),
+        'ascending': request.args.get('order') == 'asc',
+    }
+
+
+def page_json(page: QueriesPage, edit_handler: str | None = None) -> Response:
+    '''
+    Respond with one page of a paged datatable (see tables.html): the cells of
+    each row, for the columns named in the 'cols' request argument, rendered
+    as the datatable macro renders them (with the table's edit_handler, if it
+    has one), and the cursor for the next page.
+    '''
+    cols = request.args.get('cols', '').split(',')
+    if page.rows and not all(col in page.rows[0].keys() for col in cols):
+        return abort(400)
+
+    row_builder = current_app.jinja_env.filters['row_builder']([(col, col) for col in cols], edit_handler)
+    rows = [[str(markupsafe.escape(cell)) for cell in row_builder(row)] for row in page.rows]
+    return jsonify(rows=rows, next=page.next_cursor)
+
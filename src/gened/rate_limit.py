@@ -0,0 +1,269 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+import threading
+import time
+import weakref
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+
+from flask import current_app
+from werkzeug.datastructures import ImmutableMultiDict
+
+from .llm_config import api_key_id
+
+# Client-side rate limiting of LLM API calls, per API key.
+#
+# Each API key may have a requests-per-minute (RPM) and/or a tokens-per-minute
+# (TPM) limit (set per LTI consumer and per user class, or in the app config
+# for the system key).  Each limit is enforced with a token bucket that holds
+# up to one minute's allowance and refills continuously.  A call that would
+# exceed a limit waits until the bucket has refilled enough, rather than being
+# sent and rejected by the API, for up to RATE_LIMIT_MAX_WAIT seconds.
+#
+# A call's token cost is not known until it completes, so calls reserve an
+# estimate (prompt length + maximum response length), and the difference is
+# returned to the bucket once the actual usage is known.
+#
+# Each API key is also limited to LLM_CONCURRENCY_PER_KEY calls in progress at
+# once, with a semaphore per key on the LLM event loop.  A call waits for a
+# free slot, also for up to RATE_LIMIT_MAX_WAIT seconds, before waiting for the
+# key's rate limits.  A background job holds one slot for its whole duration,
+# and the calls it makes use that slot (see gened.jobs).
+#
+# Limits are tracked in memory, per process.
+
+
+class RateLimitWaitError(Exception):
+    pass
+
+
+@dataclass
+class _Bucket:
+    rpm: int | None
+    tpm: int | None
+    requests: float = 0.0
+    tokens: float = 0.0
+    updated: float = field(default_factory=time.monotonic)
+    # usage stats
+    num_requests: int = 0
+    num_tokens: int = 0
+    num_waits: int = 0
+    wait_time: float = 0.0
+    active: int = 0  # concurrency slots in use
+
+    def __post_init__(self) -> None:
+        # start full
+        self.requests = float(self.rpm or 0)
+        self.tokens = float(self.tpm or 0)
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.updated = now
+        if self.rpm:
+            self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+
+    def set_limits(self, rpm: int | None, tpm: int | None, now: float) -> None:
+        ''' Change the limits in place, keeping the current levels (capped at
+        the new limits) so that a key used with different limits by several
+        classes/consumers is not refilled each time the limits alternate.  A
+        newly-limited bucket starts full. '''
+        self._refill(now)
+        if rpm != self.rpm:
+            self.requests = min(self.requests, rpm) if (self.rpm and rpm) else float(rpm or 0)
+            self.rpm = rpm
+        if tpm != self.tpm:
+            self.tokens = min(self.tokens, tpm) if (self.tpm and tpm) else float(tpm or 0)
+            self.tpm = tpm
+
+    def take(self, cost: int, now: float) -> float:
+        ''' Take one request and the given number of tokens from the bucket if
+        available, returning 0.  Otherwise, return the time (in seconds) until
+        they will be available. '''
+        self._refill(now)
+        wait = 0.0
+        if self.rpm and self.requests < 1:
+            wait = max(wait, (1 - self.requests) * 60 / self.rpm)
+        if self.tpm:
+            cost = min(cost, self.tpm)  # a call larger than the limit can go once the bucket is full
+            if self.tokens < cost:
+                wait = max(wait, (cost - self.tokens) * 60 / self.tpm)
+        if wait > 0:
+            return wait
+        if self.rpm:
+            self.requests -= 1
+        if self.tpm:
+            self.tokens -= cost
+        return 0.0
+
+
+class _RateLimiter:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._buckets: dict[str, _Bucket] = {}
+        # Per event loop (normally just the LLM event loop), as asyncio
+        # semaphores can only be used within one loop.  Only accessed from
+        # within each loop's thread.
+        self._semaphores: weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Semaphore]] = weakref.WeakKeyDictionary()
+
+    def _get_bucket(self, api_key: str) -> _Bucket:
+        # self._lock must be held
+        bucket = self._buckets.get(api_key)
+        if bucket is None:
+            bucket = self._buckets[api_key] = _Bucket(rpm=None, tpm=None)
+        return bucket
+
+    def set_limits(self, api_key: str, rpm: int | None, tpm: int | None) -> None:
+        with self._lock:
+            bucket = self._buckets.get(api_key)
+            if bucket is None:
+                self._buckets[api_key] = _Bucket(rpm=rpm, tpm=tpm)
+            elif (bucket.rpm, bucket.tpm) != (rpm, tpm):
+                bucket.set_limits(rpm, tpm, time.monotonic())
+
+    async def acquire_slot(self, api_key: str, limit: int, max_wait: float | None) -> None:
+        semaphores = self._semaphores.setdefault(asyncio.get_running_loop(), {})
+        semaphore = semaphores.setdefault(api_key, asyncio.Semaphore(limit))
+        if max_wait is None:
+            await semaphore.acquire()
+        else:
+            try:
+                await asyncio.wait_for(semaphore.acquire(), max_wait)
+            except asyncio.TimeoutError:
+                raise RateLimitWaitError(f"No free concurrency slot within {max_wait:.1f}s") from None
+        with self._lock:
+            self._get_bucket(api_key).active += 1
+
+    def release_slot(self, api_key: str) -> None:
+        self._semaphores[asyncio.get_running_loop()][api_key].release()
+        with self._lock:
+            self._get_bucket(api_key).active -= 1
+
+    async def acquire(self, api_key: str, cost: int, max_wait: float) -> None:
+        deadline = time.monotonic() + max_wait
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                bucket = self._get_bucket(api_key)
+                wait = bucket.take(cost, now)
+                if wait == 0:
+                    bucket.num_requests += 1
+                    return
+                if now + wait > deadline:
+                    raise RateLimitWaitError(f"Rate limit wait of {wait:.1f}s exceeds the remaining {deadline - now:.1f}s")
+                bucket.num_waits += 1
+                bucket.wait_time += wait
+            await asyncio.sleep(wait)
+
+    def record_usage(self, api_key: str, reserved: int, used: int) -> None:
+        with self._lock:
+            bucket = self._buckets.get(api_key)
+            if bucket is None:
+                return
+            bucket.num_tokens += used
+            if bucket.tpm:
+                bucket.tokens = min(bucket.tpm, bucket.tokens + reserved - used)
+
+    def stats(self) -> list[dict[str, Any]]:
+        with self._lock:
+            return [
+                {
+                    'key': api_key_id(key),
+                    'rpm': bucket.rpm,
+                    'tpm': bucket.tpm,
+                    'requests': bucket.num_requests,
+                    'tokens': bucket.num_tokens,
+                    'waits': bucket.num_waits,
+                    'wait_time': bucket.wait_time,
+                    'active': bucket.active,
+                }
+                for key, bucket in self._buckets.items()
+            ]
+
+
+_limiter = _RateLimiter()
+
+# The API key whose concurrency slot is held by the current task (and the
+# tasks it starts), if any, so that calls within a background job use the
+# job's slot.
+_slot_key: ContextVar[str | None] = ContextVar('rate_limit_slot_key', default=None)
+
+
+def estimate_tokens(messages: list[dict[str, str]], max_tokens: int) -> int:
+    ''' Estimate the tokens used by a chat completion: roughly 4 characters
+    per token of input, plus the maximum response length. '''
+    return sum(len(msg['content']) for msg in messages) // 4 + max_tokens
+
+
+def parse_rate_limits(form: ImmutableMultiDict[str, str]) -> tuple[int | None, int | None]:
+    ''' Read the RPM and TPM limits from a submitted form.  Blank means no
+    limit; raises ValueError for anything but blank or a positive integer. '''
+    limits = []
+    for name in ('rate_limit_rpm', 'rate_limit_tpm'):
+        value = form.get(name, '').strip()
+        if not value:
+            limits.append(None)
+        elif not value.isdecimal() or int(value) < 1:
+            raise ValueError(f"Invalid rate limit: {value!r}")
+        else:
+            limits.append(int(value))
+    return limits[0], limits[1]
+
+
+def set_rate_limits(api_key: str, rpm: int | None, tpm: int | None) -> None:
+    ''' Set (or update) the limits for an API key.  None means no limit. '''
+    _limiter.set_limits(api_key, rpm, tpm)
+
+
+async def acquire_rate_limit(api_key: str, tokens: int) -> None:
+    ''' Wait until a call using the given (estimated) number of tokens is
+    allowed by the API key's limits.  Raises RateLimitWaitError if that would
+    take longer than RATE_LIMIT_MAX_WAIT seconds. '''
+    await _limiter.acquire(api_key, tokens, current_app.config['RATE_LIMIT_MAX_WAIT'])
+
+
+@asynccontextmanager
+async def concurrency_slot(api_key: str, max_wait: float | None) -> AsyncIterator[None]:
+    ''' Hold one of the API key's LLM_CONCURRENCY_PER_KEY concurrency slots,
+    waiting up to max_wait seconds (or indefinitely, if None) for one to be
+    free; raises RateLimitWaitError if none is.  Calls made within the context
+    use this slot rather than taking another. '''
+    if _slot_key.get() == api_key:
+        yield
+        return
+
+    await _limiter.acquire_slot(api_key, current_app.config['LLM_CONCURRENCY_PER_KEY'], max_wait)
+    prev_key = _slot_key.get()
+    _slot_key.set(api_key)
+    try:
+        yield
+    finally:
+        _slot_key.set(prev_key)
+        _limiter.release_slot(api_key)
+
+
+@asynccontextmanager
+async def rate_limited(api_key: str, tokens: int) -> AsyncIterator[None]:
+    ''' Make a call using the given (estimated) number of tokens within the
+    API key's limits: wait for a concurrency slot, held until the context
+    exits, and then for the key's rate limits (see acquire_rate_limit()). '''
+    async with concurrency_slot(api_key, current_app.config['RATE_LIMIT_MAX_WAIT']):
+        await acquire_rate_limit(api_key, tokens)
+        yield
+
+
+def record_usage(api_key: str, reserved: int, used: int) -> None:
+    ''' Record a completed call's actual token usage, returning any
+    over-estimate (reserved - used) to the API key's allowance. '''
+    _limiter.record_usage(api_key, reserved, used)
+
+
+def get_rate_limit_stats() -> list[dict[str, Any]]:
+    return _limiter.stats()
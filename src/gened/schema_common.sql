@@ -18,6 +18,13 @@ DROP TABLE IF EXISTS classes_user;
 DROP TABLE IF EXISTS demo_links;
 DROP TABLE IF EXISTS migrations;
 DROP TABLE IF EXISTS models;
+DROP TABLE IF EXISTS completion_cache;
+DROP TABLE IF EXISTS completion_cache_stats;
+DROP TABLE IF EXISTS llm_calls;
+DROP TABLE IF EXISTS user_query_counts;
+DROP TABLE IF EXISTS role_query_counts;
+DROP TABLE IF EXISTS user_query_totals;
+DROP TABLE IF EXISTS role_query_totals;
 
 PRAGMA foreign_keys = ON;  -- back on for good
 
@@ -27,6 +34,8 @@ CREATE TABLE consumers (
     lti_secret    TEXT,
     openai_key    TEXT,
     model_id      INTEGER NOT NULL DEFAULT 1,  -- gpt-3.5
+    rate_limit_rpm  INTEGER,  -- requests per minute allowed for openai_key; NULL = no limit
+    rate_limit_tpm  INTEGER,  -- tokens per minute allowed for openai_key; NULL = no limit
     created       TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY(model_id) REFERENCES models(id)
 );
@@ -111,6 +120,8 @@ CREATE TABLE classes_user (
     class_id         INTEGER PRIMARY KEY,  -- references classes.id
     openai_key       TEXT,
     model_id         INTEGER NOT NULL DEFAULT 1,  -- gpt-3.5
+    rate_limit_rpm   INTEGER,  -- requests per minute allowed for openai_key; NULL = no limit
+    rate_limit_tpm   INTEGER,  -- tokens per minute allowed for openai_key; NULL = no limit
     link_ident       TEXT NOT NULL UNIQUE,  -- random (unguessable) identifier used in access/registration link for this class
     link_reg_expires DATE NOT NULL,  -- registration active for the class link if this date is in the future (anywhere on Earth)
     creator_user_id  INTEGER NOT NULL,  -- references users.id
@@ -132,6 +143,10 @@ CREATE TABLE roles (
     FOREIGN KEY(user_id) REFERENCES users(id),
     FOREIGN KEY(class_id) REFERENCES classes(id)
 );
+DROP INDEX IF EXISTS roles_by_user_class;
+CREATE INDEX roles_by_user_class ON roles(user_id, class_id);
+DROP INDEX IF EXISTS roles_by_class;
+CREATE INDEX roles_by_class ON roles(class_id);
 
 -- Store/manage demonstration links
 CREATE TABLE demo_links (
@@ -164,3 +179,71 @@ INSERT INTO models(name, shortname, model) VALUES
     ('OpenAI GPT-4 Turbo', 'GPT-4', 'gpt-4-1106-preview')
 ;
 
+-- Cache of completed responses, keyed by a hash of the model and normalized prompt(s)
+CREATE TABLE completion_cache (
+    key             TEXT PRIMARY KEY,
+    model           TEXT NOT NULL,
+    responses_json  TEXT NOT NULL,
+    texts_json      TEXT NOT NULL,
+    hits            INTEGER NOT NULL DEFAULT 0,
+    created         TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    last_used       TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+DROP INDEX IF EXISTS completion_cache_by_last_used;
+CREATE INDEX completion_cache_by_last_used ON completion_cache(last_used);
+DROP INDEX IF EXISTS completion_cache_by_created;
+CREATE INDEX completion_cache_by_created ON completion_cache(created);
+
+-- Hit/miss counters for the completion cache
+CREATE TABLE completion_cache_stats (
+    name   TEXT PRIMARY KEY,
+    count  INTEGER NOT NULL DEFAULT 0
+);
+
+-- One row per LLM API call, for usage/cost reporting and capacity planning
+-- (query_id and chat_id refer to an application's queries / tutor_chats, if applicable)
+CREATE TABLE llm_calls (
+    id                 INTEGER PRIMARY KEY AUTOINCREMENT,
+    call_time          TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    user_id            INTEGER,
+    class_id           INTEGER,
+    kind               TEXT,  -- what the prompt is for, e.g. 'main', 'cleanup', 'sufficient', 'topics', 'tutor'
+    query_id           INTEGER,
+    chat_id            INTEGER,
+    model              TEXT,
+    prompt_tokens      INTEGER,
+    completion_tokens  INTEGER,
+    latency            REAL,  -- seconds, including any retries
+    finish_reason      TEXT,
+    error              TEXT,  -- exception class name, if the call failed
+    retries            INTEGER NOT NULL DEFAULT 0
+);
+DROP INDEX IF EXISTS llm_calls_by_time;
+CREATE INDEX llm_calls_by_time ON llm_calls(call_time);
+DROP INDEX IF EXISTS llm_calls_by_class_time;
+CREATE INDEX llm_calls_by_class_time ON llm_calls(class_id, call_time);
+
+-- Number of queries per user and per role, by day (UTC) and in total, for
+-- usage counts in the admin, instructor, and profile pages.  Maintained by
+-- triggers on an application's queries table (see queries_count_insert in its
+-- schema).
+CREATE TABLE user_query_counts (
+    user_id  INTEGER NOT NULL,
+    day      DATE NOT NULL,
+    count    INTEGER NOT NULL,
+    PRIMARY KEY (user_id, day)
+) WITHOUT ROWID;
+CREATE TABLE role_query_counts (
+    role_id  INTEGER NOT NULL,
+    day      DATE NOT NULL,
+    count    INTEGER NOT NULL,
+    PRIMARY KEY (role_id, day)
+) WITHOUT ROWID;
+CREATE TABLE user_query_totals (
+    user_id  INTEGER PRIMARY KEY,
+    count    INTEGER NOT NULL
+);
+CREATE TABLE role_query_totals (
+    role_id  INTEGER PRIMARY KEY,
+    count    INTEGER NOT NULL
+);
@@ -0,0 +1,138 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import atexit
+import sqlite3
+import threading
+import time
+
+from flask import current_app, g
+
+from .db import get_db, queue_write, run_write
+
+# Accounting for the free query tokens used by users without an active class.
+#
+# By default, each token is spent with a single conditional UPDATE, so
+# concurrent requests cannot over-spend a user's tokens, and the write lock is
+# held only for that one statement.
+#
+# Optionally (TOKEN_BATCH_INTERVAL set to a number of seconds), spending is
+# done against in-memory reservations, and the accumulated spends are written
+# to the database in one transaction every TOKEN_BATCH_INTERVAL seconds.  This
+# removes the database write from the request path entirely, but it is only
+# safe when the application runs in a single process: balances are tracked in
+# that process's memory.
+#
+# A token spent for a request is refunded if an LLM call in that request
+# returns an error (see refund_spent_token()).
+
+
+class _TokenBatcher:
+    ''' In-memory token reservations, flushed to the database periodically. '''
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Keyed by (database path, user_id)
+        self._balances: dict[tuple[str, int], int] = {}  # tokens available, net of pending spends
+        self._pending: dict[tuple[str, int], int] = {}  # spends not yet written to the database
+        self._thread: threading.Thread | None = None
+
+    def _ensure_thread(self, interval: float) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, args=[interval], name="gened-token-batcher", daemon=True)
+            self._thread.start()
+
+    def _run(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            self.flush()
+
+    def reserve(self, db_path: str, user_id: int, interval: float) -> bool:
+        key = (db_path, user_id)
+        with self._lock:
+            self._ensure_thread(interval)
+            if key not in self._balances:
+                db = get_db()
+                row = db.execute("SELECT query_tokens FROM users WHERE id=?", [user_id]).fetchone()
+                self._balances[key] = row['query_tokens']
+            if self._balances[key] <= 0:
+                return False
+            self._balances[key] -= 1
+            self._pending[key] = self._pending.get(key, 0) + 1
+            return True
+
+    def refund(self, db_path: str, user_id: int) -> None:
+        key = (db_path, user_id)
+        with self._lock:
+            if key in self._balances:
+                self._balances[key] += 1
+            self._pending[key] = self._pending.get(key, 0) - 1
+
+    def flush(self) -> None:
+        ''' Write all pending spends to the database.
+
+        The lock is held throughout, so no reservation can read a balance from
+        the database before pending spends are written.  Flushed balances are
+        dropped, to be re-read (picking up any other changes) on next use.
+        '''
+        with self._lock:
+            by_db: dict[str, list[tuple[int, int]]] = {}
+            for (db_path, user_id), count in self._pending.items():
+                if count != 0:
+                    by_db.setdefault(db_path, []).append((count, user_id))
+
+            for db_path, updates in by_db.items():
+                db = sqlite3.connect(db_path)
+                with db:
+                    db.executemany("UPDATE users SET query_tokens=MAX(query_tokens-?, 0) WHERE id=?", updates)
+                db.close()
+
+            for key in self._pending:
+                self._balances.pop(key, None)
+            self._pending.clear()
+
+
+_batcher = _TokenBatcher()
+atexit.register(_batcher.flush)
+
+
+def spend_token(user_id: int) -> bool:
+    ''' Spend one of a user's query tokens.
+
+    Returns True if a token was spent, or False if the user has none left.
+    The spend is recorded in the request context, for refund_spent_token().
+    '''
+    interval = current_app.config['TOKEN_BATCH_INTERVAL']
+    if interval:
+        spent = _batcher.reserve(current_app.config['DATABASE'], user_id, interval)
+    else:
+        row = run_write(lambda db: db.execute("UPDATE users SET query_tokens=query_tokens-1 WHERE id=? AND query_tokens>0 RETURNING query_tokens", [user_id]).fetchone())
+        spent = row is not None
+
+    if spent:
+        g.spent_token_user_id = user_id
+    return spent
+
+
+def refund_spent_token() -> None:
+    ''' Refund the token spent in the current request, if any.  At most one
+    refund is made per spend, however many times this is called.
+
+    May be called from the LLM event loop thread (which runs in a copy of the
+    request's context), so it does not use the request's database connection;
+    the refund is queued with queue_write().
+    '''
+    user_id = g.pop('spent_token_user_id', None)
+    if user_id is None:
+        return
+
+    interval = current_app.config['TOKEN_BATCH_INTERVAL']
+    if interval:
+        _batcher.refund(current_app.config['DATABASE'], user_id)
+    else:
+        queue_write(lambda db: db.execute("UPDATE users SET query_tokens=query_tokens+1 WHERE id=?", [user_id]))
+
+
+def flush_token_batches() -> None:
+    ''' Write any batched token spends to the database now. '''
+    _batcher.flush()
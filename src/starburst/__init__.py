@@ -22,6 +22,7 @@ def create_app(test_config: dict[str, str] | None = None, instance_path: Path |
         HELP_LINK_TEXT='Generate Ideas',
         DATABASE_NAME='starburst.db',
         DOCS_DIR=module_dir / 'docs',
+        QUERY_SEARCH_COLUMNS=['assignment', 'topics', 'response_text'],
     )
 
     # load test config if provided, potentially overriding above config
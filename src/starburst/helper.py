@@ -7,8 +7,8 @@ import json
 
 from flask import Blueprint, redirect, render_template, request, url_for
 from gened.auth import class_enabled_required, get_auth, login_required
-from gened.db import get_db
-from gened.openai import LLMDict, get_completion, with_llm
+from gened.db import get_db, run_write
+from gened.openai import LLMDict, get_completion, run_async, with_llm
 from gened.queries import get_history, get_query
 from werkzeug.wrappers.response import Response
 
@@ -42,7 +42,7 @@ def help_view(query_id: int) -> str:
     return render_template("help_view.html", query=query_row, responses=responses, history=history)
 
 
-async def run_query_prompts(llm_dict: LLMDict, assignment: str, topics: str) -> tuple[list[dict[str, str]], dict[str, str]]:
+async def run_query_prompts(llm_dict: LLMDict, assignment: str, topics: str, query_id: int | None = None) -> tuple[list[dict[str, str]], dict[str, str]]:
     ''' Run the given query against the coding help system of prompts.
 
     Returns a tuple containing:
@@ -56,6 +56,8 @@ async def run_query_prompts(llm_dict: LLMDict, assignment: str, topics: str) ->
             api_key=api_key,
             prompt=prompts.make_main_prompt(assignment, topics),
             model=model,
+            kind='main',
+            query_id=query_id,
         )
     )
 
@@ -72,7 +74,7 @@ async def run_query_prompts(llm_dict: LLMDict, assignment: str, topics: str) ->
 def run_query(llm_dict: LLMDict, assignment: str, topics: str) -> int:
     query_id = record_query(assignment, topics)
 
-    responses, texts = asyncio.run(run_query_prompts(llm_dict, assignment, topics))
+    responses, texts = run_async(run_query_prompts(llm_dict, assignment, topics, query_id))
 
     record_response(query_id, responses, texts)
 
@@ -80,29 +82,23 @@ def run_query(llm_dict: LLMDict, assignment: str, topics: str) -> int:
 
 
 def record_query(assignment: str, topics: str) -> int:
-    db = get_db()
     auth = get_auth()
     role_id = auth['role_id']
 
-    cur = db.execute(
+    new_row_id = run_write(lambda db: db.execute(
         "INSERT INTO queries (assignment, topics, user_id, role_id) VALUES (?, ?, ?, ?)",
         [assignment, topics, auth['user_id'], role_id]
-    )
-    new_row_id = cur.lastrowid
-    db.commit()
+    ).lastrowid)
 
     assert new_row_id is not None
     return new_row_id
 
 
 def record_response(query_id: int, responses: list[dict[str, str]], texts: dict[str, str]) -> None:
-    db = get_db()
-
-    db.execute(
+    run_write(lambda db: db.execute(
         "UPDATE queries SET response_json=?, response_text=? WHERE id=?",
         [json.dumps(responses), json.dumps(texts), query_id]
-    )
-    db.commit()
+    ))
 
 
 @bp.route("/request", methods=["POST"])
@@ -0,0 +1,12 @@
+-- SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+--
+-- SPDX-License-Identifier: AGPL-3.0-only
+
+BEGIN;
+
+-- (user_id, query_time): a user's history, newest first, without a sort
+CREATE INDEX queries_by_user_time ON queries(user_id, query_time);
+-- (role_id, query_time): queries in a class (via roles); covers per-role counts of all and recent queries
+CREATE INDEX queries_by_role_time ON queries(role_id, query_time);
+
+COMMIT;
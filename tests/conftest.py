@@ -35,6 +35,13 @@ def app(monkeypatch):
         return {'main': txt}, txt
     monkeypatch.setattr(codehelp.helper, 'get_completion', mock_completion)
 
+    async def mock_completion_stream(*args, **kwargs):
+        prompt = kwargs['prompt'] if 'prompt' in kwargs else args[1]
+        txt = f"Mocked completion with {prompt=}"
+        for i in range(0, len(txt), 10):
+            yield txt[i:i+10]
+    monkeypatch.setattr(codehelp.helper, 'get_completion_stream', mock_completion_stream)
+
     # Create an app and initialize the DB
     db_fd, db_path = tempfile.mkstemp()
 
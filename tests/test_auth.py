@@ -5,7 +5,8 @@
 import re
 import pytest
 
-from gened.auth import get_auth
+from gened.auth import get_auth, invalidate_auth
+from gened.db import get_db
 
 
 def test_login_page(client):
@@ -128,3 +129,65 @@ def test_auth_required(client, auth, path, nologin, withlogin, withadmin):
     auth.logout()
     response = client.get(path)
     assert response.status_code == nologin
+
+
+def _user_auth(client, path='/'):
+    with client:
+        client.get(path)
+        return get_auth()
+
+
+def test_auth_cached(app, client, auth):
+    auth.login()  # testuser (id 11)
+    assert _user_auth(client)['display_name'] == 'testuser'
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET auth_name='renamed' WHERE id=11")
+        db.commit()
+    assert _user_auth(client)['display_name'] == 'testuser'  # cached
+
+    with app.app_context():
+        invalidate_auth(11)
+    app.config['AUTH_CACHE_TTL'] = 0
+    assert _user_auth(client)['display_name'] == 'renamed'
+
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET auth_name='renamed again' WHERE id=11")
+        db.commit()
+    assert _user_auth(client)['display_name'] == 'renamed again'  # expired
+
+
+def test_auth_invalidated_by_instructor(app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (4, 13, 1, 'instructor')")
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (5, 11, 1, 'student')")
+        db.commit()
+
+    student = app.test_client()
+    student.post('/auth/login', data={'username': 'testuser', 'password': 'testpassword'})
+    student.get('/classes/switch/1')
+    student_auth = _user_auth(student)
+    assert student_auth['role_id'] == 5
+    assert student_auth['role'] == 'student'
+
+    instructor = app.test_client()
+    instructor.post('/auth/login', data={'username': 'testinstructor', 'password': 'testinstructorpassword'})
+    instructor.get('/classes/switch/1')
+
+    assert instructor.post('/instructor/role/set_instructor/5/1').text == 'okay'
+    assert _user_auth(student)['role'] == 'instructor'
+
+    assert instructor.post('/instructor/role/set_active/5/0').text == 'okay'
+    student_auth = _user_auth(student)
+    assert student_auth['role_id'] is None
+    assert student_auth['class_id'] is None
+
+    # disabling the class removes it from its other users' lists of classes
+    assert instructor.post('/instructor/role/set_active/5/1').text == 'okay'
+    student.get('/classes/leave/')
+    assert [c['class_id'] for c in _user_auth(student)['other_classes']] == [1]
+    instructor.post('/instructor/user_class/set', data={'save_access_form': ''}, headers={'Referer': '/instructor/'})
+    assert _user_auth(student)['other_classes'] == []
@@ -0,0 +1,133 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import sqlite3
+
+import pytest
+
+from gened.backup import list_snapshots, restore_snapshot, take_snapshot
+from gened.db import backup_db, get_db
+
+
+def _query_ids(db_file):
+    con = sqlite3.connect(db_file)
+    try:
+        assert con.execute("PRAGMA integrity_check").fetchone()[0] == 'ok'
+        return [row[0] for row in con.execute("SELECT id FROM queries ORDER BY id")]
+    finally:
+        con.close()
+
+
+def _add_queries(app, ids):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            "INSERT INTO queries (id, language, code, issue, user_id, role_id) VALUES (?, 'python', ?, 'issue', 21, 1)",
+            [(i, f"code{i}" * 200) for i in ids]
+        )
+        db.commit()
+
+
+def test_backup_db_stepped(app, tmp_path):
+    _add_queries(app, range(10, 100))
+    app.config['BACKUP_STEP_PAGES'] = 2
+    app.config['BACKUP_STEP_SLEEP'] = 0
+    target = tmp_path / 'backup.db'
+    with app.app_context():
+        backup_db(target)
+        with pytest.raises(FileExistsError):
+            backup_db(target)
+    assert _query_ids(target) == [1, 2, 3, 4, *range(10, 100)]
+
+
+def test_snapshots_restore(app, tmp_path):
+    snapshot_dir = tmp_path / 'snapshots'
+    expected = {}
+    with app.app_context():
+        full = take_snapshot(snapshot_dir)
+        expected[full.name] = [1, 2, 3, 4]
+
+        _add_queries(app, range(10, 20))
+        diff1 = take_snapshot(snapshot_dir)
+        expected[diff1.name] = [1, 2, 3, 4, *range(10, 20)]
+
+        db = get_db()
+        db.execute("DELETE FROM queries WHERE id < 15")
+        db.commit()
+        diff2 = take_snapshot(snapshot_dir)
+        expected[diff2.name] = list(range(15, 20))
+
+    assert full.full
+    assert not diff1.full
+    assert not diff2.full
+    assert diff1.size < full.size
+    assert [s.name for s in list_snapshots(snapshot_dir)] == [full.name, diff1.name, diff2.name]
+
+    for name, ids in expected.items():
+        target = tmp_path / f'{name}.db'
+        with app.app_context():
+            restore_snapshot(name, target, snapshot_dir)
+        assert _query_ids(target) == ids
+
+    with app.app_context(), pytest.raises(FileExistsError):
+        restore_snapshot(full.name, tmp_path / f'{full.name}.db', snapshot_dir)
+    with app.app_context(), pytest.raises(FileNotFoundError):
+        restore_snapshot('nonsense', tmp_path / 'other.db', snapshot_dir)
+
+
+def test_snapshot_chains_evicted(app, tmp_path):
+    snapshot_dir = tmp_path / 'snapshots'
+    app.config['BACKUP_SNAPSHOT_FULL_EVERY'] = 2
+    app.config['BACKUP_SNAPSHOT_KEEP_CHAINS'] = 2
+    with app.app_context():
+        snapshots = []
+        for i in range(7):
+            _add_queries(app, [10 + i])
+            snapshots.append(take_snapshot(snapshot_dir))
+
+    assert [s.full for s in snapshots] == [True, False, True, False, True, False, True]
+    # chains: [0, 1], [2, 3], [4, 5], [6] -> the last two remain
+    assert list_snapshots(snapshot_dir) == snapshots[4:]
+
+    target = tmp_path / 'restored.db'
+    with app.app_context():
+        restore_snapshot(snapshots[5].name, target, snapshot_dir)
+    assert _query_ids(target) == [1, 2, 3, 4, *range(10, 16)]
+
+
+def test_snapshot_commands(app, runner, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'instance_path', str(tmp_path))
+
+    result = runner.invoke(args=['backup-snapshot'])
+    assert result.exit_code == 0
+    assert "Snapshot (full," in result.output
+    result = runner.invoke(args=['backup-snapshot'])
+    assert "Snapshot (diff," in result.output
+
+    result = runner.invoke(args=['backup-list'])
+    lines = result.output.splitlines()
+    assert len(lines) == 2
+    name = lines[1].split()[0]
+
+    target = tmp_path / 'restored.db'
+    result = runner.invoke(args=['backup-restore', name, str(target)])
+    assert result.exit_code == 0
+    assert _query_ids(target) == [1, 2, 3, 4]
+
+    result = runner.invoke(args=['backup-restore', name, str(target)])
+    assert result.exit_code != 0
+    assert "already exists" in result.output
+
+
+def test_admin_database_snapshots(app, client, auth, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'instance_path', str(tmp_path))
+    auth.login('testadmin', 'testadminpassword')
+
+    response = client.get('/admin/database/')
+    assert "No snapshots yet" in response.text
+
+    with app.app_context():
+        snapshot = take_snapshot()
+    response = client.get('/admin/database/')
+    assert snapshot.name in response.text
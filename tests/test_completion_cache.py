@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import pytest
+
+import codehelp.helper
+from gened.completion_cache import make_cache_key
+from gened.db import get_db
+
+
+@pytest.fixture
+def completion_counter(monkeypatch):
+    calls = []
+    mock_completion = codehelp.helper.get_completion
+
+    async def counting_completion(*args, **kwargs):
+        calls.append(kwargs)
+        return await mock_completion(*args, **kwargs)
+    monkeypatch.setattr(codehelp.helper, 'get_completion', counting_completion)
+    return calls
+
+
+def _post_query(client, code):
+    return client.post(
+        '/help/request',
+        data={'lang_id': 1, 'code': code, 'error': 'test error', 'issue': 'test_issue'}
+    )
+
+
+def test_make_cache_key():
+    assert make_cache_key("model", "a  \r\nb\n") == make_cache_key("model", "a\nb")
+    assert make_cache_key("model", "a") != make_cache_key("other_model", "a")
+    assert make_cache_key("model", "a", "b") != make_cache_key("model", "ab")
+
+
+def test_cache_hit(client, auth, completion_counter):
+    auth.login('testadmin', 'testadminpassword')
+
+    response1 = _post_query(client, "_test_code_")
+    num_calls = len(completion_counter)
+    assert num_calls > 0
+
+    response2 = _post_query(client, "_test_code_  \r\n")  # same query after normalization
+    assert len(completion_counter) == num_calls  # no new completions
+    assert response1.location != response2.location  # but it is recorded as a new query
+
+    view1 = client.get(response1.location)
+    view2 = client.get(response2.location)
+    assert "Mocked completion" in view2.text
+    assert view1.text.count("Mocked completion") == view2.text.count("Mocked completion")
+
+    response = client.get('/admin/completion_cache/')
+    assert "<th>Hits</th><td class=\"has-text-right\">1</td>" in response.text
+    assert "<th>Misses</th><td class=\"has-text-right\">1</td>" in response.text
+
+
+def test_cache_eviction(app, client, auth):
+    app.config['COMPLETION_CACHE_MAX_ENTRIES'] = 2
+    auth.login()
+
+    for i in range(4):
+        _post_query(client, f"_test_code_{i}_")
+
+    with app.app_context():
+        count = get_db().execute("SELECT COUNT(*) FROM completion_cache").fetchone()[0]
+    assert count == 2
+
+
+def test_cache_expired(app, client, auth, completion_counter):
+    app.config['COMPLETION_CACHE_TTL'] = 0
+    auth.login()
+
+    _post_query(client, "_test_code_")
+    num_calls = len(completion_counter)
+    _post_query(client, "_test_code_")
+    assert len(completion_counter) == 2 * num_calls
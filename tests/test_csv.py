@@ -0,0 +1,70 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import csv
+import gzip
+import io
+
+import pytest
+
+import gened.csv
+from gened.db import get_db
+
+
+def _read_csv(text):
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+@pytest.mark.parametrize('chunk_rows', [1, 3, 1000])
+def test_admin_queries_csv(client, auth, monkeypatch, chunk_rows):
+    monkeypatch.setattr(gened.csv, 'CHUNK_ROWS', chunk_rows)
+    auth.login('testadmin', 'testadminpassword')
+
+    response = client.get('/admin/csv/queries/')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/csv'
+    assert 'Content-Encoding' not in response.headers
+    assert response.headers['Content-Disposition'].endswith("_admin_export_queries.csv")
+    rows = _read_csv(response.text)
+    assert sorted(int(row['id']) for row in rows) == [1, 2, 3, 4]
+    assert {row['code'] for row in rows} == {'code1', 'code2', 'code3', 'code4'}
+
+    response = client.get('/admin/csv/queries/', query_string={'user': 21})
+    assert sorted(int(row['id']) for row in _read_csv(response.text)) == [1, 3]
+
+
+def test_csv_gzip(app, client, auth):
+    auth.login('testadmin', 'testadminpassword')
+    plain = client.get('/admin/csv/queries/').text
+
+    response = client.get('/admin/csv/queries/', headers={'Accept-Encoding': 'gzip, deflate'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.data).decode('utf-8') == plain
+
+    app.config['CSV_GZIP'] = False
+    response = client.get('/admin/csv/queries/', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.text == plain
+
+
+def test_csv_empty(client, auth):
+    auth.login('testadmin', 'testadminpassword')
+    response = client.get('/admin/csv/queries/', query_string={'user': 11})
+    assert "There are no rows to export yet." in response.text
+
+
+def test_instructor_csv(app, client, auth):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (4, 13, 1, 'instructor')")
+        db.commit()
+    auth.login('testinstructor', 'testinstructorpassword')
+    client.get('/classes/switch/1')
+
+    response = client.get('/instructor/csv/queries')
+    assert sorted(int(row['id']) for row in _read_csv(response.text)) == [1, 2, 3, 4]
+
+    response = client.get('/instructor/csv/users')
+    assert sorted(int(row['id']) for row in _read_csv(response.text)) == [13, 21, 22, 23]
@@ -2,13 +2,17 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import threading
+
 import pytest
 import sqlite3
 
-from gened.db import get_db
+import gened.db
+from gened.db import flush_writes, get_db, get_db_pool_stats, get_db_ro, get_db_writer_stats, queue_write, run_write
 
 
 def test_get_close_db(app):
+    app.config['DB_POOL'] = False
     with app.app_context():
         db = get_db()
         assert db is get_db()
@@ -19,6 +23,90 @@ def test_get_close_db(app):
     assert 'closed' in str(e.value)
 
 
+def test_db_pool(app):
+    with app.app_context():
+        db = get_db()
+        assert db.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+        assert db.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        db.execute("UPDATE users SET query_tokens=99")  # not committed
+        with app.app_context():
+            nested_db = get_db()  # a nested app context gets its own connection
+            assert nested_db is not db
+
+    stats = get_db_pool_stats()
+    with app.app_context():
+        reused_db = get_db()  # a connection is reused (just one of the two is kept)
+        assert reused_db is db or reused_db is nested_db
+        assert 99 not in [row['query_tokens'] for row in reused_db.execute("SELECT query_tokens FROM users")]  # rolled back
+
+    new_stats = get_db_pool_stats()
+    assert new_stats['reused'] == stats['reused'] + 1
+    assert new_stats['opened'] == stats['opened']
+
+
+def test_get_db_ro(app):
+    with app.app_context():
+        db_ro = get_db_ro()
+        assert db_ro is not get_db()
+        assert db_ro.execute("SELECT COUNT(*) FROM users").fetchone()[0] > 0
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            db_ro.execute("UPDATE users SET query_tokens=99")
+
+
+@pytest.mark.parametrize('writer', [True, False])
+def test_run_write(app, writer):
+    app.config['DB_WRITER'] = writer
+    with app.app_context():
+        new_id = run_write(lambda db: db.execute("INSERT INTO users (auth_provider, auth_name) VALUES (1, 'writer')").lastrowid)
+
+        def fail(db):
+            db.execute("UPDATE users SET auth_name='changed' WHERE id=?", [new_id])
+            raise ValueError("failed write")
+        with pytest.raises(ValueError, match="failed write"):
+            run_write(fail)
+
+        queue_write(lambda db: db.execute("UPDATE users SET query_tokens=7 WHERE id=?", [new_id]))
+        flush_writes()
+
+        row = get_db().execute("SELECT * FROM users WHERE id=?", [new_id]).fetchone()
+        assert row['auth_name'] == 'writer'  # the failed write was rolled back
+        assert row['query_tokens'] == 7
+
+
+def test_run_write_in_transaction(app):
+    stats = get_db_writer_stats()
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET query_tokens=42 WHERE id=11")  # not committed: holds the write lock
+        run_write(lambda db: db.execute("UPDATE users SET query_tokens=43 WHERE id=12"))  # made on this connection, committing both
+        assert not db.in_transaction
+        assert [row['query_tokens'] for row in db.execute("SELECT query_tokens FROM users WHERE id IN (11, 12) ORDER BY id")] == [42, 43]
+    assert get_db_writer_stats()['writes'] == stats['writes']
+
+
+def test_group_commit(app):
+    threads = 8
+    writes = 50
+    stats = get_db_writer_stats()
+
+    def worker(n):
+        with app.app_context():
+            for i in range(writes):
+                run_write(lambda db: db.execute("INSERT INTO users (auth_provider, auth_name) VALUES (1, ?)", [f"group{n}-{i}"]))
+
+    workers = [threading.Thread(target=worker, args=[n]) for n in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT(*) FROM users WHERE auth_name LIKE 'group%'").fetchone()[0] == threads * writes
+    new_stats = get_db_writer_stats()
+    assert new_stats['writes'] - stats['writes'] == threads * writes
+    assert new_stats['commits'] - stats['commits'] <= threads * writes
+
+
 def test_init_db_command(runner, monkeypatch):
     class Recorder:
         called = False
@@ -30,3 +118,22 @@ def test_init_db_command(runner, monkeypatch):
     result = runner.invoke(args=['initdb'])
     assert 'Initialized' in result.output
     assert Recorder.called
+
+
+def test_db_explain(runner, monkeypatch):
+    result = runner.invoke(args=['db-explain'])
+    assert result.exit_code == 0
+    assert "No full scans" in result.output
+
+    monkeypatch.setitem(gened.db._explain_statements, 'unindexed', ("SELECT * FROM queries WHERE issue=?", frozenset()))
+    result = runner.invoke(args=['db-explain'])
+    assert result.exit_code == 1
+    assert "unindexed: full scan of queries" in result.output
+
+
+def test_database_admin(client, auth):
+    auth.login('testadmin', 'testadminpassword')
+    response = client.get('/admin/database/')
+    assert response.status_code == 200
+    assert "busy_timeout" in response.text
+    assert "Largest group commit" in response.text
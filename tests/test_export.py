@@ -0,0 +1,126 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import json
+
+import pytest
+
+from gened.db import get_db
+
+
+def _add_data(app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO queries (id, language, code, issue, user_id, role_id, query_time) VALUES (10, 'python', 'oldcode', 'x', 21, 1, '2023-02-03 04:05:06')")
+        chat = [{'role': 'assistant', 'content': 'hello'}, {'role': 'user', 'content': 'hi'}]
+        db.execute("INSERT INTO tutor_chats (id, topic, chat_json, user_id, role_id) VALUES (3, 'loops', ?, 21, 1)", [json.dumps(chat)])
+        db.commit()
+
+
+def _read_jsonl(path):
+    with path.open() as f:
+        return [json.loads(line) for line in f]
+
+
+def test_export_jsonl(app, runner, tmp_path):
+    _add_data(app)
+
+    result = runner.invoke(args=['export', str(tmp_path)])
+    assert result.exit_code == 0
+    assert "queries: 5 rows in 2 files (last id 10)" in result.output
+
+    old = _read_jsonl(tmp_path / 'queries' / 'month=2023-02' / 'part-from-1.jsonl')
+    assert len(old) == 1
+    assert old[0]['code'] == 'oldcode'
+    assert old[0]['query_time'] == '2023-02-03T04:05:06'
+    assert old[0]['class_id'] == 1
+    assert 'month' not in old[0]
+
+    recent = sorted(tmp_path.glob('queries/month=*/part-from-1.jsonl'))[-1]
+    rows = _read_jsonl(recent)
+    assert [row['id'] for row in rows] == [1, 2, 3, 4]
+    assert rows[0]['response_text'] == {'main': 'response1'}  # decoded JSON
+
+    messages = _read_jsonl(tmp_path / 'tutor_chat_messages' / 'part-from-1.jsonl')
+    assert len(messages) == 6
+    assert [(m['chat_id'], m['seq'], m['role'], m['content']) for m in messages[-2:]] == [(3, 0, 'assistant', 'hello'), (3, 1, 'user', 'hi')]
+    chats = _read_jsonl(tmp_path / 'tutor_chats' / 'part-from-1.jsonl')
+    assert [(chat['id'], chat['class_id'], chat['num_messages']) for chat in chats] == [(1, None, 2), (2, None, 2), (3, 1, 2)]
+
+    counts = _read_jsonl(tmp_path / 'user_query_counts' / 'data.jsonl')
+    assert sum(row['count'] for row in counts) == 5
+
+    state = json.loads((tmp_path / 'export_state.json').read_text())
+    assert state['queries'] == 10
+    assert state['tutor_chats'] == 3
+
+
+def test_export_incremental(app, runner, tmp_path):
+    result = runner.invoke(args=['export', '-d', 'queries', str(tmp_path)])
+    assert result.exit_code == 0
+
+    _add_data(app)
+    result = runner.invoke(args=['export', '-d', 'queries', '--incremental', str(tmp_path)])
+    assert result.exit_code == 0
+    assert "queries: 1 rows after id 4 in 1 files (last id 10)" in result.output
+    rows = _read_jsonl(tmp_path / 'queries' / 'month=2023-02' / 'part-from-5.jsonl')
+    assert [row['id'] for row in rows] == [10]
+
+    # nothing new
+    result = runner.invoke(args=['export', '-d', 'queries', '--incremental', str(tmp_path)])
+    assert "queries: 0 rows after id 10 in 0 files (last id 10)" in result.output
+
+    result = runner.invoke(args=['export', '-d', 'queries', '--since', '3', str(tmp_path / 'other')])
+    assert "queries: 2 rows after id 3" in result.output
+
+
+def test_export_unknown_dataset(runner, tmp_path):
+    result = runner.invoke(args=['export', '-d', 'nonsense', str(tmp_path)])
+    assert result.exit_code != 0
+    assert "Unknown dataset: nonsense" in result.output
+
+
+def test_export_parquet(app, runner, tmp_path):
+    pq = pytest.importorskip('pyarrow.parquet')
+    _add_data(app)
+
+    result = runner.invoke(args=['export', '--format', 'parquet', str(tmp_path)])
+    assert result.exit_code == 0
+    table = pq.read_table(tmp_path / 'queries' / 'month=2023-02' / 'part-from-1.parquet')
+    assert table.column('code').to_pylist() == ['oldcode']
+    messages = pq.read_table(tmp_path / 'tutor_chat_messages' / 'part-from-1.parquet')
+    assert messages.column('content').to_pylist()[-2:] == ['hello', 'hi']
+
+
+def test_admin_export(app, client, auth):
+    _add_data(app)
+    auth.login('testadmin', 'testadminpassword')
+
+    response = client.get('/admin/export/')
+    assert response.status_code == 200
+    assert 'tutor_chat_messages' in response.text
+
+    response = client.get('/admin/export/download', query_string={'dataset': 'queries', 'format': 'jsonl', 'since': 3})
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'].endswith('.jsonl')
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row['id'] for row in rows] == [4, 10]
+
+    assert client.get('/admin/export/download', query_string={'dataset': 'nonsense'}).status_code == 404
+    assert client.get('/admin/export/download', query_string={'dataset': 'queries', 'format': 'xml'}).status_code == 404
+
+
+def test_admin_export_parquet(app, client, auth):
+    pq = pytest.importorskip('pyarrow.parquet')
+    import pyarrow as pa
+    _add_data(app)
+    auth.login('testadmin', 'testadminpassword')
+
+    response = client.get('/admin/export/download', query_string={'dataset': 'llm_calls', 'format': 'parquet'})
+    assert response.status_code == 200
+    assert pq.read_table(pa.BufferReader(response.data)).num_rows == 0  # an empty, but valid, file
+
+    response = client.get('/admin/export/download', query_string={'dataset': 'queries', 'format': 'parquet', 'since': 3})
+    table = pq.read_table(pa.BufferReader(response.data))
+    assert table.column('id').to_pylist() == [4, 10]
@@ -0,0 +1,63 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+from concurrent.futures import ThreadPoolExecutor
+
+import gened.filters
+from gened.filters import get_markdown_processor
+
+TEXT = "Some *emphasis*, a list:\n\n1. one\n2. two\n\n```\nif x < 1:\n    print('<b>')\n```\n"
+
+
+def test_markdown_filter(app):
+    markdown = app.jinja_env.filters['markdown']
+    with app.app_context():
+        html = markdown(TEXT)
+        assert "<em>emphasis</em>" in html
+        assert "<li>two</li>" in html
+        assert "&lt;b&gt;" in html  # escaped, once
+        assert markdown(TEXT) == html
+
+
+def test_markdown_cached(app, monkeypatch):
+    markdown = app.jinja_env.filters['markdown']
+    conversions = []
+    real_convert = get_markdown_processor().__class__.convert
+
+    def counting_convert(self, source):
+        conversions.append(source)
+        return real_convert(self, source)
+
+    monkeypatch.setattr(get_markdown_processor().__class__, 'convert', counting_convert)
+    app.config['MARKDOWN_CACHE_SIZE'] = 2
+    with app.app_context():
+        markdown("cached text")
+        markdown("cached text")
+        assert len(conversions) == 1
+
+        markdown("other text 1")
+        markdown("other text 2")  # evicts "cached text"
+        markdown("cached text")
+        assert len(conversions) == 4
+        assert len(gened.filters._markdown_cache) == 2
+
+
+def test_markdown_threads(app):
+    markdown = app.jinja_env.filters['markdown']
+    texts = [f"{TEXT}\nMessage *{i}*" for i in range(200)]
+    with app.app_context():
+        expected = [str(markdown(text)) for text in texts]
+    gened.filters._markdown_cache.clear()
+
+    def render(text):
+        with app.app_context():
+            return str(markdown(text))
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        assert list(pool.map(render, texts)) == expected
+
+    # each thread has its own processor, reused
+    assert get_markdown_processor() is get_markdown_processor()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        assert pool.submit(get_markdown_processor).result() is not get_markdown_processor()
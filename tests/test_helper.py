@@ -2,8 +2,15 @@
 #
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import json
+
 import pytest
 
+import codehelp.helper
+from codehelp.class_config import get_class_config
+from codehelp.keywords import KeywordMatcher
+from gened.db import get_db
+
 
 @pytest.mark.parametrize(('lang_id'), (0, 1, 2))
 def test_saved_language(app, client, auth, lang_id):
@@ -40,3 +47,166 @@ def test_query(client, auth, username, password):
     for code, path in results:
         response = client.get(path)
         assert code in response.text
+
+
+def _parse_events(text):
+    events = []
+    for message in text.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in message.split("\n"))
+        events.append((lines['event'], json.loads(lines['data'])))
+    return events
+
+
+def test_query_stream(client, auth):
+    auth.login()
+
+    code = "_test_stream_code_"
+    response = client.post(
+        '/help/request/stream',
+        data={'lang_id': 1, 'code': code, 'error': 'test error', 'issue': 'test_issue'}
+    )
+    assert response.mimetype == "text/event-stream"
+
+    events = _parse_events(response.text)
+    assert events[0][0] == 'query'
+    assert events[-1][0] == 'done'
+    streamed = "".join(data for event, data in events if event == 'delta')
+    assert code in streamed
+
+    response = client.get(events[-1][1])
+    assert code in response.text
+
+
+def test_query_stream_cleanup(monkeypatch, client, auth):
+    """ Text w/ code should not be streamed; it is replaced by the cleanup response. """
+    async def mock_completion_stream(*args, **kwargs):
+        prompt = kwargs['prompt']
+        if "_test_code_" in prompt:
+            yield "Your code should look like"
+            yield "```\n_solution_code_\n```"
+        else:
+            yield "_cleaned_up_"
+    monkeypatch.setattr(codehelp.helper, 'get_completion_stream', mock_completion_stream)
+
+    auth.login()
+    response = client.post(
+        '/help/request/stream',
+        data={'lang_id': 1, 'code': '_test_code_', 'error': 'test error', 'issue': 'test_issue'}
+    )
+    events = _parse_events(response.text)
+    assert ('reset', '') in events
+    assert "_solution_code_" not in response.text
+    assert ('delta', "_cleaned_up_") in events
+
+
+@pytest.mark.parametrize('speculative', [False, True])
+def test_query_speculative_cleanup(monkeypatch, app, client, auth, speculative):
+    """ With SPECULATIVE_CLEANUP, the main response is cut off at the first sign of code and the text so far is cleaned up. """
+    app.config['SPECULATIVE_CLEANUP'] = speculative
+    main_chunks = []
+    cleanup_prompts = []
+
+    async def mock_completion_stream(*args, **kwargs):
+        prompt = kwargs['prompt']
+        if "_test_code_" in prompt:
+            for chunk in ["Try this.  ", "Your code should look like", "```\n_solution_code_\n```", "  _more_text_"]:
+                main_chunks.append(chunk)
+                yield chunk
+        else:
+            cleanup_prompts.append(prompt)
+            yield "CleanedUpText"
+    monkeypatch.setattr(codehelp.helper, 'get_completion_stream', mock_completion_stream)
+
+    auth.login()
+    response = client.post(
+        '/help/request/stream',
+        data={'lang_id': 1, 'code': '_test_code_', 'error': 'test error', 'issue': 'test_issue'}
+    )
+    events = _parse_events(response.text)
+    assert ('delta', "CleanedUpText") in events
+    assert len(cleanup_prompts) == 1
+    if speculative:
+        assert len(main_chunks) == 2  # stopped at "should look like"
+        assert "_solution_code_" not in cleanup_prompts[0]
+    else:
+        assert len(main_chunks) == 4
+        assert "_more_text_" in cleanup_prompts[0]
+
+    # the non-streaming path does the same (w/ a different query, to avoid the completion cache)
+    main_chunks.clear()
+    cleanup_prompts.clear()
+    response = client.post(
+        '/help/request',
+        data={'lang_id': 1, 'code': '_test_code_ 2', 'error': 'test error', 'issue': 'test_issue'}
+    )
+    response = client.get(response.location)
+    if speculative:
+        assert "CleanedUpText" in response.text
+        assert len(main_chunks) == 2
+    else:
+        assert not main_chunks  # uses get_completion() (mocked)
+
+
+@pytest.mark.parametrize(('candidate_txt', 'cleaned_up'), [("No code here.", False), ("```\ncode\n```", True)])
+def test_query_candidates(monkeypatch, app, client, auth, candidate_txt, cleaned_up):
+    """ With RESPONSE_CANDIDATES > 1, the cleanup prompt is only used if the chosen candidate has code. """
+    app.config['RESPONSE_CANDIDATES'] = 3
+    candidate_kwargs = []
+
+    async def mock_candidates(*args, **kwargs):
+        candidate_kwargs.append(kwargs)
+        return {'candidates': kwargs['n']}, candidate_txt
+    monkeypatch.setattr(codehelp.helper, 'get_completion_candidates', mock_candidates)
+
+    auth.login()
+    response = client.post(
+        '/help/request',
+        data={'lang_id': 1, 'code': '_test_code_', 'error': 'test error', 'issue': 'test_issue'}
+    )
+    response = client.get(response.location)
+    assert candidate_kwargs[0]['n'] == 3
+    # the mocked get_completion() (used for the cleanup) echoes its prompt
+    assert ("rewrite the following to remove any code blocks" in response.text) == cleaned_up
+
+
+def test_score_response():
+    avoid = KeywordMatcher(['sum()', 'eval()', '', 'sum()'])
+    assert avoid.keywords == {'sum()', 'eval()'}
+    assert codehelp.helper.score_response("Try a loop.", avoid) == 0
+    assert codehelp.helper.score_response("Use sum() or sum() or eval().", avoid) == -3
+    assert codehelp.helper.score_response("It should look like:\n```\nsum()\n```", avoid) == -301
+
+
+@pytest.mark.parametrize('piece_len', [1, 3, 7, 100])
+def test_response_scorer(piece_len):
+    avoid = KeywordMatcher(['sum()', 'aa', 'should'])
+    text = "It should look like sum() -- aaaa, sum(\n```\nsum()```should look something like"
+    feed = codehelp.helper.response_scorer(avoid)
+    scores = [feed(text[i:i+piece_len]) for i in range(0, len(text), piece_len)]
+    assert scores[-1] == codehelp.helper.score_response(text, avoid) == -6 - 400
+    assert scores == sorted(scores, reverse=True)  # never increases
+
+
+def test_class_config_cached(app, client):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (4, 13, 1, 'instructor')")
+        db.commit()
+    client.post('/auth/login', data={'username': 'testinstructor', 'password': 'testinstructorpassword'})
+    client.get('/classes/switch/1')
+
+    with client:
+        client.get('/help/')
+        config = get_class_config()
+        assert config.avoid_set == frozenset({'sum()', 'eval()', 'zfill()', '+='})
+        assert config.avoid_matcher.count("sum() += 1") == 2
+    with client:
+        client.get('/help/')
+        assert get_class_config() is config  # parsed once, shared across requests
+
+    client.post('/instructor/config/set', data={'languages[]': ['Python'], 'default_lang': 'Python', 'avoid': 'print()\nlen()'})
+    with client:
+        client.get('/help/')
+        config = get_class_config()
+        assert config.avoid_set == frozenset({'print()', 'len()'})
+        assert config.languages == ['Python']
@@ -0,0 +1,136 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+
+import codehelp.helper
+from codehelp.similar import index_query, set_query_helpful
+from gened.db import flush_writes, get_db
+from gened.jobs import enqueue_job, get_queue_depth, wait_for_jobs
+
+
+def test_query_job(app, client, auth):
+    app.config['BACKGROUND_JOBS'] = True
+    auth.login()
+
+    response = client.get('/help/')
+    assert "stream_request($el" not in response.text  # the form is submitted normally
+
+    response = client.post('/help/request', data={'lang_id': 1, 'code': '_test_code_', 'error': 'error', 'issue': 'issue'})
+    assert response.status_code == 302
+    query_id = int(response.location.split('/')[-1])
+
+    assert wait_for_jobs(timeout=5)
+
+    response = client.get(f'/help/status/{query_id}')
+    assert response.json == {'pending': False, 'partial': ""}
+
+    response = client.get(f'/help/view/{query_id}')
+    assert '_test_code_' in response.text
+    assert 'Mocked completion' in response.text
+    assert 'poll_status' not in response.text
+
+    # topics are generated in a job as well (and the mocked completion is not a valid list of topics)
+    response = client.get(f'/help/topics/html/{query_id}')
+    assert response.status_code == 202
+    assert wait_for_jobs(timeout=5)
+    response = client.get(f'/help/topics/html/{query_id}?poll=1')
+    assert response.status_code == 200
+
+
+def test_concurrency_per_key(app):
+    app.config['LLM_CONCURRENCY_PER_KEY'] = 2
+    running = {'a': 0, 'b': 0}
+    max_running = {'a': 0, 'b': 0}
+    results = []
+
+    async def job(key):
+        running[key] += 1
+        max_running[key] = max(max_running[key], running[key])
+        await asyncio.sleep(0.05)
+        running[key] -= 1
+        return key
+
+    with app.app_context():
+        for i in range(6):
+            enqueue_job(f"test_a:{i}", "sk-test-key-aaaa", job('a'), results.append)
+        enqueue_job("test_b:0", "sk-test-key-bbbb", job('b'), results.append)
+        enqueue_job("test_a:0", "sk-test-key-aaaa", job('a'), results.append)  # duplicate name: ignored
+        assert get_queue_depth() >= 4
+
+    assert wait_for_jobs(timeout=5)
+    assert get_queue_depth() == 0
+    assert sorted(results) == ['a'] * 6 + ['b']
+    assert max_running == {'a': 2, 'b': 1}
+
+
+def test_pending_job_refunds_token(app, client, auth):
+    app.config['BACKGROUND_JOBS'] = True
+    # make testuser a token-based (non-local) user
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET auth_provider=2, query_tokens=5 WHERE id=11")
+        db.commit()
+    auth.login()
+
+    def get_tokens():
+        with app.app_context():
+            flush_writes()  # refunds are queued writes
+            return get_db().execute("SELECT query_tokens FROM users WHERE id=11").fetchone()['query_tokens']
+
+    async def slow_job():
+        await asyncio.sleep(0.5)
+
+    # a chat message sent while the previous one is still pending: no LLM call, so no token spent
+    with app.app_context():
+        enqueue_job("chat:1", "sk-test-key-chat", slow_job(), lambda result: None)
+    response = client.post('/tutor/message', data={'id': 1, 'message': 'another message'}, follow_redirects=True)
+    assert "Please wait for a response" in response.text
+    assert get_tokens() == 5
+
+    # polling for topics that are still being generated
+    with app.app_context():
+        enqueue_job("topics:1", "sk-test-key-topics", slow_job(), lambda result: None)
+    response = client.get('/help/topics/html/1')
+    assert response.status_code == 202
+    response = client.get('/help/topics/html/1?poll=1')
+    assert response.status_code == 202
+    assert get_tokens() == 5
+
+    assert wait_for_jobs(timeout=5)
+
+
+def test_query_job_shows_similar(app, client, auth, monkeypatch):
+    app.config['BACKGROUND_JOBS'] = True
+    code, issue = "def total(values):\n    return sum(values)\n", "It returns the wrong total for my list."
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (5, 11, 1, 'student')")
+        db.execute("INSERT INTO queries (id, language, code, issue, response_text, helpful, user_id, role_id) VALUES (100, 'Python', ?, ?, '{\"main\": \"earlier-helpful-response\"}', 1, 21, 1)",
+                   [code, issue])
+        index_query(db, 100, 1, code, "", issue)
+        set_query_helpful(db, 100, True)
+        db.commit()
+
+    async def slow_prompts_stream(*args, **kwargs):
+        await asyncio.sleep(0.5)
+        yield 'result', ([], {'main': "new response"})
+    monkeypatch.setattr(codehelp.helper, 'run_query_prompts_stream', slow_prompts_stream)
+
+    auth.login()
+    client.get('/classes/switch/1')
+    response = client.post('/help/request', data={'lang_id': 0, 'code': code, 'error': '', 'issue': issue})
+    query_id = int(response.location.split('/')[-1])
+
+    # shown while the new response is still being generated
+    with app.app_context():
+        flush_writes()
+    response = client.get(f'/help/view/{query_id}')
+    assert 'poll_status' in response.text
+    assert 'earlier-helpful-response' in response.text
+
+    assert wait_for_jobs(timeout=5)
+    response = client.get(f'/help/view/{query_id}')
+    assert 'new response' in response.text
+    assert 'earlier-helpful-response' in response.text
@@ -0,0 +1,86 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+from contextlib import aclosing
+
+import openai
+from flask import g
+
+from gened.db import flush_writes, get_db
+from gened.openai import get_completion, get_completion_stream, iter_async, run_async
+
+
+def test_llm_calls_recorded(app, monkeypatch):
+    app.config['LLM_RETRY_BASE_DELAY'] = 0.01
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        if kwargs.get('stream'):
+            raise openai.error.AuthenticationError("invalid key")
+        if len(calls) == 1:
+            raise openai.error.Timeout("timed out")
+        return openai.openai_object.OpenAIObject.construct_from({
+            'choices': [{'message': {'content': "response"}, 'finish_reason': "stop"}],
+            'usage': {'prompt_tokens': 12, 'completion_tokens': 34, 'total_tokens': 46},
+        })
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with app.app_context():
+        g.auth = {'user_id': 11, 'class_id': 2}
+        run_async(get_completion("sk-test-calls", prompt="test", model="calls-model", kind='main', query_id=5))
+        "".join(iter_async(get_completion_stream("sk-test-calls", prompt="test", model="calls-model", kind='tutor', chat_id=3)))
+
+    with app.app_context():
+        flush_writes()
+        rows = get_db().execute("SELECT * FROM llm_calls ORDER BY id").fetchall()
+
+    assert len(rows) == 2
+    assert dict(rows[0]) | {'id': None, 'call_time': None, 'latency': None} == {
+        'id': None, 'call_time': None, 'latency': None,
+        'user_id': 11, 'class_id': 2, 'kind': 'main', 'query_id': 5, 'chat_id': None, 'model': "calls-model",
+        'prompt_tokens': 12, 'completion_tokens': 34, 'finish_reason': "stop", 'error': None, 'retries': 1,
+    }
+    assert rows[0]['latency'] > 0
+    assert rows[1]['kind'] == 'tutor'
+    assert rows[1]['chat_id'] == 3
+    assert rows[1]['error'] == "AuthenticationError"
+
+
+def test_llm_usage_admin(app, client, auth):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO llm_calls (class_id, kind, model, prompt_tokens, completion_tokens, latency) VALUES (2, 'main', 'calls-model', 100, 200, 1.5)")
+        db.commit()
+
+    auth.login('testadmin', 'testadminpassword')
+    response = client.get('/admin/llm_usage/')
+    assert response.status_code == 200
+    assert "calls-model" in response.text
+
+
+def test_llm_call_cancelled_stream(app, monkeypatch):
+    async def mock_acreate(*args, **kwargs):
+        async def chunks():
+            for _ in range(100):
+                yield openai.openai_object.OpenAIObject.construct_from({'choices': [{'delta': {'content': "xxxx"}, 'finish_reason': None}]})
+        return chunks()
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    async def take_two():
+        texts = []
+        async with aclosing(get_completion_stream("sk-test-calls", prompt="test", model="calls-model")) as stream:
+            async for text in stream:
+                texts.append(text)
+                if len(texts) == 2:
+                    break
+        return texts
+
+    with app.app_context():
+        assert run_async(take_two()) == ["xxxx", "xxxx"]
+        flush_writes()
+        row = get_db().execute("SELECT * FROM llm_calls").fetchone()
+
+    assert row['finish_reason'] == 'cancelled'
+    assert row['completion_tokens'] == 2
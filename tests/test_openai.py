@@ -0,0 +1,217 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+import threading
+
+import openai
+import pytest
+from flask import current_app
+
+from gened.openai import _latencies, get_completion, get_completion_candidates, run_async
+
+
+def _response(text):
+    return openai.openai_object.OpenAIObject.construct_from({
+        'choices': [{'message': {'content': text}, 'finish_reason': "stop"}],
+        'usage': {'total_tokens': 10},
+    })
+
+
+def test_run_async_shared_loop(app):
+    async def where_am_i():
+        await asyncio.sleep(0)
+        return threading.current_thread().name, asyncio.get_running_loop(), current_app.name
+
+    with app.app_context():
+        thread1, loop1, app_name = run_async(where_am_i())
+        thread2, loop2, _ = run_async(where_am_i())
+
+    # runs on the persistent loop (not the calling thread), w/ the caller's app context
+    assert thread1 != threading.current_thread().name
+    assert loop1 is loop2
+    assert app_name == app.name
+
+
+def test_run_async_exception():
+    async def fail():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError, match="failed"):
+        run_async(fail())
+
+
+@pytest.mark.parametrize(('failures', 'expected'), [
+    (0, "response"),
+    (2, "response"),
+    (3, "Error (ServiceUnavailableError)"),  # LLM_RETRIES=2 allows 3 attempts
+])
+def test_completion_retries(app, monkeypatch, failures, expected):
+    app.config['LLM_RETRY_BASE_DELAY'] = 0.01
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        if len(calls) <= failures:
+            raise openai.error.ServiceUnavailableError("overloaded")
+        return _response("response")
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with app.app_context():
+        _, text = run_async(get_completion("sk-test-retry", prompt="test", model="retry-model"))
+
+    assert text.startswith(expected)
+    assert len(calls) == min(failures + 1, 3)
+
+
+def test_completion_no_retry(app, monkeypatch):
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        raise openai.error.AuthenticationError("invalid key")
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with app.app_context():
+        _, text = run_async(get_completion("sk-test-retry", prompt="test", model="retry-model"))
+
+    assert text.startswith("Error (AuthenticationError)")
+    assert len(calls) == 1
+
+
+def test_completion_deadline(app, monkeypatch):
+    app.config['LLM_DEADLINE'] = 0.2
+
+    async def mock_acreate(*args, **kwargs):
+        await asyncio.sleep(5)
+        return _response("response")
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with app.app_context():
+        _, text = run_async(get_completion("sk-test-retry", prompt="test", model="deadline-model"))
+
+    assert text.startswith("Error (Timeout)")
+
+
+def test_completion_inner_timeout_retried(app, monkeypatch):
+    # a timeout within the request (e.g., from the HTTP client) is a transient
+    # error to retry, not the overall deadline passing
+    app.config['LLM_RETRY_BASE_DELAY'] = 0.01
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            raise asyncio.TimeoutError
+        return _response("response")
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with app.app_context():
+        _, text = run_async(get_completion("sk-test-retry", prompt="test", model="inner-timeout-model"))
+
+    assert text == "response"
+    assert len(calls) == 2
+
+
+def test_completion_hedged(app, monkeypatch):
+    app.config['LLM_HEDGE'] = True
+    app.config['LLM_HEDGE_MIN_SAMPLES'] = 5
+    for _ in range(5):
+        _latencies.record("hedge-model", 0.05)
+
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        if len(calls) == 1:
+            await asyncio.sleep(5)  # the first request stalls
+            return _response("slow")
+        return _response("fast")
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with app.app_context():
+        _, text = run_async(get_completion("sk-test-hedge", prompt="test", model="hedge-model"))
+
+    assert text == "fast"
+    assert len(calls) == 2
+
+
+def _mock_candidates_stream(monkeypatch, candidates):
+    """ Mock a streamed n>1 completion; chunks are interleaved from the given lists of candidate chunks. """
+    sent = []
+
+    async def mock_acreate(*args, **kwargs):
+        assert kwargs['n'] == len(candidates)
+
+        async def chunks():
+            for step in range(max(len(c) for c in candidates)):
+                for i, candidate in enumerate(candidates):
+                    if step < len(candidate):
+                        sent.append((i, candidate[step]))
+                        last = step == len(candidate) - 1
+                        yield openai.openai_object.OpenAIObject.construct_from({'choices': [
+                            {'index': i, 'delta': {'content': candidate[step]}, 'finish_reason': "stop" if last else None}
+                        ]})
+        return chunks()
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+    return sent
+
+
+def _bad_count(text):
+    return -100 * text.count("CODE")
+
+
+def test_candidates_first_good(app, monkeypatch):
+    sent = _mock_candidates_stream(monkeypatch, [
+        ["a1 ", "CODE ", "a3 ", "a4 ", "a5"],
+        ["b1 ", "b2"],
+        ["c1 ", "c2 ", "c3"],
+    ])
+    with app.app_context():
+        summary, text = run_async(get_completion_candidates("sk-test-candidates", prompt="test", model="m", n=3, score_func=_bad_count))
+
+    assert text == "b1 b2"
+    assert summary['chosen'] == 1
+    assert summary['scores'][0] == -100
+    assert len(sent) == 5  # stopped as soon as candidate 1 finished
+
+
+def test_candidates_all_bad(app, monkeypatch):
+    sent = _mock_candidates_stream(monkeypatch, [
+        ["a1 ", "a2 ", "CODE ", "a4", "a5"],
+        ["CODE ", "b2 ", "b3", "b4"],
+    ])
+    with app.app_context():
+        summary, text = run_async(get_completion_candidates("sk-test-candidates", prompt="test", model="m", n=2, score_func=_bad_count, abandon_at=-100))
+        _, full_text = run_async(get_completion_candidates("sk-test-candidates", prompt="test", model="m", n=2, score_func=_bad_count))
+
+    assert summary['chosen'] == 0
+    assert text == "a1 a2 CODE"  # abandoned once every candidate had code
+    assert len(sent) == 5 + 9
+    assert full_text == "a1 a2 CODE a4a5"  # w/o abandon_at, all finish and the best (first, on ties) is used
+
+
+def test_candidates_incremental_scorer(app, monkeypatch):
+    pieces = []
+
+    def new_scorer():
+        score = 0
+
+        def feed(piece):
+            nonlocal score
+            pieces.append(piece)
+            score += _bad_count(piece)
+            return score
+        return feed
+
+    _mock_candidates_stream(monkeypatch, [
+        ["a1 ", "CODE ", "a3"],
+        ["b1 ", "b2 ", "b3 ", "b4"],
+    ])
+    with app.app_context():
+        summary, text = run_async(get_completion_candidates("sk-test-candidates", prompt="test", model="m", n=2, new_scorer=new_scorer))
+
+    assert text == "b1 b2 b3 b4"
+    assert summary['scores'] == [-100, 0]
+    assert "CODE " in pieces  # scorers are given each new piece, not the whole text
@@ -0,0 +1,148 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import re
+
+import pytest
+
+from gened.db import get_db
+
+COLS = "id,display_name,query_time,code"
+
+
+@pytest.fixture
+def instructor_client(app, client, auth):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (4, 13, 1, 'instructor')")
+        # more queries in class 1, several sharing a query_time to exercise the (query_time, id) keyset
+        db.executemany(
+            "INSERT INTO queries (id, language, code, issue, user_id, role_id, query_time) VALUES (?, 'python', ?, 'issue', 21, 1, ?)",
+            [(i, f"pagecode{i}", f"2024-01-01 10:00:{i // 3:02}") for i in range(10, 30)]
+        )
+        db.commit()
+    app.config['QUERIES_PAGE_SIZE'] = 7
+    auth.login('testinstructor', 'testinstructorpassword')
+    client.get('/classes/switch/1')
+    return client
+
+
+def _fetch_all(client, url, **args):
+    ids = []
+    cursor = None
+    pages = 0
+    while True:
+        response = client.get(url, query_string={'cols': COLS, **args} | ({'cursor': cursor} if cursor else {}))
+        assert response.status_code == 200
+        ids.extend(int(row[0]) for row in response.json['rows'])
+        pages += 1
+        cursor = response.json['next']
+        if cursor is None:
+            return ids, pages
+
+
+def test_instructor_pages(instructor_client):
+    ids, pages = _fetch_all(instructor_client, '/instructor/queries.json')
+    # queries 1-4 have the current time, so come first (newest first)
+    assert ids == [4, 3, 2, 1, *range(29, 9, -1)]
+    assert pages == 4
+
+    # the page itself renders only the first page
+    response = instructor_client.get('/instructor/')
+    assert 'pagecode27' in response.text
+    assert 'pagecode26' not in response.text
+    assert '"2024-01-01 10:00:09,27"' in response.text  # next_cursor
+
+
+def test_instructor_order_and_search(instructor_client):
+    response = instructor_client.get('/instructor/queries.json', query_string={'cols': COLS, 'order': 'asc'})
+    assert [int(row[0]) for row in response.json['rows']] == list(range(10, 17))
+
+    response = instructor_client.get('/instructor/queries.json', query_string={'cols': COLS, 'q': 'pagecode1'})
+    assert sorted(int(row[0]) for row in response.json['rows']) == list(range(10, 20))[-7:]
+    assert response.json['next'] is not None
+
+    # LIKE wildcards are matched literally
+    response = instructor_client.get('/instructor/queries.json', query_string={'cols': COLS, 'q': '%'})
+    assert response.json['rows'] == []
+    assert response.json['next'] is None
+
+
+def test_instructor_user_filter(instructor_client):
+    ids, _ = _fetch_all(instructor_client, '/instructor/queries.json', user=22)
+    assert ids == [2]
+
+
+def test_invalid_requests(instructor_client):
+    assert instructor_client.get('/instructor/queries.json', query_string={'cols': COLS, 'cursor': 'nonsense'}).status_code == 400
+    assert instructor_client.get('/instructor/queries.json', query_string={'cols': 'id,response_json'}).status_code == 200
+    assert instructor_client.get('/instructor/queries.json', query_string={'cols': 'id,no_such_column'}).status_code == 400
+
+
+def test_cells_escaped(instructor_client, app):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO queries (id, language, code, issue, user_id, role_id) VALUES (100, 'python', '<script>', 'issue', 21, 1)")
+        db.commit()
+    response = instructor_client.get('/instructor/queries.json', query_string={'cols': COLS})
+    row = response.json['rows'][0]
+    assert row[0] == "100"
+    assert row[3] == "&lt;script&gt;"
+
+
+def test_admin_pages(app, client, auth):
+    app.config['QUERIES_PAGE_SIZE'] = 3
+    auth.login('testadmin', 'testadminpassword')
+
+    ids, pages = _fetch_all(client, '/admin/queries.json')
+    assert sorted(ids) == [1, 2, 3, 4]
+    assert pages == 2
+
+    ids, _ = _fetch_all(client, '/admin/queries.json', user=21)
+    assert sorted(ids) == [1, 3]
+
+    response = client.get('/admin/')
+    assert response.status_code == 200
+    assert re.search(r'/admin/queries\.json.*?next: "', response.text, re.DOTALL)  # the queries table has a next page
+
+
+def test_admin_tables_paged(app, client, auth):
+    app.config['QUERIES_PAGE_SIZE'] = 2
+    auth.login('testadmin', 'testadminpassword')
+
+    with app.app_context():
+        db = get_db()
+        user_ids = [row['id'] for row in db.execute("SELECT id FROM users ORDER BY id DESC")]
+        class1_ids = [row['user_id'] for row in db.execute("SELECT DISTINCT user_id FROM roles WHERE class_id=1 ORDER BY user_id DESC")]
+        num_roles = db.execute("SELECT COUNT(*) FROM roles").fetchone()[0]
+    assert len(user_ids) > 2
+
+    # every row reachable, newest first
+    ids, pages = _fetch_all(client, '/admin/users.json', cols='id,display_name')
+    assert ids == user_ids
+    assert pages == (len(user_ids) + 1) // 2
+
+    ids, _ = _fetch_all(client, '/admin/users.json', cols='id,display_name', order='asc')
+    assert ids == user_ids[::-1]
+
+    ids, _ = _fetch_all(client, '/admin/users.json', cols='id,display_name', **{'class': 1})
+    assert ids == class1_ids
+
+    ids, _ = _fetch_all(client, '/admin/roles.json', cols='id,role')
+    assert len(ids) == num_roles
+
+    ids, _ = _fetch_all(client, '/admin/users.json', cols='id,display_name', q='testadmin')
+    assert len(ids) == 1
+
+    # the consumers table's rows have their edit buttons
+    response = client.get('/admin/consumers.json', query_string={'cols': 'id,lti_consumer'})
+    assert len(response.json['rows'][0]) == 3
+    assert "/admin/consumer/" in response.json['rows'][0][2]
+
+    assert client.get('/admin/users.json', query_string={'cols': 'id', 'cursor': 'nonsense'}).status_code == 400
+
+    # the page shows the first page of each, with the cursor for the next
+    response = client.get('/admin/')
+    assert response.status_code == 200
+    assert re.search(r'/admin/users\.json.*?next: "' + str(user_ids[1]) + '"', response.text, re.DOTALL)
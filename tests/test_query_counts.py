@@ -0,0 +1,51 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+from gened.db import get_db
+from gened.instructor import get_users
+
+
+def _counts_match(db):
+    by_user = db.execute("SELECT user_id, date(query_time) AS day, COUNT(*) AS count FROM queries GROUP BY 1, 2 ORDER BY 1, 2").fetchall()
+    by_role = db.execute("SELECT role_id, date(query_time) AS day, COUNT(*) AS count FROM queries WHERE role_id IS NOT NULL GROUP BY 1, 2 ORDER BY 1, 2").fetchall()
+    user_counts = db.execute("SELECT user_id, CAST(day AS TEXT), count FROM user_query_counts WHERE count > 0 ORDER BY 1, 2").fetchall()
+    role_counts = db.execute("SELECT role_id, CAST(day AS TEXT), count FROM role_query_counts WHERE count > 0 ORDER BY 1, 2").fetchall()
+    user_totals = db.execute("SELECT user_id, SUM(count) FROM user_query_counts GROUP BY 1 HAVING SUM(count) > 0 ORDER BY 1").fetchall()
+    role_totals = db.execute("SELECT role_id, SUM(count) FROM role_query_counts GROUP BY 1 HAVING SUM(count) > 0 ORDER BY 1").fetchall()
+    return [tuple(row) for row in by_user] == [tuple(row) for row in user_counts] \
+        and [tuple(row) for row in by_role] == [tuple(row) for row in role_counts] \
+        and [tuple(row) for row in user_totals] == [tuple(row) for row in db.execute("SELECT * FROM user_query_totals WHERE count > 0 ORDER BY 1")] \
+        and [tuple(row) for row in role_totals] == [tuple(row) for row in db.execute("SELECT * FROM role_query_totals WHERE count > 0 ORDER BY 1")]
+
+
+def test_query_counts_maintained(app):
+    with app.app_context():
+        db = get_db()
+        assert _counts_match(db)  # from the test data
+
+        db.execute("INSERT INTO queries (language, code, issue, user_id, role_id) VALUES ('python', 'x', 'y', 21, 1)")
+        db.execute("INSERT INTO queries (language, code, issue, user_id, role_id, query_time) VALUES ('python', 'x', 'y', 11, NULL, '2020-01-01 10:00:00')")
+        db.commit()
+        assert _counts_match(db)
+
+        db.execute("DELETE FROM queries WHERE id IN (1, 2)")
+        db.commit()
+        assert _counts_match(db)
+
+        users = {row['id']: row for row in get_users(1)}
+        assert users[21]['num_queries'] == 2
+        assert users[21]['num_recent_queries'] == 2
+        assert users[22]['num_queries'] == 0
+
+
+def test_profile_counts(app, client, auth):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO queries (language, code, issue, user_id) VALUES ('python', 'x', 'y', 11)")
+        db.execute("INSERT INTO queries (language, code, issue, user_id, query_time) VALUES ('python', 'x', 'y', 11, '2020-01-01 10:00:00')")
+        db.commit()
+
+    auth.login()
+    response = client.get('/profile/')
+    assert "2 total, 1 in the past week" in response.text
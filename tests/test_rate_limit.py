@@ -0,0 +1,202 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+
+import openai
+import pytest
+
+from werkzeug.datastructures import ImmutableMultiDict
+
+from gened.db import get_db
+from gened.openai import MAX_TOKENS, get_completion, get_completion_candidates, get_completion_stream, run_async
+from gened.rate_limit import _Bucket, acquire_rate_limit, get_rate_limit_stats, parse_rate_limits, record_usage, set_rate_limits
+
+
+def test_bucket():
+    bucket = _Bucket(rpm=2, tpm=1000, updated=0.0)
+    assert bucket.take(400, now=0.0) == 0
+    assert bucket.take(400, now=0.0) == 0
+    assert bucket.take(100, now=0.0) == pytest.approx(30)  # out of requests: 30s until one more
+    assert bucket.take(900, now=30.0) == pytest.approx(12)  # 700 tokens after 30s; 200 more takes 12s
+    assert bucket.take(900, now=42.0) == 0
+    assert bucket.take(5000, now=200.0) == 0  # larger than the limit: allowed once the bucket is full
+
+
+def test_bucket_set_limits():
+    bucket = _Bucket(rpm=2, tpm=None, updated=0.0)
+    bucket.set_limits(rpm=100, tpm=None, now=0.0)
+    assert bucket.requests == 2  # not refilled to the new limit
+    bucket.set_limits(rpm=1, tpm=None, now=0.0)
+    assert bucket.requests == 1  # capped at the new limit
+    bucket.set_limits(rpm=1, tpm=600, now=0.0)
+    assert bucket.tokens == 600  # newly limited: starts full
+
+
+def test_alternating_limits(app):
+    # one key shared by two classes with different limits
+    app.config['RATE_LIMIT_MAX_WAIT'] = 0.1
+    key = "sk-test-alternating"
+    with app.app_context():
+        for limits in [(2, 1000), (100, 5000)]:
+            set_rate_limits(key, *limits)
+            run_async(acquire_rate_limit(key, 400))
+        # two requests used: neither set of limits refills the bucket
+        for limits in [(2, 1000), (100, 5000)]:
+            set_rate_limits(key, *limits)
+            with pytest.raises(Exception, match="Rate limit wait"):
+                run_async(acquire_rate_limit(key, 400))
+
+
+@pytest.mark.parametrize(('rpm', 'tpm', 'result'), [
+    ('', '', (None, None)),
+    ('10', ' 2000 ', (10, 2000)),
+    ('0', '', None),
+    ('-5', '', None),
+    ('', '1.5', None),
+    ('', 'many', None),
+])
+def test_parse_rate_limits(rpm, tpm, result):
+    form = ImmutableMultiDict({'rate_limit_rpm': rpm, 'rate_limit_tpm': tpm})
+    if result is None:
+        with pytest.raises(ValueError, match="Invalid rate limit"):
+            parse_rate_limits(form)
+    else:
+        assert parse_rate_limits(form) == result
+
+
+def test_consumer_rate_limits(app, client, auth):
+    auth.login('testadmin', 'testadminpassword')
+
+    def limits():
+        with app.app_context():
+            return tuple(get_db().execute("SELECT rate_limit_rpm, rate_limit_tpm FROM consumers WHERE id=1").fetchone())
+
+    response = client.post('/admin/consumer/update', data={'consumer_id': 1, 'rate_limit_rpm': '10', 'rate_limit_tpm': ''}, follow_redirects=True)
+    assert "Consumer updated." in response.text
+    assert limits() == (10, None)
+
+    response = client.post('/admin/consumer/update', data={'consumer_id': 1, 'rate_limit_rpm': '-1', 'rate_limit_tpm': '100'}, follow_redirects=True)
+    assert "Rate limits must be positive whole numbers" in response.text
+    assert limits() == (10, None)
+
+    response = client.post('/admin/consumer/update', data={'lti_consumer': 'new', 'lti_secret': 's', 'openai_key': 'k', 'rate_limit_rpm': '0'}, follow_redirects=True)
+    assert "Rate limits must be positive whole numbers" in response.text
+    with app.app_context():
+        assert get_db().execute("SELECT COUNT(*) FROM consumers WHERE lti_consumer='new'").fetchone()[0] == 0
+
+
+def test_acquire(app):
+    app.config['RATE_LIMIT_MAX_WAIT'] = 0.5
+    set_rate_limits("sk-test-acquire", rpm=None, tpm=60)  # 1 token per second
+
+    with app.app_context():
+        run_async(acquire_rate_limit("sk-test-acquire", 60))
+        record_usage("sk-test-acquire", reserved=60, used=20)  # returns 40 tokens
+        run_async(acquire_rate_limit("sk-test-acquire", 40))
+        with pytest.raises(Exception, match="Rate limit wait"):
+            run_async(acquire_rate_limit("sk-test-acquire", 10))  # would wait 10s
+
+    stats = [row for row in get_rate_limit_stats() if row['key'] == "...uire"]
+    assert stats[0]['requests'] == 2
+    assert stats[0]['tokens'] == 20
+
+
+def test_completion_rate_limited(app, monkeypatch):
+    app.config['RATE_LIMIT_MAX_WAIT'] = 0.5
+    set_rate_limits("sk-test-completion", rpm=1, tpm=None)
+
+    calls = []
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        return openai.openai_object.OpenAIObject.construct_from({
+            'choices': [{'message': {'content': "response"}, 'finish_reason': "stop"}],
+            'usage': {'total_tokens': 10},
+        })
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', mock_acreate)
+
+    with app.app_context():
+        _, text1 = run_async(get_completion("sk-test-completion", prompt="test"))
+        _, text2 = run_async(get_completion("sk-test-completion", prompt="test"))
+
+    assert text1 == "response"
+    assert text2.startswith("Error (RateLimitError).  Too many requests")
+    assert len(calls) == 1  # the second request was never sent
+
+
+def _slow_acreate(delay, counts):
+    async def mock_acreate(*args, **kwargs):
+        counts['active'] += 1
+        counts['max'] = max(counts['max'], counts['active'])
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            counts['active'] -= 1
+        return openai.openai_object.OpenAIObject.construct_from({
+            'choices': [{'message': {'content': "response"}, 'finish_reason': "stop"}],
+            'usage': {'total_tokens': 10},
+        })
+    return mock_acreate
+
+
+def test_concurrency_limited(app, monkeypatch):
+    app.config['LLM_CONCURRENCY_PER_KEY'] = 2
+    counts = {'active': 0, 'max': 0}
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', _slow_acreate(0.1, counts))
+
+    async def calls(key, num):
+        return await asyncio.gather(*(get_completion(key, prompt="test") for _ in range(num)))
+
+    with app.app_context():
+        results = run_async(calls("sk-test-concurrency", 5))
+    assert [text for _, text in results] == ["response"] * 5
+    assert counts['max'] == 2
+
+    stats = [row for row in get_rate_limit_stats() if row['key'] == "...ency"]
+    assert stats[0]['active'] == 0
+
+    # a call that cannot get a slot within RATE_LIMIT_MAX_WAIT is not sent
+    app.config['LLM_CONCURRENCY_PER_KEY'] = 1
+    app.config['RATE_LIMIT_MAX_WAIT'] = 0.1
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', _slow_acreate(0.5, counts))
+    with app.app_context():
+        results = run_async(calls("sk-test-concurrency-wait", 2))
+    assert sorted(text[:30] for _, text in results) == ["Error (RateLimitError).  Too m", "response"]
+
+
+async def _failing_acreate(*args, **kwargs):
+    raise openai.error.APIError("failed")
+
+
+async def _collect_stream(*args, **kwargs):
+    return [text async for text in get_completion_stream(*args, **kwargs)]
+
+
+def test_failed_stream_returns_reservation(app, monkeypatch):
+    # room for one call's reservation and concurrency slot only: if a failed
+    # call did not return them, the next call would have to wait
+    app.config['RATE_LIMIT_MAX_WAIT'] = 0.1
+    app.config['LLM_CONCURRENCY_PER_KEY'] = 1
+    set_rate_limits("sk-test-failed-stream", rpm=None, tpm=MAX_TOKENS + 10)
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', _failing_acreate)
+
+    with app.app_context():
+        for _ in range(2):
+            texts = run_async(_collect_stream("sk-test-failed-stream", prompt="test", model="m"))
+            assert texts[0].startswith("Error (APIError)")
+        run_async(acquire_rate_limit("sk-test-failed-stream", MAX_TOKENS))
+
+
+def test_failed_candidates_return_reservation(app, monkeypatch):
+    app.config['RATE_LIMIT_MAX_WAIT'] = 0.1
+    app.config['LLM_CONCURRENCY_PER_KEY'] = 1
+    set_rate_limits("sk-test-failed-candidates", rpm=None, tpm=2 * MAX_TOKENS + 10)
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', _failing_acreate)
+
+    with app.app_context():
+        for _ in range(2):
+            _, text = run_async(get_completion_candidates("sk-test-failed-candidates", prompt="test", model="m", n=2, score_func=len))
+            assert text.startswith("Error (APIError)")
+        run_async(acquire_rate_limit("sk-test-failed-candidates", 2 * MAX_TOKENS))
@@ -0,0 +1,69 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import pytest
+
+from gened.auth import get_request_context, invalidate_auth
+from gened.db import get_db, get_db_queries
+from gened.llm_config import invalidate_llm_config
+
+HELP_FORM = {'code': 'code', 'error': 'error', 'issue': 'issue', 'lang_id': 0}
+
+
+@pytest.fixture
+def student_client(app, client, auth):
+    app.config['DB_COUNT_QUERIES'] = True
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (5, 11, 1, 'student')")
+        db.commit()
+    auth.login()  # testuser (id 11)
+    client.get('/classes/switch/1')
+    return client
+
+
+def _reads(queries, table):
+    return [q for q in queries if q.lstrip().startswith('SELECT') and f'FROM {table}\n' in q + '\n']
+
+
+def test_request_context(student_client):
+    with student_client:
+        student_client.get('/help/')
+        context = get_request_context()
+        assert context.auth['class_id'] == 1
+        assert context.llm_config is not None
+        assert context.llm_config.enabled
+        assert context.llm_config.openai_key == 'keeeez1'
+
+
+def test_query_budget(app, student_client):
+    # first request with a cold cache: one query for the user and one for the class
+    with app.app_context():
+        invalidate_auth()
+        invalidate_llm_config()
+    with student_client:
+        student_client.get('/help/')
+        queries = get_db_queries()
+        assert len(_reads(queries, 'users')) == 1
+        assert len(_reads(queries, 'classes')) == 1
+
+    # after that, the auth and class checks, LLM selection, and class config need none
+    with student_client:
+        response = student_client.post('/help/request', data=HELP_FORM)
+        assert response.status_code == 302
+        queries = get_db_queries()
+        assert _reads(queries, 'users') == []
+        assert _reads(queries, 'classes') == []
+        assert len(queries) <= 4
+
+
+def test_query_budget_no_class(app, client, auth):
+    app.config['DB_COUNT_QUERIES'] = True
+    auth.login()
+    client.get('/help/')
+    with client:
+        response = client.post('/help/request', data=HELP_FORM)
+        assert response.status_code == 302
+        # local users use the system key: no query for their auth provider
+        assert not any('auth_providers' in q for q in get_db_queries())
@@ -0,0 +1,97 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+from codehelp.similar import MAX_PER_BUCKET, find_similar, index_query, query_signature, set_query_helpful
+from gened import minhash
+from gened.db import get_db
+
+CODE = """\
+def total(values):
+    # add them all up
+    result = 0
+    for v in values:
+        result += v
+    return result
+"""
+
+CODE_RENAMED = """\
+def total(nums):
+    s = 0   // different comment
+    for n in nums:
+        s += n
+
+    return s
+"""
+
+ISSUE = "My function returns the wrong total for my list of numbers."
+
+
+def test_minhash_near_duplicates():
+    sig = query_signature(CODE, "", ISSUE)
+    sig_renamed = query_signature(CODE_RENAMED, "", ISSUE)
+    sig_other = query_signature("print('hello world')", "SyntaxError", "Why won't this print?")
+
+    assert minhash.similarity(sig, sig_renamed) == 1.0
+    assert minhash.similarity(sig, sig_other) < 0.3
+    assert minhash.unpack_signature(minhash.pack_signature(sig)) == sig
+
+
+def test_find_similar(app, runner):
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE queries SET code=?, issue=?, helpful=1 WHERE id=1", [CODE, ISSUE])
+        db.commit()
+
+    result = runner.invoke(args=['index-queries'])
+    assert "Indexed 4 queries." in result.output
+
+    with app.app_context():
+        assert find_similar(1, CODE_RENAMED, "", ISSUE) == "response1"
+        assert find_similar(1, CODE_RENAMED, "", ISSUE, exclude_id=1) is None  # excluded
+        assert find_similar(1, "print('hello world')", "", "Why won't this print?") is None  # not similar
+        assert find_similar(2, CODE_RENAMED, "", ISSUE) is None  # different class
+
+
+def test_find_similar_dense_buckets(app):
+    # many students submitting the same starter code: unrated queries do not
+    # crowd helpful ones out of the buckets, and the most recent
+    # MAX_PER_BUCKET helpful queries in each bucket are considered
+    with app.app_context():
+        db = get_db()
+        for i in range(100, 100 + 2 * MAX_PER_BUCKET):
+            db.execute("INSERT INTO queries (id, language, code, issue, response_text, user_id, role_id) VALUES (?, 'Python', ?, ?, ?, 21, 1)",
+                       [i, CODE, ISSUE, f'{{"main": "response{i}"}}'])
+            index_query(db, i, 1, CODE, "", ISSUE)
+        db.execute("UPDATE queries SET helpful=1 WHERE id=100")  # the oldest
+        set_query_helpful(db, 100, True)
+        db.commit()
+        assert find_similar(1, CODE_RENAMED, "", ISSUE) == "response100"
+
+        helpful_ids = range(101, 102 + MAX_PER_BUCKET)
+        db.execute(f"UPDATE queries SET helpful=1 WHERE id IN ({','.join(map(str, helpful_ids))})")
+        for i in helpful_ids:
+            set_query_helpful(db, i, True)
+        db.commit()
+        assert find_similar(1, CODE_RENAMED, "", ISSUE) not in (None, "response100", "response101")  # beyond the most recent MAX_PER_BUCKET
+
+
+def test_post_helpful_indexes(app, client, auth):
+    with app.app_context():
+        db = get_db()
+        db.execute("INSERT INTO roles (id, user_id, class_id, role) VALUES (5, 11, 1, 'student')")
+        db.execute("INSERT INTO queries (id, language, code, issue, response_text, user_id, role_id) VALUES (100, 'Python', ?, ?, '{\"main\": \"response100\"}', 11, 5)",
+                   [CODE, ISSUE])
+        index_query(db, 100, 1, CODE, "", ISSUE)
+        db.commit()
+        assert find_similar(1, CODE_RENAMED, "", ISSUE) is None  # not yet marked helpful
+
+    auth.login()
+    client.post('/help/post_helpful', data={'id': 100, 'value': 1})
+    with app.app_context():
+        assert find_similar(1, CODE_RENAMED, "", ISSUE) == "response100"
+
+    client.post('/help/post_helpful', data={'id': 100, 'value': 0})
+    with app.app_context():
+        assert find_similar(1, CODE_RENAMED, "", ISSUE) is None
+        assert get_db().execute("SELECT COUNT(*) FROM query_lsh WHERE query_id=100").fetchone()[0] == 0
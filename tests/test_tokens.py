@@ -0,0 +1,83 @@
+# SPDX-FileCopyrightText: 2024 Mark Liffiton <liffiton@gmail.com>
+#
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import threading
+
+import openai
+import pytest
+
+from gened.db import get_db
+from gened.openai import get_completion, get_completion_stream, iter_async, run_async
+from gened.tokens import flush_token_batches, spend_token
+
+USER_ID = 21  # an LTI user (local users do not use tokens)
+
+
+def _get_tokens(app):
+    with app.app_context():
+        return get_db().execute("SELECT query_tokens FROM users WHERE id=?", [USER_ID]).fetchone()['query_tokens']
+
+
+def _set_tokens(app, tokens):
+    with app.app_context():
+        db = get_db()
+        db.execute("UPDATE users SET query_tokens=? WHERE id=?", [tokens, USER_ID])
+        db.commit()
+
+
+@pytest.mark.parametrize('batch_interval', [None, 0.01])
+def test_spend_concurrent(app, batch_interval):
+    app.config['TOKEN_BATCH_INTERVAL'] = batch_interval
+    _set_tokens(app, 20)
+
+    num_threads = 8
+    attempts_per_thread = 10
+    results = []
+    barrier = threading.Barrier(num_threads)
+
+    def worker():
+        barrier.wait()
+        for _ in range(attempts_per_thread):
+            with app.app_context():
+                results.append(spend_token(USER_ID))
+
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    flush_token_batches()
+
+    # exactly the available tokens were spent: no over-spend, no lost spends
+    assert results.count(True) == 20
+    assert _get_tokens(app) == 0
+
+
+@pytest.mark.parametrize('batch_interval', [None, 60])
+def test_refund_on_error(app, monkeypatch, batch_interval):
+    app.config['TOKEN_BATCH_INTERVAL'] = batch_interval
+    _set_tokens(app, 2)
+
+    async def fail(*args, **kwargs):
+        raise openai.error.APIConnectionError("connection failed")
+    monkeypatch.setattr(openai.ChatCompletion, 'acreate', fail)
+
+    with app.app_context():
+        assert spend_token(USER_ID)
+        # two failed calls in one request refund the request's token only once
+        _, text = run_async(get_completion("key", prompt="test"))
+        assert text.startswith("Error (")
+        run_async(get_completion("key", prompt="test"))
+
+    with app.app_context():
+        assert spend_token(USER_ID)
+        text = "".join(iter_async(get_completion_stream("key", prompt="test")))
+        assert text.startswith("Error (")
+
+    with app.app_context():
+        assert spend_token(USER_ID)  # no error, so no refund
+
+    flush_token_batches()
+    assert _get_tokens(app) == 1
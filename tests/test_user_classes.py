@@ -61,6 +61,31 @@ def test_user_class_creation(auth, client):
     _test_user_class_link(client, class_access_link_name, 302, '/')
 
 
+
+def test_user_class_rate_limits(auth, client):
+    auth.login()
+    _create_user_class(client, "Test Class")
+
+    response = client.post(
+        '/instructor/user_class/set',
+        data={'save_llm_form': '', 'model_id': 1, 'rate_limit_rpm': '100', 'rate_limit_tpm': ''},
+        headers={'Referer': 'http://localhost/instructor/config/'},
+        follow_redirects=True
+    )
+    assert "Class language model configuration updated." in response.text
+    assert 'name="rate_limit_rpm" value="100"' in response.text
+    assert 'name="rate_limit_tpm" value=""' in response.text
+
+    for bad_value in ['-5', '0', '1.5', 'x']:
+        response = client.post(
+            '/instructor/user_class/set',
+            data={'save_llm_form': '', 'model_id': 1, 'rate_limit_rpm': '100', 'rate_limit_tpm': bad_value},
+            headers={'Referer': 'http://localhost/instructor/config/'},
+            follow_redirects=True
+        )
+        assert "Rate limits must be positive whole numbers" in response.text
+        assert 'name="rate_limit_tpm" value=""' in response.text  # unchanged
+
 def test_user_class_usage(app):
     instructor_client = app.test_client()
     instructor_auth = AuthActions(instructor_client)
@@ -149,3 +174,25 @@ def test_user_class_usage(app):
     _test_user_class_link(user_client, access_link_name, 302, '/')
     result = user_client.get('/help/')
     assert result.status_code == 200
+
+    # 12) instructor disables the class (invalidating its cached configuration)
+    result = instructor_client.post(
+        '/instructor/user_class/set',
+        data={
+            'link_reg_active_present': 'true',
+            'link_reg_active': 'disabled',
+            'save_access_form': '',
+        },
+        headers={
+            'Referer': 'http://localhost/instructor/config'
+        },
+        follow_redirects=True
+    )
+    assert "Class access configuration updated." in result.text
+
+    # 13) user can no longer make queries
+    result = user_client.get('/help/')
+    assert result.status_code == 200
+    assert "The current class is archived or disabled." in result.text
+    result = user_client.post('/help/request', data={'lang_id': 1, 'code': 'student_1_code', 'error': 'error', 'issue': 'issue'})
+    assert "The current class is archived or disabled." in result.text